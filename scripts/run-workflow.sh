@@ -58,7 +58,7 @@ do
         --request GET \
         --url "http://localhost:8100${location}" )
     status=$(echo "$resp" | jq -r .status)
-    if [[ "$status" != "Running" ]]; then
+    if [[ "$status" != "Running" && "$status" != "Queued" ]]; then
         echo "Status: $status - done"
         break
     fi
@@ -0,0 +1,286 @@
+import logging
+import os
+import threading
+import time
+
+import codec
+
+# Admission control limits the number of workflow instances (and the number of actions in them) that are
+# running at once so that a burst of jobs doesn't create lots of workflow instances that all contend for the
+# processors (inflating the latency for every job).
+#
+# MAX_RUNNING_WORKFLOWS is the maximum number of running workflow instances and MAX_OUTSTANDING_ACTIONS
+# is the maximum number of actions across the running workflow instances (0 means no limit for either).
+# The outstanding actions are counted as the total number of actions in the running jobs (whether or not the actions
+# have completed) as the admission controller doesn't track the progress of the workflows.
+# When there isn't capacity for a job, it is either added to a pending queue (ADMISSION_MODE=queue, the default)
+# which is started as running workflows complete, or rejected (ADMISSION_MODE=reject) and the caller
+# is told to retry after ADMISSION_RETRY_AFTER_SECONDS. Jobs are also rejected if the queue is full
+# (i.e. has MAX_PENDING_WORKFLOWS jobs).
+#
+# The running workflows and pending queue are kept in memory and saved in the state store so that queued jobs
+# survive restarts (this assumes a single instance of the workflow app). The saved admission state only has the
+# instance ids and action counts, and each queued job is saved under its own key (admission||<instance_id>)
+# so that queueing or starting a job doesn't rewrite the other jobs.
+# Completed workflows are found by the drain thread (every ADMISSION_DRAIN_INTERVAL_SECONDS) rather than when
+# jobs are submitted, so submitting a job doesn't have to check the status of every running workflow instance.
+#
+# Slots are reserved while holding the lock, but the workflows are started and the state saved after releasing it
+# so that a slow Dapr call doesn't hold up the other submitted jobs. A reservation is released again if the call
+# fails, and a queued job that fails to start is put back at the head of the queue to be retried at the next drain.
+
+MAX_RUNNING_WORKFLOWS = int(os.getenv("MAX_RUNNING_WORKFLOWS", "0"))
+MAX_OUTSTANDING_ACTIONS = int(os.getenv("MAX_OUTSTANDING_ACTIONS", "0"))
+MAX_PENDING_WORKFLOWS = int(os.getenv("MAX_PENDING_WORKFLOWS", "1000"))
+MODE = os.getenv("ADMISSION_MODE", "queue").lower()
+RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "30"))
+DRAIN_INTERVAL_SECONDS = float(os.getenv("ADMISSION_DRAIN_INTERVAL_SECONDS", "5"))
+
+STARTED = "started"
+QUEUED = "queued"
+REJECTED = "rejected"
+
+
+class DaprStateStore:
+    # Saves the admission state items in a Dapr state store
+    # (get_dapr_client is called to get the client when it is needed)
+    def __init__(self, get_dapr_client, store_name="statestore"):
+        self._get_dapr_client = get_dapr_client
+        self._store_name = store_name
+
+    def load(self, key):
+        state = self._get_dapr_client().get_state(self._store_name, key)
+        return codec.loads(state.data) if state.data else None
+
+    def save(self, key, value):
+        self._get_dapr_client().save_state(self._store_name, key, codec.dumps(value))
+
+    def delete(self, key):
+        self._get_dapr_client().delete_state(self._store_name, key)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        store,
+        is_running,
+        start_workflow,
+        max_running_workflows=MAX_RUNNING_WORKFLOWS,
+        max_outstanding_actions=MAX_OUTSTANDING_ACTIONS,
+        max_pending_workflows=MAX_PENDING_WORKFLOWS,
+        mode=MODE,
+    ):
+        # store has load, save and delete methods for the admission state and queued jobs (by key)
+        # is_running is called with an instance id and returns whether the workflow instance is still running
+        # (False for an instance that no longer exists, e.g. because it has been purged)
+        # start_workflow is called with an instance id and the job to start a workflow instance
+        self.max_running_workflows = max_running_workflows
+        self.max_outstanding_actions = max_outstanding_actions
+        self.max_pending_workflows = max_pending_workflows
+        self.mode = mode
+        self._store = store
+        self._is_running = is_running
+        self._start_workflow = start_workflow
+        self._lock = threading.Lock()
+        # held while saving the admission state so that an older snapshot can't overwrite a newer one
+        self._save_lock = threading.Lock()
+        self._state = None
+        # the instance ids of the jobs that have been reserved a running slot and are being started
+        self._starting = set()
+        # the instance ids of the jobs that have been reserved a place in the queue and are being saved
+        self._saving = set()
+
+    @property
+    def enabled(self):
+        return self.max_running_workflows > 0 or self.max_outstanding_actions > 0
+
+    def submit(self, instance_id, data, action_count):
+        """Starts a workflow instance for the job if there is capacity, otherwise queues or rejects it.
+
+        Returns STARTED, QUEUED or REJECTED
+        """
+        if not self.enabled:
+            self._start_workflow(instance_id, data)
+            return STARTED
+
+        job = {"instance_id": instance_id, "action_count": action_count}
+        with self._lock:
+            state = self._get_state()
+            # jobs aren't allowed to jump the queue
+            if len(state["pending"]) == 0 and self._has_capacity(state, action_count):
+                state["running"].append(job)
+                self._starting.add(instance_id)
+                result = STARTED
+            elif self.mode == "queue" and len(state["pending"]) < self.max_pending_workflows:
+                state["pending"].append(job)
+                # the queued job isn't started until it has been saved (see drain)
+                self._saving.add(instance_id)
+                result = QUEUED
+            else:
+                return REJECTED
+
+        try:
+            if result == STARTED:
+                self._start_workflow(instance_id, data)
+            else:
+                self._store.save(_get_job_key(instance_id), data)
+        except Exception:
+            with self._lock:
+                state = self._get_state()
+                state["running" if result == STARTED else "pending"].remove(job)
+            raise
+        finally:
+            with self._lock:
+                self._starting.discard(instance_id)
+                self._saving.discard(instance_id)
+        self._save_state()
+        return result
+
+    def drain(self):
+        """Removes completed workflows and starts queued jobs (in order) while there is capacity.
+
+        Returns the number of jobs started
+        """
+        if not self.enabled:
+            return 0
+
+        self._remove_completed()
+        logger = logging.getLogger("admission")
+        started = 0
+        while True:
+            with self._lock:
+                state = self._get_state()
+                if (
+                    len(state["pending"]) == 0
+                    or state["pending"][0]["instance_id"] in self._saving
+                    or not self._has_capacity(state, state["pending"][0]["action_count"])
+                ):
+                    return started
+                job = state["pending"].pop(0)
+                state["running"].append(job)
+                self._starting.add(job["instance_id"])
+
+            try:
+                data = self._store.load(_get_job_key(job["instance_id"]))
+                if data is None:
+                    logger.error(f"admission: queued job not found: {job['instance_id']}")
+                    with self._lock:
+                        self._get_state()["running"].remove(job)
+                else:
+                    self._start_workflow(job["instance_id"], data)
+                    started += 1
+            except Exception as e:
+                # put the job back at the head of the queue so that it is retried (in order) at the next drain
+                logger.error(f"admission: failed to start queued job {job['instance_id']}: {e}")
+                with self._lock:
+                    state = self._get_state()
+                    state["running"].remove(job)
+                    state["pending"].insert(0, job)
+                return started
+            finally:
+                with self._lock:
+                    self._starting.discard(job["instance_id"])
+            # saved after each job so that the jobs already started aren't started again if a later one fails
+            self._save_state()
+            self._store.delete(_get_job_key(job["instance_id"]))
+
+    def get_queue_position(self, instance_id):
+        # returns the (1-based) position of the job in the pending queue, or None if it isn't queued
+        if not self.enabled:
+            return None
+        with self._lock:
+            for index, job in enumerate(self._get_state()["pending"]):
+                if job["instance_id"] == instance_id:
+                    return index + 1
+        return None
+
+    def get_status(self):
+        with self._lock:
+            state = self._get_state() if self.enabled else {"running": [], "pending": []}
+            return {
+                "mode": self.mode,
+                "max_running_workflows": self.max_running_workflows,
+                "max_outstanding_actions": self.max_outstanding_actions,
+                "max_pending_workflows": self.max_pending_workflows,
+                "running_workflows": len(state["running"]),
+                "outstanding_actions": _get_action_count(state["running"]),
+                "queue_depth": len(state["pending"]),
+            }
+
+    def _get_state(self):
+        # loaded from the store the first time it is needed (e.g. after a restart) and then kept in memory
+        if self._state is None:
+            self._state = self._store.load(_STATE_KEY) or {"running": [], "pending": []}
+        return self._state
+
+    def _save_state(self):
+        # called without holding self._lock, which is only held to take a snapshot of the state
+        with self._save_lock:
+            with self._lock:
+                state = {"running": list(self._state["running"]), "pending": list(self._state["pending"])}
+            self._store.save(_STATE_KEY, state)
+
+    def _remove_completed(self):
+        # the workflow statuses are checked without holding the lock so that submitting jobs isn't held up
+        # (the jobs that are still being started are skipped as their workflow instances may not exist yet)
+        with self._lock:
+            instance_ids = [
+                job["instance_id"] for job in self._get_state()["running"] if job["instance_id"] not in self._starting
+            ]
+        completed = {instance_id for instance_id in instance_ids if not self._is_job_running(instance_id)}
+        if len(completed) == 0:
+            return
+        with self._lock:
+            state = self._get_state()
+            state["running"] = [job for job in state["running"] if job["instance_id"] not in completed]
+        self._save_state()
+
+    def _is_job_running(self, instance_id):
+        try:
+            return self._is_running(instance_id)
+        except Exception as e:
+            # keep the job's slot (rather than failing the drain) until its status can be checked
+            logging.getLogger("admission").error(f"admission: failed to check workflow status {instance_id}: {e}")
+            return True
+
+    def _has_capacity(self, state, action_count):
+        if len(state["running"]) == 0:
+            # always allow a job when nothing is running (even if it has more than MAX_OUTSTANDING_ACTIONS actions)
+            return True
+        if self.max_running_workflows > 0 and len(state["running"]) >= self.max_running_workflows:
+            return False
+        if (
+            self.max_outstanding_actions > 0
+            and _get_action_count(state["running"]) + action_count > self.max_outstanding_actions
+        ):
+            return False
+        return True
+
+
+_STATE_KEY = "admission"
+
+
+def _get_job_key(instance_id):
+    return f"admission||{instance_id}"
+
+
+def _get_action_count(jobs):
+    return sum(job["action_count"] for job in jobs)
+
+
+def start_draining(admission_controller, interval_seconds=DRAIN_INTERVAL_SECONDS):
+    """Starts a background thread that periodically starts queued jobs as running workflows complete"""
+
+    def drain():
+        logger = logging.getLogger("admission")
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                started = admission_controller.drain()
+                if started > 0:
+                    logger.info(f"admission: started {started} queued workflow(s)")
+            except Exception as e:
+                logger.error(f"admission: drain failed: {e}")
+
+    if admission_controller.enabled:
+        threading.Thread(target=drain, name="admission-drain", daemon=True).start()
@@ -0,0 +1,179 @@
+from collections import deque
+import os
+import threading
+import time
+
+# Circuit breakers stop calls to a target app (e.g. a processor) that is failing or responding slowly
+# so that the target isn't hammered while it recovers and callers get an error straight away.
+#
+# A circuit breaker starts in the closed state (calls are allowed) and tracks the outcome of the last
+# CIRCUIT_BREAKER_WINDOW_SIZE calls. Once there are at least CIRCUIT_BREAKER_MINIMUM_CALLS calls in the window,
+# if the percentage of failed calls or slow calls reaches the threshold then the circuit breaker opens.
+# While open, calls fail with CircuitOpenError without calling the target.
+# After CIRCUIT_BREAKER_OPEN_SECONDS the circuit breaker becomes half-open and allows a limited number of
+# trial calls through: if they succeed the circuit breaker closes, otherwise it opens again.
+
+ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+WINDOW_SIZE = int(os.getenv("CIRCUIT_BREAKER_WINDOW_SIZE", "20"))
+MINIMUM_CALLS = int(os.getenv("CIRCUIT_BREAKER_MINIMUM_CALLS", "5"))
+FAILURE_RATE_THRESHOLD = float(os.getenv("CIRCUIT_BREAKER_FAILURE_RATE", "50"))
+SLOW_CALL_RATE_THRESHOLD = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_RATE", "100"))
+SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_SECONDS", "30"))
+OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "30"))
+HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_CALLS", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name):
+        super().__init__(f"circuit breaker open for {name}")
+        self.name = name
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name,
+        window_size=WINDOW_SIZE,
+        minimum_calls=MINIMUM_CALLS,
+        failure_rate_threshold=FAILURE_RATE_THRESHOLD,
+        slow_call_rate_threshold=SLOW_CALL_RATE_THRESHOLD,
+        slow_call_seconds=SLOW_CALL_SECONDS,
+        open_seconds=OPEN_SECONDS,
+        half_open_calls=HALF_OPEN_CALLS,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window_size)  # (failed, slow) for recent calls
+        self._state = CLOSED
+        self._opened_at = None
+        self._half_open_started = 0
+        self._half_open_succeeded = 0
+
+    def call(self, fn, is_failure=lambda result: False):
+        """Calls fn if the circuit breaker allows it, otherwise raises CircuitOpenError.
+
+        Exceptions raised by fn are treated as failures, as are results for which is_failure returns True
+        """
+        self.before_call()
+        start = self._clock()
+        try:
+            result = fn()
+        except Exception:
+            self.record_call(failed=True, duration=self._clock() - start)
+            raise
+        self.record_call(failed=is_failure(result), duration=self._clock() - start)
+        return result
+
+    def before_call(self):
+        with self._lock:
+            if self._state == OPEN:
+                if self._clock() - self._opened_at < self.open_seconds:
+                    raise CircuitOpenError(self.name)
+                self._state = HALF_OPEN
+                self._half_open_started = 0
+                self._half_open_succeeded = 0
+            if self._state == HALF_OPEN:
+                if self._half_open_started >= self.half_open_calls:
+                    raise CircuitOpenError(self.name)
+                self._half_open_started += 1
+
+    def is_call_allowed(self):
+        """Returns whether a call would be allowed now (without starting one, unlike before_call)"""
+        with self._lock:
+            if self._state == OPEN:
+                return self._clock() - self._opened_at >= self.open_seconds
+            if self._state == HALF_OPEN:
+                return self._half_open_started < self.half_open_calls
+            return True
+
+    def record_call(self, failed, duration):
+        slow = duration >= self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if failed or slow:
+                    self._open()
+                else:
+                    self._half_open_succeeded += 1
+                    if self._half_open_succeeded >= self.half_open_calls:
+                        self._state = CLOSED
+                        self._calls.clear()
+            elif self._state == CLOSED:
+                self._calls.append((failed, slow))
+                if len(self._calls) >= self.minimum_calls and (
+                    self._get_rate(0) >= self.failure_rate_threshold
+                    or self._get_rate(1) >= self.slow_call_rate_threshold
+                ):
+                    self._open()
+            # calls that complete while the circuit breaker is open are ignored
+
+    def get_status(self):
+        with self._lock:
+            status = {
+                "state": self._state,
+                "calls": len(self._calls),
+                "failure_rate": self._get_rate(0),
+                "slow_call_rate": self._get_rate(1),
+            }
+            if self._state == OPEN:
+                status["open_seconds_remaining"] = max(
+                    0, self.open_seconds - (self._clock() - self._opened_at)
+                )
+            return status
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._calls.clear()
+
+    def _get_rate(self, index):
+        # returns the percentage of calls in the window that failed (index 0) or were slow (index 1)
+        if len(self._calls) == 0:
+            return 0
+        return 100 * sum(1 for call in self._calls if call[index]) / len(self._calls)
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    """Returns the circuit breaker for the named target (shared across all callers in the process)"""
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            _circuit_breakers[name] = CircuitBreaker(name)
+        return _circuit_breakers[name]
+
+
+def call_with_circuit_breaker(name, fn, is_failure=lambda result: False):
+    """Calls fn using the circuit breaker for the named target (if circuit breakers are enabled)"""
+    if not ENABLED:
+        return fn()
+    return get_circuit_breaker(name).call(fn, is_failure)
+
+
+def is_call_allowed(name):
+    """Returns whether the circuit breaker for the named target would allow a call now (if they are enabled)"""
+    if not ENABLED:
+        return True
+    return get_circuit_breaker(name).is_call_allowed()
+
+
+def get_circuit_breaker_statuses():
+    with _circuit_breakers_lock:
+        circuit_breakers = list(_circuit_breakers.values())
+    return {
+        circuit_breaker.name: circuit_breaker.get_status()
+        for circuit_breaker in circuit_breakers
+    }
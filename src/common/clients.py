@@ -0,0 +1,20 @@
+import threading
+
+from dapr.clients import DaprClient
+
+from local_dapr import LOCAL_DAPR_ENABLED, LocalDaprClient
+
+# The DaprClient is shared by the app and the workflow activities, and is created on first use
+# (rather than at import time) so that importing the modules doesn't wait for the Dapr sidecar.
+# When running against the local stand-in (LOCAL_DAPR=true) a LocalDaprClient is used instead (see local_dapr.py)
+
+_dapr_client = None
+_dapr_client_lock = threading.Lock()
+
+
+def get_dapr_client():
+    global _dapr_client
+    with _dapr_client_lock:
+        if _dapr_client is None:
+            _dapr_client = LocalDaprClient() if LOCAL_DAPR_ENABLED else DaprClient()
+        return _dapr_client
@@ -0,0 +1,124 @@
+import json
+import lzma
+import os
+import zlib
+
+# The codec is used to serialise the data that is saved in the state store and sent via pub/sub.
+#
+# CODEC selects the serialisation format: json (the default), msgpack or cbor.
+# msgpack and cbor are more compact and faster for large payloads but need the msgpack or cbor2 package
+# to be installed (in every service that reads or writes the data).
+# CODEC_COMPRESSION selects the compression to use: none (the default), zlib or lzma.
+# Only values larger than CODEC_COMPRESSION_MIN_BYTES are compressed.
+#
+# Data that isn't plain JSON is tagged with its content type (e.g. "application/msgpack+zlib") so that it can
+# be decoded regardless of the current settings. Plain JSON is left untagged so that it is compatible with
+# data saved before the codec was configured (and with services that expect JSON).
+
+CODEC = os.getenv("CODEC", "json").lower()
+COMPRESSION = os.getenv("CODEC_COMPRESSION", "none").lower()
+COMPRESSION_MIN_BYTES = int(os.getenv("CODEC_COMPRESSION_MIN_BYTES", "1024"))
+
+JSON_CONTENT_TYPE = "application/json"
+# content type for tagged data (the actual content type is in the tag)
+TAGGED_CONTENT_TYPE = "application/octet-stream"
+
+_TAG_PREFIX = b"\x00"
+_TAG_SUFFIX = b"\n"
+
+
+def _get_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ValueError("The msgpack codec requires the msgpack package (pip install msgpack)")
+    return msgpack
+
+
+def _get_cbor2():
+    try:
+        import cbor2
+    except ImportError:
+        raise ValueError("The cbor codec requires the cbor2 package (pip install cbor2)")
+    return cbor2
+
+
+_CODECS = {
+    "json": (
+        JSON_CONTENT_TYPE,
+        lambda value: json.dumps(value, separators=(",", ":")).encode("utf-8"),
+        lambda data: json.loads(data),
+    ),
+    "msgpack": (
+        "application/msgpack",
+        lambda value: _get_msgpack().packb(value),
+        lambda data: _get_msgpack().unpackb(data),
+    ),
+    "cbor": (
+        "application/cbor",
+        lambda value: _get_cbor2().dumps(value),
+        lambda data: _get_cbor2().loads(data),
+    ),
+}
+
+_COMPRESSIONS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def encode(value, codec=None, compression=None, compression_min_bytes=None):
+    """Serialises value using the codec (and compression) and returns the bytes and the content type"""
+    codec = codec or CODEC
+    compression = compression or COMPRESSION
+    compression_min_bytes = COMPRESSION_MIN_BYTES if compression_min_bytes is None else compression_min_bytes
+    if codec not in _CODECS:
+        raise ValueError(f"Unknown codec: {codec}")
+    if compression != "none" and compression not in _COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+
+    content_type, dumps, _ = _CODECS[codec]
+    data = dumps(value)
+    if compression != "none" and len(data) >= compression_min_bytes:
+        data = _COMPRESSIONS[compression][0](data)
+        content_type = f"{content_type}+{compression}"
+    return data, content_type
+
+
+def decode(data, content_type=JSON_CONTENT_TYPE):
+    """Deserialises data that was serialised with the given content type"""
+    base_content_type, _, compression = content_type.partition("+")
+    if compression:
+        if compression not in _COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        data = _COMPRESSIONS[compression][1](data)
+    for codec_content_type, _, loads in _CODECS.values():
+        if codec_content_type == base_content_type:
+            return loads(data)
+    raise ValueError(f"Unknown content type: {content_type}")
+
+
+def dumps(value, **kwargs):
+    """Serialises value to bytes that are tagged with the content type (unless they are plain JSON)
+
+    Takes the same arguments as encode
+    """
+    data, content_type = encode(value, **kwargs)
+    if content_type == JSON_CONTENT_TYPE:
+        return data
+    return _TAG_PREFIX + content_type.encode("ascii") + _TAG_SUFFIX + data
+
+
+def loads(data):
+    """Deserialises data from dumps (untagged data is treated as JSON)"""
+    if isinstance(data, str):
+        return json.loads(data)
+    if data.startswith(_TAG_PREFIX):
+        tag_end = data.index(_TAG_SUFFIX)
+        return decode(data[tag_end + 1 :], data[1:tag_end].decode("ascii"))
+    return json.loads(data)
+
+
+def get_content_type(data):
+    """Returns the content type to send with data from dumps"""
+    return TAGGED_CONTENT_TYPE if data.startswith(_TAG_PREFIX) else JSON_CONTENT_TYPE
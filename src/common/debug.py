@@ -0,0 +1,277 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Debug endpoints for finding where the time goes in a running service:
+#  - /debug/profile?seconds=N samples the stacks of all threads for N seconds and returns them as collapsed stacks
+#    (one line per stack with the number of samples, the input format for flame graph tools such as
+#    flamegraph.pl or speedscope), or a summary of the functions with the most samples (format=top, similar to
+#    pstats output). Threads waiting on locks, queues or sockets are left out unless idle=true.
+#  - /debug/stats returns thread counts, thread pool utilisation (for all of the ThreadPoolExecutors in the process,
+#    e.g. the Dapr workflow worker and gRPC server pools), and GC and memory statistics.
+#
+# The endpoints are only registered (and GC pauses only timed) when DEBUG_ENDPOINTS=true,
+# so there is no cost when they are disabled.
+# For the gRPC services (processing_consumer) the endpoints are the debug/profile and debug/stats methods
+# with the profile options in the (JSON) body, e.g. {"seconds": 10, "format": "top"}.
+
+DEBUG_ENDPOINTS_ENABLED = os.getenv("DEBUG_ENDPOINTS", "false").lower() == "true"
+PROFILE_MAX_SECONDS = float(os.getenv("DEBUG_PROFILE_MAX_SECONDS", "60"))
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(os.getenv("DEBUG_PROFILE_SAMPLE_INTERVAL_SECONDS", "0.01"))
+
+COLLAPSED = "collapsed"
+TOP = "top"
+
+# the leaf frames of threads that are waiting rather than doing work
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("socketserver.py", "serve_forever"),
+    ("thread.py", "_worker"),
+    # the gRPC server (dapr.ext.grpc) polling for requests
+    ("_server.py", "_serve"),
+    ("_common.py", "_wait_once"),
+}
+
+_profile_lock = threading.Lock()
+_gc_pause_seconds = [0.0, 0.0, 0.0]
+_gc_started_at = None
+
+
+class ProfileInProgressError(Exception):
+    pass
+
+
+def sample_stacks(seconds, interval_seconds=PROFILE_SAMPLE_INTERVAL_SECONDS, include_idle=False):
+    """Samples the stacks of all threads (other than the calling thread) for the given number of seconds.
+
+    Returns (Counter of stack -> sample count, number of samples), where each stack is a tuple of frames
+    starting with the thread name (with any numeric suffix removed so that the threads in a pool are combined)
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfileInProgressError("a profile is already in progress")
+    try:
+        stacks = Counter()
+        sample_count = 0
+        own_thread_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while True:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                if not include_idle and _is_idle(frame):
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(_format_frame(frame))
+                    frame = frame.f_back
+                frames.append(_get_thread_group(thread_names.get(thread_id, str(thread_id))))
+                stacks[tuple(reversed(frames))] += 1
+            sample_count += 1
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(interval_seconds)
+        return stacks, sample_count
+    finally:
+        _profile_lock.release()
+
+
+def format_collapsed(stacks):
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+
+def format_top(stacks, sample_count, limit=50):
+    # self: samples with the function at the top of the stack, cumulative: samples with the function in the stack
+    self_counts = Counter()
+    cumulative_counts = Counter()
+    for stack, count in stacks.items():
+        # the first item is the thread name
+        self_counts[stack[-1]] += count
+        for frame in set(stack[1:]):
+            cumulative_counts[frame] += count
+    lines = [
+        f"{sample_count} samples, {sum(stacks.values())} thread stacks",
+        "",
+        f"{'self':>8} {'self%':>7} {'cum':>8} {'cum%':>7}  function",
+    ]
+    total = max(1, sum(stacks.values()))
+    for frame, count in cumulative_counts.most_common(limit):
+        self_count = self_counts[frame]
+        lines.append(
+            f"{self_count:>8} {100 * self_count / total:>6.1f}% {count:>8} {100 * count / total:>6.1f}%  {frame}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def profile(seconds, format=COLLAPSED, include_idle=False):
+    """Runs a sampling profile and returns the output as text"""
+    if format not in [COLLAPSED, TOP]:
+        raise ValueError(f"Unknown profile format: {format}")
+    seconds = float(seconds)
+    if not math.isfinite(seconds):
+        # min/max don't clamp nan, which would sample forever (while holding the profile lock)
+        raise ValueError(f"seconds must be a finite number: {seconds}")
+    seconds = min(max(seconds, 0.0), PROFILE_MAX_SECONDS)
+    stacks, sample_count = sample_stacks(seconds, include_idle=include_idle)
+    if format == TOP:
+        return format_top(stacks, sample_count)
+    return format_collapsed(stacks)
+
+
+def get_stats():
+    threads = threading.enumerate()
+    return {
+        "pid": os.getpid(),
+        "threads": {
+            "count": len(threads),
+            "by_name": dict(Counter(_get_thread_group(thread.name) for thread in threads).most_common()),
+        },
+        "thread_pools": [_get_thread_pool_stats(executor) for executor in _get_thread_pools()],
+        "gc": _get_gc_stats(),
+        "memory": _get_memory_stats(),
+    }
+
+
+def register_debug_routes(app):
+    """Adds /debug/profile and /debug/stats to a Flask app if DEBUG_ENDPOINTS is enabled"""
+    if not DEBUG_ENDPOINTS_ENABLED:
+        return
+    from flask import Response, request
+
+    _start_gc_timing()
+
+    @app.route("/debug/profile", methods=["GET"])
+    def debug_profile():
+        try:
+            output = profile(
+                request.args.get("seconds", "10"),
+                format=request.args.get("format", COLLAPSED),
+                include_idle=request.args.get("idle", "false").lower() == "true",
+            )
+        except ProfileInProgressError as e:
+            return {"error": str(e)}, 409
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        return Response(output, content_type="text/plain")
+
+    @app.route("/debug/stats", methods=["GET"])
+    def debug_stats():
+        return get_stats()
+
+
+def register_debug_methods(app):
+    """Adds debug/profile and debug/stats methods to a dapr.ext.grpc App if DEBUG_ENDPOINTS is enabled"""
+    if not DEBUG_ENDPOINTS_ENABLED:
+        return
+
+    _start_gc_timing()
+
+    @app.method(name="debug/profile")
+    def debug_profile(request):
+        options = json.loads(request.text() or "{}")
+        try:
+            return profile(
+                options.get("seconds", 10),
+                format=options.get("format", COLLAPSED),
+                include_idle=options.get("idle", False),
+            )
+        except (ProfileInProgressError, ValueError) as e:
+            return json.dumps({"error": str(e)})
+
+    @app.method(name="debug/stats")
+    def debug_stats(request):
+        return json.dumps(get_stats())
+
+
+def _format_frame(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle(frame):
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_FRAMES
+
+
+def _get_thread_group(thread_name):
+    # e.g. ThreadPoolExecutor-0_3 -> ThreadPoolExecutor-0, Thread-12 (process_request_thread) -> Thread
+    thread_name = re.sub(r"^Thread-\d+ \(.*\)$", "Thread", thread_name)
+    return re.sub(r"[-_]\d+$", "", thread_name)
+
+
+def _get_thread_pools():
+    # only called for /debug/stats, so the cost of scanning the objects tracked by the GC is acceptable
+    return [obj for obj in gc.get_objects() if isinstance(obj, ThreadPoolExecutor)]
+
+
+def _get_thread_pool_stats(executor):
+    # uses ThreadPoolExecutor internals, so each value is read defensively
+    threads = len(getattr(executor, "_threads", ()))
+    idle_semaphore = getattr(executor, "_idle_semaphore", None)
+    idle = getattr(idle_semaphore, "_value", 0) if idle_semaphore is not None else 0
+    work_queue = getattr(executor, "_work_queue", None)
+    return {
+        "name": getattr(executor, "_thread_name_prefix", None) or "ThreadPoolExecutor",
+        "max_workers": getattr(executor, "_max_workers", None),
+        "threads": threads,
+        "busy": max(0, threads - idle),
+        "queued": work_queue.qsize() if work_queue is not None else 0,
+        "shutdown": getattr(executor, "_shutdown", False),
+    }
+
+
+def _start_gc_timing():
+    global _gc_started_at
+    if _gc_started_at is not None:
+        return
+    _gc_started_at = {}
+
+    def on_gc(phase, info):
+        if phase == "start":
+            _gc_started_at[info["generation"]] = time.perf_counter()
+        elif info["generation"] in _gc_started_at:
+            _gc_pause_seconds[info["generation"]] += time.perf_counter() - _gc_started_at.pop(info["generation"])
+
+    gc.callbacks.append(on_gc)
+
+
+def _get_gc_stats():
+    return {
+        "enabled": gc.isenabled(),
+        "counts": gc.get_count(),
+        "thresholds": gc.get_threshold(),
+        "generations": [
+            dict(stats, pause_seconds=round(pause_seconds, 6))
+            for stats, pause_seconds in zip(gc.get_stats(), _gc_pause_seconds)
+        ],
+        "tracked_objects": len(gc.get_objects()),
+    }
+
+
+def _get_memory_stats():
+    stats = {"rss_bytes": None, "max_rss_bytes": None}
+    try:
+        with open("/proc/self/statm") as f:
+            stats["rss_bytes"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        stats["max_rss_bytes"] = max_rss if sys.platform == "darwin" else max_rss * 1024
+    return stats
@@ -0,0 +1,491 @@
+import base64
+from collections import deque
+from datetime import datetime, timedelta, timezone
+import inspect
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dapr.clients.grpc._response import BulkStateItem, BulkStatesResponse, StateResponse
+
+try:
+    from dapr.ext.workflow._durabletask import task
+    from dapr.ext.workflow._durabletask.internal import helpers, shared
+except ImportError:
+    # older versions of the Dapr SDK use the durabletask package
+    from durabletask import task
+    from durabletask.internal import helpers, shared
+
+# Running the services normally needs the Dapr CLI, a sidecar per app and Redis. For local performance testing
+# the services can instead be run against the stand-in in src/local_sidecar (see the README), which implements
+# the subset of the Dapr HTTP API that the services use. Setting LOCAL_DAPR=true makes this app use:
+#  - LocalWorkflowRuntime, which runs the workflows and activities in-process in place of the Dapr workflow engine
+#  - LocalDaprClient, which implements the DaprClient methods used by the app, using the LocalWorkflowRuntime
+#    for workflows and the stand-in's HTTP API (on DAPR_HTTP_PORT) for state and pub/sub
+#
+# Workflow state is only held in memory, so workflows don't survive a restart of the app and
+# the workflow runtime can't be run in separate worker processes (WORKFLOW_WORKERS is ignored).
+
+LOCAL_DAPR_ENABLED = os.getenv("LOCAL_DAPR", "false").lower() == "true"
+
+_TERMINAL_STATUSES = ["Completed", "Failed", "Terminated"]
+
+_local_runtime = None
+
+
+def _utc_now():
+    # naive UTC datetime to match DaprWorkflowContext.current_utc_datetime
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class LocalWorkflowRuntime:
+    """In-process stand-in for WorkflowRuntime (see above)"""
+
+    def __init__(self, max_concurrent_activities=None):
+        self._workflows = {}
+        self._activities = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+        self._max_concurrent_activities = max_concurrent_activities
+        self._executor = None
+
+    def register_workflow(self, fn, *, name=None):
+        self._workflows[name or fn.__name__] = fn
+
+    def register_activity(self, fn, *, name=None):
+        self._activities[name or fn.__name__] = fn
+
+    def start(self):
+        global _local_runtime
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._max_concurrent_activities, thread_name_prefix="local-activity"
+        )
+        _local_runtime = self
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def wait_for_worker_ready(self, timeout=None):
+        return self._executor is not None
+
+    def schedule_new_workflow(self, workflow_name, input=None, instance_id=None, parent=None):
+        if workflow_name not in self._workflows:
+            raise ValueError(f"workflow {workflow_name} is not registered")
+        instance_id = instance_id or uuid.uuid4().hex
+        with self._lock:
+            existing = self._instances.get(instance_id)
+            if existing is not None and existing.runtime_status not in _TERMINAL_STATUSES:
+                raise ValueError(f"workflow instance {instance_id} already exists")
+            instance = _WorkflowInstance(self, instance_id, workflow_name, shared.to_json(input), parent)
+            self._instances[instance_id] = instance
+        instance.post(instance.start)
+        return instance_id
+
+    def get_instance(self, instance_id):
+        with self._lock:
+            instance = self._instances.get(instance_id)
+        if instance is None:
+            raise ValueError(f"workflow instance {instance_id} not found")
+        return instance
+
+    def purge_instance(self, instance_id):
+        with self._lock:
+            instance = self._instances.get(instance_id)
+            if instance is None:
+                raise ValueError(f"workflow instance {instance_id} not found")
+            if instance.runtime_status not in _TERMINAL_STATUSES:
+                raise ValueError(f"workflow instance {instance_id} is still running")
+            del self._instances[instance_id]
+
+    def terminate_instance(self, instance_id, output=None):
+        instance = self.get_instance(instance_id)
+        instance.post(lambda: instance.terminate(output))
+
+    def raise_event(self, instance_id, event_name, data=None):
+        instance = self.get_instance(instance_id)
+        encoded_data = shared.to_json(data)
+        instance.post(lambda: instance.on_event_raised(event_name.lower(), shared.from_json(encoded_data)))
+
+
+class _WorkflowInstance:
+    def __init__(self, runtime, instance_id, workflow_name, input, parent):
+        self.runtime = runtime
+        self.instance_id = instance_id
+        self.workflow_name = workflow_name
+        self.input = input
+        self.output = None
+        self.custom_status = None
+        self.failure = None
+        self.runtime_status = "Pending"
+        self.created_at = _utc_now()
+        self.last_updated_at = self.created_at
+        self._parent = parent  # (parent instance, task) for child workflows
+        self._context = None
+        self._generator = None
+        self._current_task = None
+        self._task_id = 0
+        self._buffered_events = {}
+        self._event_waiters = {}
+        # events for the instance (task completions, raised events) are processed one at a time
+        # by whichever thread posts them, so that the orchestrator is never run concurrently
+        self._mailbox = deque()
+        self._mailbox_lock = threading.Lock()
+        self._is_processing = False
+
+    def post(self, fn):
+        with self._mailbox_lock:
+            self._mailbox.append(fn)
+            if self._is_processing:
+                return
+            self._is_processing = True
+        while True:
+            with self._mailbox_lock:
+                if len(self._mailbox) == 0:
+                    self._is_processing = False
+                    return
+                fn = self._mailbox.popleft()
+            try:
+                fn()
+            except Exception as e:
+                self._fail(e)
+
+    def start(self):
+        if self.runtime_status == "Terminated":
+            # terminated before starting (or before continuing as new)
+            return
+        self._context = _LocalWorkflowContext(self)
+        self._generator = None
+        self._current_task = None
+        self.runtime_status = "Running"
+        self.last_updated_at = self._context.current_utc_datetime = _utc_now()
+        result = self.runtime._workflows[self.workflow_name](self._context, shared.from_json(self.input))
+        if not inspect.isgenerator(result):
+            self._complete(result)
+            return
+        self._generator = result
+        self._resume(None)
+
+    def next_task_id(self):
+        self._task_id += 1
+        return self._task_id
+
+    def on_task_completed(self):
+        if self._current_task is None or not self._current_task.is_complete:
+            return
+        completed_task = self._current_task
+        self._current_task = None
+        self._resume(completed_task)
+
+    def on_event_raised(self, event_name, data):
+        if self.runtime_status in _TERMINAL_STATUSES:
+            return
+        waiters = self._event_waiters.get(event_name)
+        if waiters:
+            waiters.popleft().complete(data)
+            self.on_task_completed()
+        else:
+            self._buffered_events.setdefault(event_name, deque()).append(data)
+
+    def wait_for_event(self, event_name, event_task):
+        buffered = self._buffered_events.get(event_name)
+        if buffered:
+            event_task.complete(buffered.popleft())
+        else:
+            self._event_waiters.setdefault(event_name, deque()).append(event_task)
+
+    def _resume(self, completed_task):
+        self.last_updated_at = self._context.current_utc_datetime = _utc_now()
+        try:
+            while True:
+                if completed_task is None:
+                    next_task = next(self._generator)
+                elif completed_task.is_failed:
+                    next_task = self._generator.throw(completed_task.get_exception())
+                else:
+                    next_task = self._generator.send(completed_task.get_result())
+                if not next_task.is_complete:
+                    self._current_task = next_task
+                    return
+                completed_task = next_task
+        except StopIteration as e:
+            self._complete(e.value)
+
+    def _complete(self, result):
+        if self._context.continue_as_new_input is not None:
+            # restart the workflow with the new input (carrying over any raised events if requested)
+            self.input = shared.to_json(self._context.continue_as_new_input)
+            if not self._context.save_events:
+                self._buffered_events = {}
+            self._event_waiters = {}
+            self.post(self.start)
+            return
+        self.output = shared.to_json(result)
+        self._set_terminal_status("Completed")
+        if self._parent is not None:
+            parent, parent_task = self._parent
+            output = self.output
+            parent.post(lambda: (parent_task.complete(shared.from_json(output)), parent.on_task_completed()))
+
+    def _fail(self, e):
+        if self.runtime_status in _TERMINAL_STATUSES:
+            return
+        logging.getLogger("local_dapr").error(f"workflow {self.instance_id} failed: {e}")
+        self.failure = e
+        self._set_terminal_status("Failed")
+        if self._parent is not None:
+            parent, parent_task = self._parent
+            details = helpers.new_failure_details(e)
+            parent.post(lambda: (parent_task.fail(str(e), details), parent.on_task_completed()))
+
+    def terminate(self, output):
+        if self.runtime_status in _TERMINAL_STATUSES:
+            return
+        self.output = shared.to_json(output)
+        self._set_terminal_status("Terminated")
+        if self._parent is not None:
+            # the parent sees a terminated child workflow as failed
+            parent, parent_task = self._parent
+            e = Exception(f"workflow instance {self.instance_id} was terminated")
+            details = helpers.new_failure_details(e)
+            parent.post(lambda: (parent_task.fail(str(e), details), parent.on_task_completed()))
+
+    def _set_terminal_status(self, status):
+        self.runtime_status = status
+        self.last_updated_at = _utc_now()
+        self._generator = None
+        self._current_task = None
+        self._event_waiters = {}
+
+
+class _LocalWorkflowContext:
+    """Implements the parts of DaprWorkflowContext that the workflows use"""
+
+    def __init__(self, instance):
+        self._instance = instance
+        self.current_utc_datetime = _utc_now()
+        self.is_replaying = False  # workflows are run once rather than replayed from history
+        self.continue_as_new_input = None
+        self.save_events = False
+
+    @property
+    def instance_id(self):
+        return self._instance.instance_id
+
+    def call_activity(self, activity, *, input=None, retry_policy=None):
+        activity_task = task.CompletableTask()
+        name = activity if isinstance(activity, str) else activity.__name__
+        _ActivityRun(self._instance, name, input, retry_policy, activity_task).schedule()
+        return activity_task
+
+    def call_child_workflow(self, workflow, *, input=None, instance_id=None, retry_policy=None):
+        child_task = task.CompletableTask()
+        name = workflow if isinstance(workflow, str) else workflow.__name__
+        instance_id = instance_id or f"{self.instance_id}:{self._instance.next_task_id():04x}"
+        self._instance.runtime.schedule_new_workflow(name, input, instance_id, parent=(self._instance, child_task))
+        return child_task
+
+    def create_timer(self, fire_at):
+        timer_task = task.CompletableTask()
+        delay = fire_at if isinstance(fire_at, timedelta) else fire_at - _utc_now()
+        instance = self._instance
+
+        def fire():
+            instance.post(lambda: (timer_task.complete(None), instance.on_task_completed()))
+
+        timer = threading.Timer(max(delay.total_seconds(), 0), fire)
+        timer.daemon = True
+        timer.start()
+        return timer_task
+
+    def wait_for_external_event(self, name):
+        event_task = task.CompletableTask()
+        self._instance.wait_for_event(name.lower(), event_task)
+        return event_task
+
+    def continue_as_new(self, new_input, *, save_events=False):
+        self.continue_as_new_input = new_input
+        self.save_events = save_events
+
+    def set_custom_status(self, custom_status):
+        self._instance.custom_status = custom_status
+
+
+class _ActivityContext:
+    def __init__(self, workflow_id, task_id):
+        self.workflow_id = workflow_id
+        self.task_id = task_id
+
+
+class _ActivityRun:
+    # Runs an activity on the runtime's thread pool, applying the retry policy (if any) on failure
+    def __init__(self, instance, name, input, retry_policy, activity_task):
+        self._instance = instance
+        self._name = name
+        self._input = shared.to_json(input)
+        self._retry_policy = retry_policy
+        self._task = activity_task
+        self._task_id = instance.next_task_id()
+        self._attempt = 1
+        self._started_at = time.monotonic()
+
+    def schedule(self):
+        self._instance.runtime._executor.submit(self._run)
+
+    def _run(self):
+        instance = self._instance
+        try:
+            activity = instance.runtime._activities[self._name]
+            context = _ActivityContext(instance.instance_id, self._task_id)
+            output = shared.to_json(activity(context, shared.from_json(self._input)))
+        except Exception as e:
+            retry_delay = self._get_retry_delay()
+            if retry_delay is not None:
+                self._attempt += 1
+                timer = threading.Timer(retry_delay.total_seconds(), self.schedule)
+                timer.daemon = True
+                timer.start()
+                return
+            # e is cleared at the end of the except block so the message is captured for the (deferred) post
+            message, details = str(e), helpers.new_failure_details(e)
+            instance.post(lambda: (self._task.fail(message, details), instance.on_task_completed()))
+            return
+        instance.post(lambda: (self._task.complete(shared.from_json(output)), instance.on_task_completed()))
+
+    def _get_retry_delay(self):
+        policy = self._retry_policy
+        if policy is None or self._attempt >= policy.max_number_of_attempts:
+            return None
+        elapsed_seconds = time.monotonic() - self._started_at
+        if policy.retry_timeout is not None and elapsed_seconds >= policy.retry_timeout.total_seconds():
+            return None
+        delay = policy.first_retry_interval * (policy.backoff_coefficient ** (self._attempt - 1))
+        if policy.max_retry_interval is not None:
+            delay = min(delay, policy.max_retry_interval)
+        return delay
+
+
+class LocalStartWorkflowResponse:
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+
+
+class LocalGetWorkflowResponse:
+    # has the same attributes as the response from DaprClient.get_workflow
+    def __init__(self, instance):
+        self.instance_id = instance.instance_id
+        self.workflow_name = instance.workflow_name
+        self.created_at = instance.created_at
+        self.last_updated_at = instance.last_updated_at
+        self.runtime_status = instance.runtime_status
+        self.properties = {"dapr.workflow.input": instance.input}
+        if instance.output is not None:
+            self.properties["dapr.workflow.output"] = instance.output
+        if instance.custom_status is not None:
+            self.properties["dapr.workflow.custom_status"] = shared.to_json(instance.custom_status)
+        if instance.failure is not None:
+            self.properties["dapr.workflow.failure.error_type"] = type(instance.failure).__name__
+            self.properties["dapr.workflow.failure.error_message"] = str(instance.failure)
+
+
+class LocalDaprClient:
+    """Implements the DaprClient methods used by the app against the local stand-in (see above)"""
+
+    def __init__(self):
+        self._base_url = f"http://localhost:{os.getenv('DAPR_HTTP_PORT', '3500')}/v1.0"
+        self._session = requests.Session()
+
+    def wait(self, timeout_s):
+        deadline = time.monotonic() + timeout_s
+        while True:
+            try:
+                if self._session.get(f"{self._base_url}/healthz").ok:
+                    return
+            except requests.ConnectionError:
+                pass
+            if time.monotonic() >= deadline:
+                raise Exception(f"local sidecar not available at {self._base_url}")
+            time.sleep(0.1)
+
+    def get_state(self, store_name, key, state_metadata=None):
+        resp = self._session.get(f"{self._base_url}/state/{store_name}/{key}")
+        resp.raise_for_status()
+        data = _decode_value(resp.json()) if resp.status_code == 200 else b""
+        return StateResponse(data=data, etag=resp.headers.get("ETag", ""))
+
+    def save_state(self, store_name, key, value, etag=None, options=None, state_metadata=None):
+        item = {"key": key, "value": _encode_value(value), "metadata": state_metadata or {}}
+        resp = self._session.post(f"{self._base_url}/state/{store_name}", json=[item])
+        resp.raise_for_status()
+
+    def save_bulk_state(self, store_name, states, metadata=None):
+        items = [
+            {"key": state.key, "value": _encode_value(state.value), "metadata": state.metadata or {}}
+            for state in states
+        ]
+        resp = self._session.post(f"{self._base_url}/state/{store_name}", json=items)
+        resp.raise_for_status()
+
+    def delete_state(self, store_name, key, etag=None, options=None, state_metadata=None):
+        resp = self._session.delete(f"{self._base_url}/state/{store_name}/{key}")
+        resp.raise_for_status()
+
+    def get_bulk_state(self, store_name, keys, parallelism=1, states_metadata=None):
+        resp = self._session.post(f"{self._base_url}/state/{store_name}/bulk", json={"keys": keys})
+        resp.raise_for_status()
+        return BulkStatesResponse(
+            items=[
+                BulkStateItem(key=item["key"], data=_decode_value(item.get("data")), etag=item.get("etag", ""))
+                for item in resp.json()
+            ]
+        )
+
+    def publish_event(self, pubsub_name, topic_name, data, publish_metadata=None, data_content_type=None):
+        resp = self._session.post(
+            f"{self._base_url}/publish/{pubsub_name}/{topic_name}",
+            data=data,
+            headers={"Content-Type": data_content_type or "application/json"},
+        )
+        resp.raise_for_status()
+
+    def start_workflow(self, workflow_component, workflow_name, input=None, instance_id=None, **kwargs):
+        instance_id = _get_local_runtime().schedule_new_workflow(workflow_name, input, instance_id)
+        return LocalStartWorkflowResponse(instance_id)
+
+    def get_workflow(self, instance_id, workflow_component):
+        return LocalGetWorkflowResponse(_get_local_runtime().get_instance(instance_id))
+
+    def purge_workflow(self, instance_id, workflow_component):
+        _get_local_runtime().purge_instance(instance_id)
+
+    def terminate_workflow(self, instance_id, workflow_component, **kwargs):
+        _get_local_runtime().terminate_instance(instance_id, kwargs.get("output"))
+
+    def raise_workflow_event(self, instance_id, workflow_component, event_name, event_data=None, **kwargs):
+        _get_local_runtime().raise_event(instance_id, event_name, event_data)
+
+    def close(self):
+        self._session.close()
+
+
+def _get_local_runtime():
+    if _local_runtime is None:
+        raise Exception("local workflow runtime not started")
+    return _local_runtime
+
+
+# values are base64-encoded for the stand-in's (JSON) state API so that binary values (e.g. msgpack) round-trip
+
+
+def _encode_value(value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return base64.b64encode(value).decode("ascii")
+
+
+def _decode_value(value):
+    return base64.b64decode(value) if value else b""
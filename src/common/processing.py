@@ -0,0 +1,1015 @@
+from collections import deque
+from dataclasses import dataclass, asdict, replace
+from functools import partial
+from itertools import count
+import json
+import logging
+import os
+from dapr.ext.workflow import (
+    DaprWorkflowContext,
+    WorkflowActivityContext,
+)
+import dapr.ext.workflow as wf
+from dapr.clients.grpc._state import StateItem
+
+import codec
+from clients import get_dapr_client
+from retention import CHECKPOINT_TTL_SECONDS, RESULT_TTL_SECONDS, get_ttl_metadata
+
+# The job model and the orchestration shared by the workflow services: running the steps of a job as a dependency
+# graph (run_steps), resuming, chunking and sharding steps, continuing as new and the checkpoint/state activities.
+# The services provide the step classes that process the actions (e.g. by invoking the processor or publishing
+# messages) and their own processing_workflow and processing_shard_workflow.
+
+# steps with more than SHARD_SIZE actions are processed by child workflows that each handle a shard of the actions
+# (0 disables sharding)
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", "500"))
+# jobs with sequential steps process at most MAX_STEPS_PER_INSTANCE steps in a workflow instance
+# before continuing as new with the results so far (0 disables this)
+MAX_STEPS_PER_INSTANCE = int(os.getenv("MAX_STEPS_PER_INSTANCE", "20"))
+# for jobs with chunking enabled, the default maximum chunk size (in characters) and the chunk sizes
+# for specific action types (JSON, e.g. {"processor1": 2000}) - see ChunkingOptions
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "10000"))
+CHUNK_SIZES = json.loads(os.getenv("CHUNK_SIZES") or "{}")
+# how long the records of cancelled actions are kept for the actions to be checked against (see cancel_actions)
+CANCELLED_ACTION_TTL_SECONDS = int(os.getenv("CANCELLED_ACTION_TTL_SECONDS", "86400"))
+
+
+@dataclass
+class ProcessingAction:
+    action: str
+    content: str | None = None
+    # optional id that later actions can use to refer to this action
+    id: str | None = None
+    # optional id of an earlier action whose result is used as the content for this action
+    content_from: str | None = None
+
+
+@dataclass
+class ProcessingStep:
+    name: str
+    actions: list[ProcessingAction]
+    depends_on: list[str] | None = None
+    # when fail_fast is set, the first failed action causes the remaining actions in the step to be cancelled
+    # (if not set on the step, the value from the payload is used)
+    fail_fast: bool | None = None
+    # the tenant for the job (set from the payload when the step is processed)
+    tenant: str | None = None
+
+    @staticmethod
+    def from_input(data):
+        name = data["name"]
+        actions = []
+        for action in data["actions"]:
+            actions.append(ProcessingAction(**action))
+        depends_on = data.get("depends_on")
+        fail_fast = data.get("fail_fast")
+        tenant = data.get("tenant")
+
+        return ProcessingStep(name, actions, depends_on, fail_fast, tenant)
+
+
+@dataclass
+class ChunkingOptions:
+    # content that is larger than the chunk size for the action is split into chunks that are processed
+    # as parallel actions, and the results for the chunks are reassembled in order (see _ChunkedStep).
+    # The chunk size for an action is taken from action_sizes, then CHUNK_SIZES, then size, then CHUNK_SIZE
+    size: int | None = None
+    action_sizes: dict[str, int] | None = None
+    # when set, chunks end after the last delimiter within the chunk size (e.g. "\n" to split between lines)
+    delimiter: str | None = None
+
+    @staticmethod
+    def from_input(data):
+        options = ChunkingOptions(data.get("size"), data.get("action_sizes"), data.get("delimiter"))
+        for size in [options.size, *(options.action_sizes or {}).values()]:
+            if size is not None and (not isinstance(size, int) or size <= 0):
+                raise ValueError(f"Invalid chunk size: {size}")
+        return options
+
+    def get_chunk_size(self, action):
+        return (self.action_sizes or {}).get(action) or CHUNK_SIZES.get(action) or self.size or CHUNK_SIZE
+
+    def should_split(self, action: ProcessingAction):
+        return action.content is not None and len(action.content) > self.get_chunk_size(action.action)
+
+    def split(self, action: ProcessingAction):
+        return split_content(action.content, self.get_chunk_size(action.action), self.delimiter)
+
+
+def split_content(content, chunk_size, delimiter=None):
+    """Splits content into chunks of at most chunk_size characters.
+
+    Concatenating the chunks gives the original content. If delimiter is set then each chunk ends after
+    the last delimiter within the chunk size (chunks without a delimiter are split at chunk_size)
+    """
+    chunks = []
+    start = 0
+    while len(content) - start > chunk_size:
+        end = start + chunk_size
+        if delimiter:
+            delimiter_index = content.rfind(delimiter, start, end)
+            if delimiter_index >= 0:
+                end = delimiter_index + len(delimiter)
+        chunks.append(content[start:end])
+        start = end
+    chunks.append(content[start:])
+    return chunks
+
+
+@dataclass
+class ProcessingPayload:
+    steps: list[ProcessingStep]
+    # when pipelined is set, actions are started as soon as their inputs are available
+    # rather than waiting for all of the actions in the previous step(s) to complete
+    pipelined: bool = False
+    # when fail_fast is set, the first failed action causes all other running actions to be cancelled
+    fail_fast: bool = False
+    # id of a previous workflow instance for this job whose checkpointed results should be reused
+    resume_from: str | None = None
+    # the tenant that the job is submitted for, used to share the processor capacity fairly between tenants
+    tenant: str | None = None
+    # when set, large content is split into chunks that are processed in parallel (see ChunkingOptions)
+    chunking: ChunkingOptions | None = None
+
+    @staticmethod
+    def from_input(data):
+        steps = []
+        for step in data["steps"]:
+            steps.append(ProcessingStep.from_input(step))
+        payload = ProcessingPayload(
+            steps,
+            data.get("pipelined", False),
+            data.get("fail_fast", False),
+            data.get("resume_from"),
+            data.get("tenant"),
+            ChunkingOptions.from_input(data["chunking"]) if data.get("chunking") else None,
+        )
+        payload.get_action_ids()  # validate the dependency graph and action references
+        return payload
+
+    def get_dependencies(self):
+        """Returns a list containing the indices of the steps that each step depends on.
+
+        If no step specifies depends_on then each step depends on the previous step
+        (i.e. steps are run in sequence)
+        """
+        if self.is_sequential():
+            return [[step_index - 1] if step_index > 0 else [] for step_index in range(len(self.steps))]
+
+        step_indices = {}
+        for step_index, step in enumerate(self.steps):
+            if step.name in step_indices:
+                raise ValueError(f"Duplicate step name: {step.name}")
+            step_indices[step.name] = step_index
+
+        dependencies = []
+        for step in self.steps:
+            step_dependencies = []
+            for name in step.depends_on or []:
+                if name not in step_indices:
+                    raise ValueError(f"Step {step.name} depends on unknown step: {name}")
+                step_dependencies.append(step_indices[name])
+            dependencies.append(step_dependencies)
+
+        # Check that the steps can be ordered (i.e. that there are no cycles)
+        completed = set()
+        while len(completed) < len(self.steps):
+            ready = _get_ready_steps(dependencies, started=completed, completed=completed)
+            if len(ready) == 0:
+                raise ValueError("Step dependencies contain a cycle")
+            completed.update(ready)
+
+        return dependencies
+
+    def is_sequential(self):
+        return all(step.depends_on is None for step in self.steps)
+
+    def get_action_ids(self):
+        """Returns a dict mapping action ids to the (step index, action index) of the action.
+
+        Actions using content_from must refer to an action in a step that they (directly or indirectly) depend on
+        """
+        dependencies = self.get_dependencies()
+        action_ids = {}
+        for step_index, step in enumerate(self.steps):
+            for action_index, action in enumerate(step.actions):
+                if action.id is None:
+                    continue
+                if action.id in action_ids:
+                    raise ValueError(f"Duplicate action id: {action.id}")
+                action_ids[action.id] = (step_index, action_index)
+
+        for step_index, step in enumerate(self.steps):
+            # find all the steps that this step depends on (directly or indirectly)
+            ancestors = set()
+            to_visit = list(dependencies[step_index])
+            while to_visit:
+                ancestor = to_visit.pop()
+                if ancestor not in ancestors:
+                    ancestors.add(ancestor)
+                    to_visit.extend(dependencies[ancestor])
+
+            for action in step.actions:
+                if action.content_from is None:
+                    if action.content is None:
+                        raise ValueError(f"Action in step {step.name} has no content or content_from")
+                    continue
+                if action.content_from not in action_ids:
+                    raise ValueError(f"Action in step {step.name} has content_from unknown action: {action.content_from}")
+                if action_ids[action.content_from][0] not in ancestors:
+                    raise ValueError(
+                        f"Action in step {step.name} has content_from action {action.content_from} in a step that it doesn't depend on"
+                    )
+
+        return action_ids
+
+    def get_action_dependencies(self):
+        """Returns a dict mapping each (step index, action index) to the list of (step index, action index) that it depends on.
+
+        Actions using content_from depend only on that action,
+        other actions depend on all of the actions in the steps that their step depends on
+        """
+        dependencies = self.get_dependencies()
+        action_ids = self.get_action_ids()
+
+        # Get the actions that must complete for a step to be complete
+        # (a step with no actions is complete when the steps it depends on are complete)
+        completion_actions = {}
+
+        def get_completion_actions(step_index):
+            if step_index not in completion_actions:
+                if len(self.steps[step_index].actions) > 0:
+                    completion_actions[step_index] = [
+                        (step_index, action_index)
+                        for action_index in range(len(self.steps[step_index].actions))
+                    ]
+                else:
+                    completion_actions[step_index] = [
+                        completion_action
+                        for dependency in dependencies[step_index]
+                        for completion_action in get_completion_actions(dependency)
+                    ]
+            return completion_actions[step_index]
+
+        action_dependencies = {}
+        for step_index, step in enumerate(self.steps):
+            step_actions = [
+                completion_action
+                for dependency in dependencies[step_index]
+                for completion_action in get_completion_actions(dependency)
+            ]
+            for action_index, action in enumerate(step.actions):
+                if action.content_from is None:
+                    action_dependencies[(step_index, action_index)] = step_actions
+                else:
+                    action_dependencies[(step_index, action_index)] = [action_ids[action.content_from]]
+        return action_dependencies
+
+
+@dataclass
+class ProcessingActionResult:
+    action: str
+    content: str
+    result: str
+    attempt_count: int
+
+
+@dataclass
+class ProcessingStepResult:
+    name: str
+    actions: list[ProcessingActionResult]
+
+
+@dataclass
+class ProcessingResult:
+    id: str
+    status: str
+    steps: list[ProcessingStepResult]
+
+
+def has_errors(tasks):
+    for task in tasks:
+        if is_error(task):
+            return True
+    return False
+
+
+def cancelled_result():
+    # result recorded for actions that were abandoned because another action failed (see fail_fast)
+    return {"error": "cancelled as another action failed", "cancelled": True}
+
+
+def is_error(task):
+    if task.is_failed:
+        return True
+    return is_error_result(task.get_result())
+
+
+def is_error_result(result):
+    if result is None:
+        return True
+    if "error" in result:
+        return True
+    return False
+
+
+def _get_ready_steps(dependencies, started, completed):
+    # Returns the indices of the steps that haven't been started and have all of their dependencies completed
+    return [
+        step_index
+        for step_index, step_dependencies in enumerate(dependencies)
+        if step_index not in started
+        and all(dependency in completed for dependency in step_dependencies)
+    ]
+
+
+def _run_graph(context: DaprWorkflowContext, dependencies, start_node, fail_fast, on_progress):
+    # Runs the nodes of a dependency graph, starting each node as soon as the nodes it depends on have completed
+    # (independent nodes run concurrently).
+    # dependencies is a list containing the indices of the nodes that each node depends on.
+    # start_node is called with the node index and the dict of started nodes to start processing a node and
+    # returns an object with step, task, is_done, success, on_task_completed and cancel members.
+    # If a node fails then no further nodes are started (any nodes already running are allowed to finish).
+    # If fail_fast is set then any running nodes are cancelled instead, and if the failed node's step is fail_fast
+    # then running nodes for the same step are cancelled.
+    # on_progress is called with the dict of started nodes and the indices of the nodes that have been started
+    # or had tasks complete, each time nodes are started or tasks complete.
+    # The ready and running nodes are tracked incrementally (rather than checking every node each time a task
+    # completes) so that the work for each completion doesn't grow with the size of the graph.
+    # Returns a dict of node index -> started node
+    logger = logging.getLogger("processing_workflow")
+    dependents = [[] for _ in dependencies]
+    waiting_counts = []
+    for node_index, node_dependencies in enumerate(dependencies):
+        waiting_counts.append(len(node_dependencies))
+        for dependency in node_dependencies:
+            dependents[dependency].append(node_index)
+    ready_nodes = deque(node_index for node_index, count in enumerate(waiting_counts) if count == 0)
+    started_nodes = {}
+    running_nodes = {}  # node index -> started node for the nodes that are still running
+    changed_nodes = []
+    have_errors = False
+
+    def on_node_done(node_index):
+        # returns whether the node failed
+        started_node = started_nodes[node_index]
+        if not started_node.success:
+            logger.info(
+                f"processing step completed with errors - skipping any remaining work: {started_node.step.name}"
+            )
+            return True
+        for dependent in dependents[node_index]:
+            waiting_counts[dependent] -= 1
+            if waiting_counts[dependent] == 0:
+                ready_nodes.append(dependent)
+        return False
+
+    while True:
+        # nodes can complete as soon as they are started (e.g. when resuming)
+        # so keep going until there are no more nodes ready to start
+        while not have_errors and len(ready_nodes) > 0:
+            node_index = ready_nodes.popleft()
+            started_nodes[node_index] = start_node(node_index, started_nodes)
+            changed_nodes.append(node_index)
+            if started_nodes[node_index].is_done:
+                have_errors = on_node_done(node_index) or have_errors
+            else:
+                running_nodes[node_index] = started_nodes[node_index]
+
+        on_progress(started_nodes, changed_nodes)
+        changed_nodes = []
+
+        if len(running_nodes) == 0:
+            break
+
+        yield wf.when_any([running_node.task for running_node in running_nodes.values()])
+
+        fail_fast_steps = set()
+        for node_index, running_node in list(running_nodes.items()):
+            if not running_node.task.is_complete:
+                continue
+            running_node.on_task_completed()
+            changed_nodes.append(node_index)
+            if running_node.is_done:
+                del running_nodes[node_index]
+                if on_node_done(node_index):
+                    have_errors = True
+                    if running_node.step.fail_fast:
+                        fail_fast_steps.add(running_node.step.name)
+
+        for node_index, running_node in list(running_nodes.items()):
+            if (have_errors and fail_fast) or running_node.step.name in fail_fast_steps:
+                logger.info(f"cancelling actions after failure (fail_fast): {running_node.step.name}")
+                running_node.cancel()
+                changed_nodes.append(node_index)
+                del running_nodes[node_index]
+
+    return started_nodes
+
+
+def run_steps(context: DaprWorkflowContext, payload: ProcessingPayload, start_step, shard_workflow, completed_steps=0):
+    # Runs the steps in the payload, starting each step as soon as the steps it depends on have completed.
+    # If the payload is pipelined then each action is started as soon as the actions it depends on have completed.
+    # start_step is called with a step (with content_from resolved for its actions) to start processing it.
+    # Steps with more than SHARD_SIZE actions are processed using shard_workflow child workflows (see _ShardedStep).
+    # If the payload has chunking options then actions with large content are split into chunks (see _ChunkedStep).
+    # Results for completed actions are checkpointed as they complete, and if the payload has resume_from then
+    # the checkpointed results from that workflow instance are reused rather than processing the actions again.
+    # completed_steps is the number of steps that were processed by earlier runs of this workflow instance
+    # (see MAX_STEPS_PER_INSTANCE) - their results are in the instance's checkpoints.
+    # Returns a dict of (step index, action index) -> (started step, index of the action in the started step)
+    # for the actions processed in this run, a flag indicating whether all actions completed successfully and
+    # the index of the first step to be processed by continuing the workflow as new (or None)
+    action_ids = payload.get_action_ids()
+    next_step = None
+    if payload.pipelined:
+        # each node in the graph is a single action
+        action_dependencies = payload.get_action_dependencies()
+        nodes = [(step_index, [action_index]) for step_index, action_index in action_dependencies]
+    else:
+        # each node in the graph is a step
+        last_step = len(payload.steps)
+        if payload.is_sequential() and MAX_STEPS_PER_INSTANCE > 0 and completed_steps + MAX_STEPS_PER_INSTANCE < last_step:
+            # limit the number of steps processed in this workflow instance to keep the history bounded
+            last_step = next_step = completed_steps + MAX_STEPS_PER_INSTANCE
+        nodes = [
+            (step_index, list(range(len(payload.steps[step_index].actions))))
+            for step_index in range(completed_steps, last_step)
+        ]
+    # map (step index, action index) to (node index, index of the action in the node)
+    action_locations = {
+        (step_index, action_index): (node_index, index)
+        for node_index, (step_index, action_indices) in enumerate(nodes)
+        for index, action_index in enumerate(action_indices)
+    }
+    if payload.pipelined:
+        dependencies = [
+            [action_locations[dependency][0] for dependency in action_dependencies[(step_index, action_indices[0])]]
+            for step_index, action_indices in nodes
+        ]
+    else:
+        dependencies = [
+            [dependency - completed_steps for dependency in step_dependencies if dependency >= completed_steps]
+            for step_dependencies in payload.get_dependencies()[completed_steps:last_step]
+        ]
+
+    # load the results from earlier runs of this workflow instance that are used as content (see content_from)
+    earlier_action_keys = sorted(
+        {
+            action_ids[action.content_from]
+            for step_index, action_indices in nodes
+            for action in (payload.steps[step_index].actions[action_index] for action_index in action_indices)
+            if action.content_from is not None and action_ids[action.content_from] not in action_locations
+        }
+    )
+    earlier_results = {}
+    if len(earlier_action_keys) > 0:
+        checkpoint = yield context.call_activity(
+            load_checkpoint,
+            input={
+                "instance_id": context.instance_id,
+                "action_keys": [_get_action_key(*action_key) for action_key in earlier_action_keys],
+            },
+        )
+        for action_key in earlier_action_keys:
+            if _get_action_key(*action_key) not in checkpoint:
+                raise Exception(f"checkpointed result not found for action {_get_action_key(*action_key)}")
+            earlier_results[action_key] = ProcessingActionResult(**checkpoint[_get_action_key(*action_key)])
+
+    previous_results = {}
+    if payload.resume_from is not None:
+        checkpoint = yield context.call_activity(
+            load_checkpoint,
+            input={
+                "instance_id": payload.resume_from,
+                "action_keys": [_get_action_key(*action_key) for action_key in action_locations],
+            },
+        )
+        previous_results = {
+            action_key: ProcessingActionResult(**checkpoint[_get_action_key(*action_key)])
+            for action_key in action_locations
+            if _get_action_key(*action_key) in checkpoint
+        }
+
+    # activities to terminate the child workflows for cancelled shards (see _ShardedStep)
+    terminate_tasks = []
+
+    def start_shardable_step(context: DaprWorkflowContext, step: ProcessingStep, node_key):
+        if SHARD_SIZE > 0 and len(step.actions) > SHARD_SIZE:
+            return _ShardedStep(context, step, shard_workflow, f"{context.instance_id}:{node_key}", terminate_tasks)
+        return start_step(context, step)
+
+    def start_chunkable_step(context: DaprWorkflowContext, step: ProcessingStep, node_key):
+        start_next_step = partial(start_shardable_step, node_key=node_key)
+        if payload.chunking is not None and any(payload.chunking.should_split(action) for action in step.actions):
+            return _ChunkedStep(context, step, payload.chunking, start_next_step)
+        return start_next_step(context, step)
+
+    def start_node(node_index, started_nodes):
+        step_index, action_indices = nodes[node_index]
+        step = payload.steps[step_index]
+        resolved_actions = []
+        for action_index in action_indices:
+            action = step.actions[action_index]
+            if action.content_from is not None:
+                # content_from refers to an action that this node depends on so it has completed
+                source_action_key = action_ids[action.content_from]
+                if source_action_key in earlier_results:
+                    source_result = earlier_results[source_action_key]
+                else:
+                    source_node_index, source_index = action_locations[source_action_key]
+                    source_result = started_nodes[source_node_index].get_action_result(source_index)
+                action = replace(action, content=source_result.result.get("result"))
+            resolved_actions.append(action)
+        fail_fast = step.fail_fast if step.fail_fast is not None else payload.fail_fast
+        node_step = ProcessingStep(step.name, resolved_actions, fail_fast=fail_fast, tenant=payload.tenant)
+
+        # previous results are only reused if they are for the same action and content
+        # (the job may have been changed when resuming it)
+        node_previous_results = {}
+        for index, action_index in enumerate(action_indices):
+            previous_result = previous_results.get((step_index, action_index))
+            if previous_result is None:
+                continue
+            action = resolved_actions[index]
+            if previous_result.action == action.action and previous_result.content == action.content:
+                node_previous_results[index] = previous_result
+            elif not context.is_replaying:
+                logging.getLogger("processing_workflow").info(
+                    f"checkpointed result doesn't match the action - processing it again: {_get_action_key(step_index, action_index)}"
+                )
+        # the node key is unique within the job so it is used for the ids of any child workflows
+        start_next_step = partial(start_chunkable_step, node_key=_get_action_key(step_index, action_indices[0]))
+        if len(node_previous_results) > 0:
+            return _ResumedStep(context, node_step, node_previous_results, start_next_step)
+        return start_next_step(context, node_step)
+
+    checkpointed_actions = set()
+    pending_checkpoint = {}
+    checkpoint_tasks = []
+
+    def save_checkpoint_batch():
+        # not waiting for the checkpoint here so that it doesn't hold up processing
+        checkpoint_tasks.append(context.call_activity(save_checkpoint, input=dict(pending_checkpoint)))
+        pending_checkpoint.clear()
+
+    def save_progress(started_nodes, node_indices):
+        # checkpoint the results for any actions that have completed since the last checkpoint.
+        # Only one checkpoint is saved at a time and results for actions that complete in the meantime
+        # are batched into the next one, so there are far fewer save_checkpoint activities than actions
+        for node_index in node_indices:
+            started_node = started_nodes[node_index]
+            step_index, action_indices = nodes[node_index]
+            for index in started_node.get_completed_actions():
+                action_key = (step_index, action_indices[index])
+                if action_key not in checkpointed_actions:
+                    checkpointed_actions.add(action_key)
+                    pending_checkpoint[_get_action_key(*action_key)] = asdict(started_node.get_action_result(index))
+        if len(pending_checkpoint) > 0 and (len(checkpoint_tasks) == 0 or checkpoint_tasks[-1].is_complete):
+            save_checkpoint_batch()
+
+    started_nodes = yield from _run_graph(
+        context, dependencies, start_node, payload.fail_fast, save_progress
+    )
+    if len(pending_checkpoint) > 0:
+        save_checkpoint_batch()
+    if len(checkpoint_tasks) + len(terminate_tasks) > 0:
+        yield wf.when_all(checkpoint_tasks + terminate_tasks)
+
+    action_runs = {}
+    for node_index, started_node in started_nodes.items():
+        step_index, action_indices = nodes[node_index]
+        for index, action_index in enumerate(action_indices):
+            action_runs[(step_index, action_index)] = (started_node, index)
+
+    success = len(started_nodes) == len(nodes) and all(
+        started_node.success for started_node in started_nodes.values()
+    )
+    if not success:
+        return action_runs, success, None
+    if next_step is not None and any(is_error(task) for task in checkpoint_tasks):
+        # the next run of the workflow instance relies on the checkpoints for the results so far
+        raise Exception("failed to checkpoint results before continuing as new")
+    return action_runs, success, next_step
+
+
+def get_continue_as_new_input(input, next_step):
+    # Returns the input for continuing the workflow as new from next_step
+    # (the results so far are in the checkpoints rather than the input so that its size stays bounded)
+    return dict(input, completed_steps=next_step)
+
+
+def get_save_state_input(results: ProcessingResult, completed_steps):
+    # the results for the steps processed by earlier runs of the workflow instance
+    # are loaded from the checkpoints when saving the results (see save_state)
+    save_state_input = asdict(results)
+    if completed_steps > 0:
+        save_state_input["checkpointed_steps"] = completed_steps
+    return save_state_input
+
+
+def _get_action_key(step_index, action_index):
+    return f"{step_index}-{action_index}"
+
+
+class _ResumedStep:
+    # Wraps a step that has results from a previous workflow instance for some of its actions (see resume_from)
+    # so that only the outstanding actions are processed
+    def __init__(self, context: DaprWorkflowContext, step: ProcessingStep, previous_results, start_step):
+        self.step = step
+        self.previous_results = previous_results
+        self.outstanding_actions = [
+            action_index
+            for action_index in range(len(step.actions))
+            if action_index not in previous_results
+        ]
+        self._outstanding_step = None
+        if len(self.outstanding_actions) > 0:
+            self._outstanding_step = start_step(
+                context,
+                replace(step, actions=[step.actions[action_index] for action_index in self.outstanding_actions]),
+            )
+
+    @property
+    def task(self):
+        return self._outstanding_step.task
+
+    @property
+    def is_done(self):
+        return self._outstanding_step is None or self._outstanding_step.is_done
+
+    @property
+    def success(self):
+        return self._outstanding_step is None or self._outstanding_step.success
+
+    def on_task_completed(self):
+        self._outstanding_step.on_task_completed()
+
+    def cancel(self):
+        self._outstanding_step.cancel()
+
+    def get_action_result(self, action_index):
+        if action_index in self.previous_results:
+            return self.previous_results[action_index]
+        return self._outstanding_step.get_action_result(self.outstanding_actions.index(action_index))
+
+    def get_completed_actions(self):
+        completed_actions = list(self.previous_results.keys())
+        if self._outstanding_step is not None:
+            completed_actions.extend(
+                self.outstanding_actions[index]
+                for index in self._outstanding_step.get_completed_actions()
+            )
+        return completed_actions
+
+
+class _ChunkedStep:
+    # Wraps a step with actions whose content is larger than the chunk size (see ChunkingOptions)
+    # so that the content is split into chunks that are processed as parallel actions (map),
+    # and the results for the chunks are reassembled in order into a single result for each action (reduce)
+    def __init__(self, context: DaprWorkflowContext, step: ProcessingStep, chunking: ChunkingOptions, start_step):
+        self.step = step
+        # the indices of the chunks for each action in the chunked step
+        self.action_chunks = []
+        chunk_actions = []
+        for action in step.actions:
+            chunks = chunking.split(action) if chunking.should_split(action) else [action.content]
+            self.action_chunks.append(range(len(chunk_actions), len(chunk_actions) + len(chunks)))
+            chunk_actions.extend(replace(action, content=chunk) for chunk in chunks)
+        self._chunked_step = start_step(context, replace(step, actions=chunk_actions))
+
+    @property
+    def task(self):
+        return self._chunked_step.task
+
+    @property
+    def is_done(self):
+        return self._chunked_step.is_done
+
+    @property
+    def success(self):
+        return self._chunked_step.success
+
+    def on_task_completed(self):
+        self._chunked_step.on_task_completed()
+
+    def cancel(self):
+        self._chunked_step.cancel()
+
+    def get_action_result(self, action_index):
+        chunk_results = [
+            self._chunked_step.get_action_result(chunk_index) for chunk_index in self.action_chunks[action_index]
+        ]
+        return _combine_chunk_results(self.step.actions[action_index], chunk_results)
+
+    def get_completed_actions(self):
+        # an action has completed successfully when all of its chunks have
+        completed_chunks = set(self._chunked_step.get_completed_actions())
+        return [
+            action_index
+            for action_index, chunk_indices in enumerate(self.action_chunks)
+            if all(chunk_index in completed_chunks for chunk_index in chunk_indices)
+        ]
+
+
+def _combine_chunk_results(action: ProcessingAction, chunk_results):
+    # Combines the results for the chunks of an action into a single result (the first error if any chunk failed)
+    attempt_count = max(chunk_result.attempt_count for chunk_result in chunk_results)
+    if len(chunk_results) == 1:
+        return replace(chunk_results[0], content=action.content)
+    for chunk_index, chunk_result in enumerate(chunk_results):
+        if is_error_result(chunk_result.result):
+            result = dict(chunk_result.result or {"error": "no result"}, chunk_index=chunk_index)
+            return ProcessingActionResult(action.action, action.content, result, attempt_count)
+    result = {
+        "success": True,
+        "result": "".join(chunk_result.result.get("result") or "" for chunk_result in chunk_results),
+        "chunk_count": len(chunk_results),
+    }
+    return ProcessingActionResult(action.action, action.content, result, attempt_count)
+
+
+class _ShardedStep:
+    # Processes the actions for a large step (more than SHARD_SIZE actions) using child workflows
+    # that each process a shard of the actions, so that the history for each workflow instance stays bounded
+    # and the shards can be spread across workflow workers.
+    # If the step is cancelled then the child workflows for any shards that are still running are terminated
+    # (by activities appended to terminate_tasks, which the caller waits for) and their results are discarded.
+    # shard_workflow is the service's workflow for processing a shard (with the step for the shard as its input)
+    # and the child workflow instance ids are <instance_id_prefix>:<shard index>
+    def __init__(
+        self, context: DaprWorkflowContext, step: ProcessingStep, shard_workflow, instance_id_prefix, terminate_tasks
+    ):
+        self.step = step
+        shard_starts = range(0, len(step.actions), SHARD_SIZE)
+        self.shard_instance_ids = [f"{instance_id_prefix}:{shard_index}" for shard_index in range(len(shard_starts))]
+        self.shard_tasks = [
+            context.call_child_workflow(
+                shard_workflow,
+                input=asdict(replace(step, actions=step.actions[shard_start : shard_start + SHARD_SIZE])),
+                instance_id=shard_instance_id,
+            )
+            for shard_start, shard_instance_id in zip(shard_starts, self.shard_instance_ids)
+        ]
+        self.cancelled_shards = set()
+        self.is_done = False
+        self.success = False
+        self._context = context
+        self._terminate_tasks = terminate_tasks
+        self._wait_for_shards()
+
+    def _wait_for_shards(self):
+        # wait for the next shard to complete (rather than all of them) so that a failed shard is handled straight away
+        self.task = wf.when_any([task for task in self.shard_tasks if not task.is_complete])
+
+    def on_task_completed(self):
+        completed_tasks = [task for task in self.shard_tasks if task.is_complete]
+        has_errors = any(_is_shard_error(task) for task in completed_tasks)
+        if self.step.fail_fast and has_errors:
+            self.cancel()
+        elif len(completed_tasks) == len(self.shard_tasks):
+            self.is_done = True
+            self.success = not has_errors
+        else:
+            self._wait_for_shards()
+
+    def cancel(self):
+        self.cancelled_shards = {
+            shard_index
+            for shard_index, task in enumerate(self.shard_tasks)
+            if not task.is_complete
+        }
+        if len(self.cancelled_shards) > 0:
+            self._terminate_tasks.append(
+                self._context.call_activity(
+                    terminate_workflows,
+                    input=[self.shard_instance_ids[shard_index] for shard_index in sorted(self.cancelled_shards)],
+                )
+            )
+        self.is_done = True
+        self.success = False
+
+    def get_completed_actions(self):
+        # returns the indices of the actions that have completed successfully
+        return [
+            shard_index * SHARD_SIZE + index
+            for shard_index, task in enumerate(self.shard_tasks)
+            if shard_index not in self.cancelled_shards and task.is_complete and not task.is_failed
+            for index, action_result in enumerate(task.get_result()["results"])
+            if not is_error_result(action_result["result"])
+        ]
+
+    def get_action_result(self, action_index):
+        shard_index, index = divmod(action_index, SHARD_SIZE)
+        task = self.shard_tasks[shard_index]
+        if shard_index in self.cancelled_shards or task.is_failed:
+            action = self.step.actions[action_index]
+            return ProcessingActionResult(
+                action=action.action,
+                content=action.content,
+                result=cancelled_result()
+                if shard_index in self.cancelled_shards
+                else {"error": f"shard failed: {task.get_exception()}"},
+                attempt_count=1,
+            )
+        return ProcessingActionResult(**task.get_result()["results"][index])
+
+
+def _is_shard_error(task):
+    return task.is_failed or not task.get_result()["success"]
+
+
+
+def gather_step_results(payload: ProcessingPayload, action_runs, not_started_attempt_count):
+    # Maps the results from run_steps back to the steps in the payload
+    return [
+        ProcessingStepResult(
+            step.name,
+            [
+                action_runs[(step_index, action_index)][0].get_action_result(
+                    action_runs[(step_index, action_index)][1]
+                )
+                if (step_index, action_index) in action_runs
+                else ProcessingActionResult(
+                    action=action.action,
+                    content=action.content,
+                    result=None,
+                    attempt_count=not_started_attempt_count,
+                )
+                for action_index, action in enumerate(step.actions)
+            ],
+        )
+        for step_index, step in enumerate(payload.steps)
+    ]
+
+
+class ActionCorrelation:
+    # Generates the correlation ids for the actions started by a workflow instance and records the actions
+    # that are cancelled, so that actions for fail_fast steps can be skipped once they are no longer needed
+    # (see cancel_actions and is_action_cancelled).
+    # The workflow waits for cancel_tasks before it completes
+    def __init__(self, context: DaprWorkflowContext, completed_steps=0):
+        self.cancel_tasks = []
+        self._context = context
+        self._completed_steps = completed_steps
+        self._sequence = count(1)
+
+    def new_correlation_id(self):
+        # generated in the workflow (rather than by the activity that starts the action)
+        # so that actions can be cancelled before they have been started.
+        # The sequence restarts when the instance continues as new, so the ids include
+        # the step cursor for the run to keep them unique across the runs of the instance
+        return f"{self._context.instance_id}-{self._completed_steps}-{next(self._sequence)}"
+
+    def cancel(self, correlation_ids):
+        if len(correlation_ids) > 0:
+            self.cancel_tasks.append(self._context.call_activity(cancel_actions, input=correlation_ids))
+
+
+def save_state(context: WorkflowActivityContext, input_dict):
+    # Saves the results for the workflow instance. If checkpointed_steps is set then the results for the
+    # first steps were processed by earlier runs of the instance and are loaded from its checkpoints
+    logger = logging.getLogger("save_state")
+
+    try:
+        input_dict = dict(input_dict)
+        checkpointed_steps = input_dict.pop("checkpointed_steps", 0)
+        if checkpointed_steps > 0:
+            input_dict["steps"] = _load_checkpointed_steps(context.workflow_id, input_dict["steps"], checkpointed_steps)
+        get_dapr_client().save_state(
+            "statestore",
+            context.workflow_id,
+            codec.dumps(input_dict),
+            state_metadata=get_ttl_metadata(RESULT_TTL_SECONDS),
+        )
+    except Exception as e:
+        logger.error(f"!!!save_state error: {e}")
+        raise e
+
+
+def save_checkpoint(context: WorkflowActivityContext, input_dict):
+    # Saves the results for completed actions (keyed by action key)
+    # so that they can be reused if the job is resumed
+    logger = logging.getLogger("save_checkpoint")
+
+    try:
+        get_dapr_client().save_bulk_state(
+            "statestore",
+            [
+                StateItem(
+                    key=_get_checkpoint_key(context.workflow_id, action_key),
+                    value=codec.dumps(result),
+                    metadata=get_ttl_metadata(CHECKPOINT_TTL_SECONDS),
+                )
+                for action_key, result in input_dict.items()
+            ],
+        )
+        return {"success": True}
+    except Exception as e:
+        logger.error(f"!!!save_checkpoint error: {e}")
+        # return an error rather than failing the workflow as the checkpoint is only needed to resume the job
+        return {"error": str(e)}
+
+
+def load_checkpoint(context: WorkflowActivityContext, input_dict):
+    # Loads the checkpointed results for a previous workflow instance
+    # Returns a dict of action key -> result for the actions that have a checkpointed result
+    logger = logging.getLogger("load_checkpoint")
+
+    try:
+        instance_id = input_dict["instance_id"]
+        action_keys = {
+            _get_checkpoint_key(instance_id, action_key): action_key
+            for action_key in input_dict["action_keys"]
+        }
+        resp = get_dapr_client().get_bulk_state("statestore", keys=list(action_keys.keys()))
+        return {
+            action_keys[item.key]: codec.loads(item.data)
+            for item in resp.items
+            if item.data
+        }
+    except Exception as e:
+        logger.error(f"!!!load_checkpoint error: {e}")
+        raise e
+
+
+def _get_checkpoint_key(instance_id, action_key):
+    return f"{instance_id}||checkpoint||{action_key}"
+
+
+def get_checkpoint_keys(instance_id, input):
+    """Returns the state keys that checkpointed results may be saved under for a workflow instance and its input"""
+    return [
+        _get_checkpoint_key(instance_id, _get_action_key(step_index, action_index))
+        for step_index, step in enumerate(input["steps"])
+        for action_index in range(len(step["actions"]))
+    ]
+
+
+def terminate_workflows(context: WorkflowActivityContext, instance_ids):
+    # Terminates workflow instances (the child workflows for the shards of a cancelled step)
+    logger = logging.getLogger("terminate_workflows")
+
+    for instance_id in instance_ids:
+        try:
+            get_dapr_client().terminate_workflow(instance_id=instance_id, workflow_component="dapr")
+        except Exception as e:
+            # not failing the workflow as the instance may have completed in the meantime
+            logger.error(f"!!!terminate_workflows error ({instance_id}): {e}")
+    return {"success": True}
+
+
+def cancel_actions(context: WorkflowActivityContext, correlation_ids):
+    # Records the correlation ids for cancelled actions so that
+    # their processing can be skipped (see is_action_cancelled)
+    logger = logging.getLogger("cancel_actions")
+
+    try:
+        get_dapr_client().save_bulk_state(
+            "statestore",
+            [
+                StateItem(
+                    key=_get_cancelled_key(correlation_id),
+                    value=codec.dumps({"cancelled": True}),
+                    metadata=get_ttl_metadata(CANCELLED_ACTION_TTL_SECONDS),
+                )
+                for correlation_id in correlation_ids
+            ],
+        )
+        return {"success": True}
+    except Exception as e:
+        logger.error(f"!!!cancel_actions error: {e}")
+        # return an error rather than failing the workflow, as the cancelled actions are
+        # still processed (their results are ignored)
+        return {"error": str(e)}
+
+
+def is_action_cancelled(correlation_id):
+    return bool(get_dapr_client().get_state("statestore", _get_cancelled_key(correlation_id)).data)
+
+
+def _get_cancelled_key(correlation_id):
+    return f"{correlation_id}||cancelled"
+
+
+def _load_checkpointed_steps(instance_id, steps, step_count):
+    # Returns the step results with the results for the first step_count steps loaded from the checkpoints.
+    # Raises an exception if any of the checkpoints are missing (e.g. they have expired or failed to save)
+    # rather than saving a result with missing action results
+    action_keys = {
+        _get_checkpoint_key(instance_id, _get_action_key(step_index, action_index)): (step_index, action_index)
+        for step_index in range(step_count)
+        for action_index in range(len(steps[step_index]["actions"]))
+    }
+    steps = [dict(step, actions=list(step["actions"])) for step in steps]
+    resp = get_dapr_client().get_bulk_state("statestore", keys=list(action_keys.keys()))
+    missing_keys = set(action_keys.keys())
+    for item in resp.items:
+        if item.data:
+            step_index, action_index = action_keys[item.key]
+            steps[step_index]["actions"][action_index] = codec.loads(item.data)
+            missing_keys.discard(item.key)
+    if len(missing_keys) > 0:
+        raise Exception(f"Checkpointed results not found for {len(missing_keys)} action(s): {sorted(missing_keys)}")
+    return steps
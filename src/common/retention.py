@@ -0,0 +1,255 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+import codec
+
+# Retention limits how long completed jobs take up space in the state stores: the workflow history in the
+# actor state store and the results and checkpoints in statestore (which are otherwise kept forever).
+#
+# RESULT_TTL_SECONDS and CHECKPOINT_TTL_SECONDS set a TTL (the ttlInSeconds state metadata) on the saved
+# results and checkpoints so that the state store expires them (0, the default, means they are kept forever).
+# Note that jobs can't be resumed once their checkpoints have expired.
+#
+# If PURGE_AFTER_SECONDS is set, workflow instances that completed, failed or were terminated at least that long
+# ago are purged every PURGE_INTERVAL_SECONDS, i.e. the workflow history, saved result and checkpoints are deleted.
+# If ARCHIVE_DIR is set, the results are first archived to gzipped JSON files (<instance_id>.json.gz)
+# in that directory, and GET /workflows/<instance_id> returns the archived result once the instance is purged.
+#
+# The started instances are tracked in the state store (in buckets by start time so that tracking an instance
+# doesn't rewrite the whole index) so that they are still purged after a restart (this assumes a single instance
+# of the workflow app).
+
+RESULT_TTL_SECONDS = int(os.getenv("RESULT_TTL_SECONDS", "0"))
+CHECKPOINT_TTL_SECONDS = int(os.getenv("CHECKPOINT_TTL_SECONDS", "0"))
+PURGE_AFTER_SECONDS = int(os.getenv("PURGE_AFTER_SECONDS", "0"))
+PURGE_INTERVAL_SECONDS = float(os.getenv("PURGE_INTERVAL_SECONDS", "60"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")
+
+INDEX_BUCKET_SECONDS = 600
+
+
+def get_ttl_metadata(ttl_seconds):
+    """Returns the state metadata to save an item with the TTL (or no metadata if ttl_seconds is 0)"""
+    return {"ttlInSeconds": str(ttl_seconds)} if ttl_seconds > 0 else {}
+
+
+class DaprStateItemStore:
+    # Reads and deletes items in a Dapr state store
+    # (get_dapr_client is called to get the client when it is needed)
+    def __init__(self, get_dapr_client, store_name="statestore"):
+        self._get_dapr_client = get_dapr_client
+        self._store_name = store_name
+
+    def get(self, key):
+        # returns the (encoded) data for the key, or b"" if it doesn't exist
+        return self._get_dapr_client().get_state(self._store_name, key).data
+
+    def get_many(self, keys):
+        # returns a dict of key -> (encoded) data for the keys that exist
+        if len(keys) == 0:
+            return {}
+        resp = self._get_dapr_client().get_bulk_state(self._store_name, keys=keys)
+        return {item.key: item.data for item in resp.items if item.data}
+
+    def save(self, key, data):
+        self._get_dapr_client().save_state(self._store_name, key, data)
+
+    def delete(self, key):
+        self._get_dapr_client().delete_state(self._store_name, key)
+
+
+class RetentionManager:
+    def __init__(
+        self,
+        store,
+        get_completed_at,
+        purge_workflow,
+        get_checkpoint_keys=None,
+        purge_after_seconds=PURGE_AFTER_SECONDS,
+        archive_dir=ARCHIVE_DIR,
+        bucket_seconds=INDEX_BUCKET_SECONDS,
+        clock=time.time,
+    ):
+        # store has get, get_many, save and delete methods for the results (keyed by instance id),
+        # checkpoints and the index
+        # get_completed_at is called with an instance id and returns the time (in seconds since the epoch)
+        # that the workflow instance completed, failed or was terminated, or None if it is still running
+        # purge_workflow is called with an instance id to purge the workflow instance's history
+        # get_checkpoint_keys (optional) is called with an instance id and returns the keys that its checkpoints
+        # may be saved under (it is called before the workflow history is purged)
+        self.purge_after_seconds = purge_after_seconds
+        self.archive_dir = archive_dir
+        self._store = store
+        self._get_completed_at = get_completed_at
+        self._purge_workflow = purge_workflow
+        self._get_checkpoint_keys = get_checkpoint_keys
+        self._bucket_seconds = bucket_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._purged_instances = 0
+        self._deleted_keys = 0
+        self._reclaimed_bytes = 0
+        self._archived_results = 0
+        self._archived_bytes = 0
+        self._errors = 0
+        self._last_purge_seconds = None
+
+    @property
+    def enabled(self):
+        return self.purge_after_seconds > 0
+
+    def track(self, instance_id):
+        """Records a started workflow instance so that it is purged once it has completed"""
+        if not self.enabled:
+            return
+        bucket = int(self._clock() // self._bucket_seconds) * self._bucket_seconds
+        with self._lock:
+            buckets = self._load(_INDEX_KEY) or []
+            if bucket not in buckets:
+                buckets.append(bucket)
+                self._save(_INDEX_KEY, buckets)
+            instance_ids = self._load(_get_bucket_key(bucket)) or []
+            instance_ids.append(instance_id)
+            self._save(_get_bucket_key(bucket), instance_ids)
+
+    def purge(self):
+        """Purges the tracked workflow instances that completed at least purge_after_seconds ago.
+
+        Returns the number of instances purged
+        """
+        if not self.enabled:
+            return 0
+
+        started_at = time.perf_counter()
+        now = self._clock()
+        with self._lock:
+            buckets = list(self._load(_INDEX_KEY) or [])
+        purged = 0
+        for bucket in buckets:
+            if bucket > now - self.purge_after_seconds:
+                # instances in this bucket (and later ones) started too recently to be purged
+                break
+            with self._lock:
+                instance_ids = self._load(_get_bucket_key(bucket)) or []
+            purged_ids = {instance_id for instance_id in instance_ids if self._try_purge(instance_id, now)}
+            purged += len(purged_ids)
+            if len(purged_ids) > 0:
+                # reload the bucket as instances may have been tracked in it while purging
+                with self._lock:
+                    self._remove_from_bucket(bucket, purged_ids)
+        self._last_purge_seconds = time.perf_counter() - started_at
+        return purged
+
+    def load_archived_result(self, instance_id):
+        """Returns the archived result for a purged workflow instance, or None if it hasn't been archived"""
+        if not self.archive_dir:
+            return None
+        try:
+            with gzip.open(self._get_archive_path(instance_id), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def get_status(self):
+        with self._lock:
+            buckets = (self._load(_INDEX_KEY) or []) if self.enabled else []
+        return {
+            "result_ttl_seconds": RESULT_TTL_SECONDS,
+            "checkpoint_ttl_seconds": CHECKPOINT_TTL_SECONDS,
+            "purge_after_seconds": self.purge_after_seconds,
+            "archive_dir": self.archive_dir or None,
+            "tracked_buckets": len(buckets),
+            "purged_instances": self._purged_instances,
+            "deleted_keys": self._deleted_keys,
+            "reclaimed_bytes": self._reclaimed_bytes,
+            "archived_results": self._archived_results,
+            "archived_bytes": self._archived_bytes,
+            "errors": self._errors,
+            "last_purge_seconds": self._last_purge_seconds,
+        }
+
+    def _try_purge(self, instance_id, now):
+        # returns whether the instance has been purged
+        logger = logging.getLogger("retention")
+        try:
+            completed_at = self._get_completed_at(instance_id)
+            if completed_at is None or now - completed_at < self.purge_after_seconds:
+                return False
+            data = self._store.get(instance_id)
+            if data:
+                if self.archive_dir:
+                    self._archive(instance_id, data)
+                self._store.delete(instance_id)
+                self._deleted_keys += 1
+                self._reclaimed_bytes += len(data)
+            if self._get_checkpoint_keys is not None:
+                for key, checkpoint_data in self._store.get_many(self._get_checkpoint_keys(instance_id)).items():
+                    self._store.delete(key)
+                    self._deleted_keys += 1
+                    self._reclaimed_bytes += len(checkpoint_data)
+            self._purge_workflow(instance_id)
+            self._purged_instances += 1
+            return True
+        except Exception as e:
+            logger.error(f"retention: failed to purge {instance_id}: {e}")
+            self._errors += 1
+            return False
+
+    def _remove_from_bucket(self, bucket, instance_ids):
+        remaining = [
+            instance_id for instance_id in self._load(_get_bucket_key(bucket)) or [] if instance_id not in instance_ids
+        ]
+        if len(remaining) > 0:
+            self._save(_get_bucket_key(bucket), remaining)
+        else:
+            self._store.delete(_get_bucket_key(bucket))
+            self._save(_INDEX_KEY, [value for value in self._load(_INDEX_KEY) or [] if value != bucket])
+
+    def _archive(self, instance_id, data):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = self._get_archive_path(instance_id)
+        # write to a temporary file first so that a partially written archive is never read
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+            json.dump(codec.loads(data), f)
+        os.replace(path + ".tmp", path)
+        self._archived_results += 1
+        self._archived_bytes += os.path.getsize(path)
+
+    def _get_archive_path(self, instance_id):
+        return os.path.join(self.archive_dir, f"{instance_id}.json.gz")
+
+    def _load(self, key):
+        data = self._store.get(key)
+        return codec.loads(data) if data else None
+
+    def _save(self, key, value):
+        self._store.save(key, codec.dumps(value))
+
+
+_INDEX_KEY = "retention"
+
+
+def _get_bucket_key(bucket):
+    return f"retention||{bucket}"
+
+
+def start_purging(retention_manager, interval_seconds=PURGE_INTERVAL_SECONDS):
+    """Starts a background thread that periodically purges workflow instances that completed a while ago"""
+
+    def purge():
+        logger = logging.getLogger("retention")
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                purged = retention_manager.purge()
+                if purged > 0:
+                    logger.info(f"retention: purged {purged} workflow instance(s)")
+            except Exception as e:
+                logger.error(f"retention: purge failed: {e}")
+
+    if retention_manager.enabled:
+        threading.Thread(target=purge, name="retention-purge", daemon=True).start()
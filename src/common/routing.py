@@ -0,0 +1,337 @@
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from circuit_breaker import CircuitOpenError, is_call_allowed
+
+# The routing table maps a logical action (as used in job payloads) to a pool of replicas (Dapr app ids).
+# Each call is routed to the replica with the fewest outstanding requests (and the most available rate-limit
+# tokens), so that a processor can be scaled by adding replicas without changing the job payloads.
+#
+# The routing table is loaded from the ROUTES environment variable (JSON) or the file named by ROUTES_FILE:
+#
+# {
+#     "processor": {
+#         "replicas": [
+#             {"app_id": "processor1", "rate_limit": 1},
+#             {"app_id": "processor2", "rate_limit": 1}
+#         ],
+#         "hedge_after_seconds": 5
+#     }
+# }
+#
+# rate_limit is the number of requests per second allowed for the replica (omit for no limit).
+# Replicas whose circuit breaker is open are skipped (before taking a rate-limit token).
+# hedge_after_seconds (optional) sends a second request to another replica if the first hasn't succeeded
+# in that time after it was sent. The first successful response is used (responses that the caller treats as
+# failures, e.g. 5xx and 429, don't count) and the other request is abandoned: it isn't sent if it is still
+# waiting for a rate-limit token, otherwise its response is ignored.
+# Actions that aren't in the routing table are treated as a single replica with the action as the app id.
+#
+# Both requests for a hedged call run on a pool of HEDGE_MAX_CONCURRENCY threads while the calling thread waits.
+# The call isn't hedged (and runs on the calling thread) if the pool is busy, and no hedged request is sent
+# if the pool is busy when it is due (so that calls never queue behind each other).
+#
+# When the calls for the routing table are made from several processes (e.g. the workflow worker processes, see
+# worker.py), LIMIT_SHARES is the number of processes and each process is given that share of each rate_limit
+# so that the total rate is still within the limit.
+
+HEDGE_MAX_CONCURRENCY = int(os.getenv("HEDGE_MAX_CONCURRENCY", "8"))
+LIMIT_SHARES = max(1, int(os.getenv("LIMIT_SHARES", "1")))
+
+
+class TokenBucket:
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = self.capacity
+        self._clock = clock
+        self._updated_at = clock()
+
+    def get_tokens(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        return self._tokens
+
+    def try_take(self):
+        if self.get_tokens() >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def get_wait_seconds(self):
+        return max(0, (1 - self.get_tokens()) / self.rate)
+
+
+class Replica:
+    def __init__(self, app_id, rate_limit=None, clock=time.monotonic):
+        self.app_id = app_id
+        self.outstanding = 0
+        self.bucket = TokenBucket(rate_limit, clock) if rate_limit else None
+
+    def get_tokens(self):
+        return self.bucket.get_tokens() if self.bucket else float("inf")
+
+
+class ReplicaPool:
+    def __init__(
+        self,
+        name,
+        replicas,
+        hedge_after_seconds=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+        is_available=is_call_allowed,
+    ):
+        self.name = name
+        self.replicas = replicas
+        self.hedge_after_seconds = hedge_after_seconds
+        self._sleep = sleep
+        # called with an app id to check whether its circuit breaker allows calls
+        self._is_available = is_available
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=None):
+        """Returns the replica to use for a call (waiting for a rate-limit token if necessary).
+
+        The replica's outstanding count is incremented and must be decremented by calling release.
+        Replicas in exclude are skipped, and the chosen replica is added to it (under the pool's lock,
+        so that concurrent calls sharing exclude never choose the same replica).
+        Replicas whose circuit breaker is open are skipped without taking a token, and None is returned
+        if there are no replicas left
+        """
+        while True:
+            with self._lock:
+                candidates = [
+                    replica
+                    for replica in self.replicas
+                    if (exclude is None or replica.app_id not in exclude) and self._is_available(replica.app_id)
+                ]
+                if len(candidates) == 0:
+                    return None
+                # prefer the replica with the fewest outstanding requests, then the most available tokens
+                candidates.sort(key=lambda replica: (replica.outstanding, -replica.get_tokens()))
+                for replica in candidates:
+                    if replica.bucket is None or replica.bucket.try_take():
+                        replica.outstanding += 1
+                        if exclude is not None:
+                            exclude.add(replica.app_id)
+                        return replica
+                wait_seconds = min(replica.bucket.get_wait_seconds() for replica in candidates)
+            self._sleep(wait_seconds)
+
+    def release(self, replica):
+        with self._lock:
+            replica.outstanding -= 1
+
+    def get_status(self):
+        with self._lock:
+            return {
+                "hedge_after_seconds": self.hedge_after_seconds,
+                "replicas": [
+                    {
+                        "app_id": replica.app_id,
+                        "outstanding": replica.outstanding,
+                        "tokens": replica.bucket.get_tokens() if replica.bucket else None,
+                    }
+                    for replica in self.replicas
+                ],
+            }
+
+
+def load_routes(routes_json, limit_shares=LIMIT_SHARES):
+    routes = {}
+    for name, route in json.loads(routes_json).items():
+        replicas = [
+            Replica(replica["app_id"], replica["rate_limit"] / limit_shares if replica.get("rate_limit") else None)
+            for replica in route["replicas"]
+        ]
+        routes[name] = ReplicaPool(name, replicas, route.get("hedge_after_seconds"))
+    return routes
+
+
+def _load_routes_from_env():
+    routes_json = os.getenv("ROUTES")
+    routes_file = os.getenv("ROUTES_FILE")
+    if not routes_json and routes_file:
+        with open(routes_file) as f:
+            routes_json = f.read()
+    return load_routes(routes_json) if routes_json else {}
+
+
+class _Timer:
+    # Runs callbacks after a delay on a single background thread (rather than a thread per call)
+    def __init__(self, name):
+        self._name = name
+        self._condition = threading.Condition()
+        self._timers = []  # heap of (due time, sequence number, callback)
+        self._sequence = itertools.count()
+        self._thread = None
+
+    def schedule(self, delay_seconds, callback):
+        with self._condition:
+            heapq.heappush(self._timers, (time.monotonic() + delay_seconds, next(self._sequence), callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._timers) == 0 or self._timers[0][0] > time.monotonic():
+                    timeout = self._timers[0][0] - time.monotonic() if len(self._timers) > 0 else None
+                    self._condition.wait(timeout)
+                _, _, callback = heapq.heappop(self._timers)
+            try:
+                callback()
+            except Exception as e:
+                logging.getLogger("route_call").error(f"{self._name}: callback failed: {e}")
+
+
+_routes = _load_routes_from_env()
+_routes_lock = threading.Lock()
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_CONCURRENCY, thread_name_prefix="hedge")
+_hedge_slots = threading.BoundedSemaphore(HEDGE_MAX_CONCURRENCY)
+_hedge_timer = _Timer("hedge-timer")
+
+
+def get_pool(action):
+    with _routes_lock:
+        if action not in _routes:
+            # not in the routing table, so use the action as the app id
+            _routes[action] = ReplicaPool(action, [Replica(action)])
+        return _routes[action]
+
+
+def get_route_statuses():
+    with _routes_lock:
+        pools = list(_routes.values())
+    return {pool.name: pool.get_status() for pool in pools}
+
+
+def route_call(action, fn, is_failure=lambda result: False):
+    """Calls fn with the app id of the replica to use for the action and returns the result.
+
+    Replicas whose circuit breaker is open are skipped (CircuitOpenError is raised if all of them are open).
+    For hedged calls, exceptions and results for which is_failure returns True don't count as a success
+    """
+    pool = get_pool(action)
+    if pool.hedge_after_seconds is None or len(pool.replicas) < 2:
+        return _call_replica(pool, fn, exclude=set())
+    if not _hedge_slots.acquire(blocking=False):
+        logging.getLogger("route_call").info(f"route_call ({pool.name}): all hedge threads busy - not hedging")
+        return _call_replica(pool, fn, exclude=set())
+    return _HedgedCall(pool, fn, is_failure).run()
+
+
+def is_failed_response(resp):
+    """Returns whether an HTTP response is a failure for hedging (server errors and rate-limiting)"""
+    return resp.status_code >= 500 or resp.status_code == 429
+
+
+class _HedgedCall:
+    # Sends the first request on the hedge executor and, if it hasn't succeeded hedge_after_seconds after it was
+    # sent, a hedged request to a different replica. run waits for the first successful response, or for both
+    # requests to fail (the first request's outcome is used then).
+    # Each request holds a hedge slot while it runs (the first request's slot is acquired by route_call)
+    def __init__(self, pool, fn, is_failure):
+        self.pool = pool
+        self.fn = fn
+        self.is_failure = is_failure
+        # shared between the requests so that each request uses a different replica
+        self.exclude = set()
+        self._condition = threading.Condition()
+        self._request_count = 0
+        self._outcomes = {}  # request index -> (succeeded, result, exception)
+        self._timer_started = False
+        self._finished = False
+
+    def run(self):
+        with self._condition:
+            self._submit(on_acquired=self._start_timer)
+            self._condition.wait_for(self._is_done)
+            self._finished = True
+            succeeded = [outcome for outcome in self._outcomes.values() if outcome[0]]
+            _, result, exception = succeeded[0] if len(succeeded) > 0 else self._outcomes[0]
+        if exception is not None:
+            raise exception
+        return result
+
+    def _is_done(self):
+        # done once a request has succeeded or all of the requests sent have failed
+        # (a hedged request isn't sent once the first request has failed)
+        return any(outcome[0] for outcome in self._outcomes.values()) or len(self._outcomes) == self._request_count
+
+    def _submit(self, on_acquired):
+        # called with the condition's lock held and a hedge slot acquired
+        request_index = self._request_count
+        self._request_count += 1
+        _hedge_executor.submit(self._call, request_index, on_acquired)
+
+    def _call(self, request_index, on_acquired):
+        try:
+            result = _call_replica(self.pool, self.fn, self.exclude, on_acquired=on_acquired)
+            outcome = (not self.is_failure(result), result, None)
+        except Exception as e:
+            outcome = (False, None, e)
+        finally:
+            _hedge_slots.release()
+        with self._condition:
+            self._outcomes[request_index] = outcome
+            self._condition.notify_all()
+
+    def _start_timer(self):
+        # called once the first request has its replica (after waiting for a rate-limit token)
+        # so that the time waiting for a token doesn't count towards hedge_after_seconds
+        with self._condition:
+            if not self._timer_started:
+                self._timer_started = True
+                _hedge_timer.schedule(self.pool.hedge_after_seconds, self._send_hedge)
+        return True
+
+    def _send_hedge(self):
+        logger = logging.getLogger("route_call")
+        with self._condition:
+            if self._finished or len(self._outcomes) > 0:
+                return
+            if not _hedge_slots.acquire(blocking=False):
+                logger.info(f"route_call ({self.pool.name}): all hedge threads busy - not sending hedged request")
+                return
+            logger.info(
+                f"route_call ({self.pool.name}): no response after {self.pool.hedge_after_seconds}s - sending hedged request"
+            )
+            self._submit(on_acquired=self._is_needed)
+
+    def _is_needed(self):
+        # the hedged request isn't sent if the call has finished while it was waiting for a rate-limit token
+        with self._condition:
+            return not self._finished
+
+
+class _AbandonedRequestError(Exception):
+    pass
+
+
+def _call_replica(pool, fn, exclude, on_acquired=None):
+    # exclude is updated with the replicas used (see ReplicaPool.acquire).
+    # on_acquired is called once a replica has been acquired, and fn isn't called if it returns False
+    circuit_open_error = None
+    while True:
+        replica = pool.acquire(exclude)
+        if replica is None:
+            raise circuit_open_error or CircuitOpenError(pool.name)
+        try:
+            if on_acquired is not None and not on_acquired():
+                raise _AbandonedRequestError(f"request to {replica.app_id} abandoned")
+            return fn(replica.app_id)
+        except CircuitOpenError as e:
+            circuit_open_error = e
+        finally:
+            pool.release(replica)
@@ -0,0 +1,194 @@
+from collections import deque
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+import time
+
+# The scheduler shares the processor capacity between tenants so that a tenant submitting large jobs
+# doesn't stop other tenants' actions from being processed.
+#
+# There is a scheduler per action which allows up to SCHEDULER_CONCURRENCY concurrent calls to the processor
+# (0 means no limit, in which case calls aren't queued but the per-tenant stats are still recorded).
+# When calls are queued, the next call is chosen by weighted fair queuing: each call is given a virtual finish time
+# based on the tenant's previous calls and weight, and the call with the earliest finish time is granted next.
+# This means that each tenant with queued calls gets a share of the calls in proportion to its weight.
+#
+# Tenant weights are loaded from the TENANT_WEIGHTS environment variable (JSON), e.g.
+#
+# {"tenant1": 3, "tenant2": 1}
+#
+# Tenants that aren't listed have a weight of SCHEDULER_DEFAULT_WEIGHT (default 1).
+# Jobs without a tenant are scheduled as the DEFAULT_TENANT tenant.
+#
+# When the calls are made from several processes (e.g. the workflow worker processes, see worker.py),
+# LIMIT_SHARES is the number of processes and each process is given that share of SCHEDULER_CONCURRENCY.
+
+CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "0"))
+DEFAULT_WEIGHT = float(os.getenv("SCHEDULER_DEFAULT_WEIGHT", "1"))
+STATS_WINDOW_SECONDS = float(os.getenv("SCHEDULER_STATS_WINDOW_SECONDS", "60"))
+TENANT_WEIGHTS = json.loads(os.getenv("TENANT_WEIGHTS") or "{}")
+LIMIT_SHARES = max(1, int(os.getenv("LIMIT_SHARES", "1")))
+
+DEFAULT_TENANT = "default"
+
+
+class _Request:
+    def __init__(self, tenant, finish_time, requested_at):
+        self.tenant = tenant
+        self.finish_time = finish_time
+        self.requested_at = requested_at
+        self.granted = False
+
+
+class _TenantStats:
+    def __init__(self):
+        self.waiting = 0
+        self.in_flight = 0
+        self.granted = 0
+        self.completed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.recent_completions = deque()  # completion times within the stats window
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        name,
+        concurrency=CONCURRENCY,
+        weights=TENANT_WEIGHTS,
+        default_weight=DEFAULT_WEIGHT,
+        stats_window_seconds=STATS_WINDOW_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.weights = weights
+        self.default_weight = default_weight
+        self.stats_window_seconds = stats_window_seconds
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._virtual_time = 0.0
+        self._last_finish_times = {}  # tenant -> virtual finish time of the tenant's last request
+        self._queue = []  # heap of (finish time, sequence, request)
+        self._sequence = itertools.count()
+        self._in_use = 0
+        self._stats = {}
+
+    def get_weight(self, tenant):
+        return self.weights.get(tenant, self.default_weight)
+
+    def call(self, tenant, fn):
+        """Calls fn once the tenant has been granted a share of the processor capacity and returns the result"""
+        self.acquire(tenant)
+        try:
+            return fn()
+        finally:
+            self.release(tenant)
+
+    def acquire(self, tenant):
+        """Waits until the tenant is granted a call. release must be called once the call has completed"""
+        request = self.request(tenant)
+        with self._condition:
+            while not request.granted:
+                self._condition.wait()
+
+    def request(self, tenant):
+        """Queues a request for a call and returns it (request.granted indicates whether it has been granted)"""
+        with self._condition:
+            # the virtual finish time is later for tenants with more outstanding requests
+            # and advances more slowly for tenants with higher weights
+            start_time = max(self._virtual_time, self._last_finish_times.get(tenant, 0.0))
+            request = _Request(tenant, start_time + 1 / self.get_weight(tenant), self._clock())
+            self._last_finish_times[tenant] = request.finish_time
+            heapq.heappush(self._queue, (request.finish_time, next(self._sequence), request))
+            self._get_stats(tenant).waiting += 1
+            self._dispatch()
+            return request
+
+    def release(self, tenant):
+        with self._condition:
+            self._in_use -= 1
+            stats = self._get_stats(tenant)
+            stats.in_flight -= 1
+            stats.completed += 1
+            stats.recent_completions.append(self._clock())
+            self._dispatch()
+
+    def get_status(self):
+        with self._condition:
+            now = self._clock()
+            tenants = {}
+            for tenant, stats in self._stats.items():
+                self._trim_completions(stats, now)
+                tenants[tenant] = {
+                    "weight": self.get_weight(tenant),
+                    "waiting": stats.waiting,
+                    "in_flight": stats.in_flight,
+                    "granted": stats.granted,
+                    "completed": stats.completed,
+                    "throughput_per_second": len(stats.recent_completions) / self.stats_window_seconds,
+                    "average_wait_seconds": stats.total_wait_seconds / stats.granted if stats.granted > 0 else 0,
+                    "max_wait_seconds": stats.max_wait_seconds,
+                }
+            return {
+                "concurrency": self.concurrency,
+                "in_use": self._in_use,
+                "queued": len(self._queue),
+                "tenants": tenants,
+            }
+
+    def _dispatch(self):
+        # grant queued requests (in order of virtual finish time) while there is capacity
+        granted = False
+        while len(self._queue) > 0 and (self.concurrency <= 0 or self._in_use < self.concurrency):
+            _, _, request = heapq.heappop(self._queue)
+            self._virtual_time = request.finish_time
+            self._in_use += 1
+            request.granted = True
+            granted = True
+
+            wait_seconds = self._clock() - request.requested_at
+            stats = self._get_stats(request.tenant)
+            stats.waiting -= 1
+            stats.in_flight += 1
+            stats.granted += 1
+            stats.total_wait_seconds += wait_seconds
+            stats.max_wait_seconds = max(stats.max_wait_seconds, wait_seconds)
+        if granted:
+            self._condition.notify_all()
+
+    def _get_stats(self, tenant):
+        if tenant not in self._stats:
+            self._stats[tenant] = _TenantStats()
+        return self._stats[tenant]
+
+    def _trim_completions(self, stats, now):
+        while len(stats.recent_completions) > 0 and now - stats.recent_completions[0] > self.stats_window_seconds:
+            stats.recent_completions.popleft()
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(action):
+    """Returns the scheduler for the action (shared across all callers in the process)"""
+    with _schedulers_lock:
+        if action not in _schedulers:
+            _schedulers[action] = FairScheduler(action, concurrency=math.ceil(CONCURRENCY / LIMIT_SHARES))
+        return _schedulers[action]
+
+
+def call_with_scheduler(action, tenant, fn):
+    """Calls fn once the tenant has been granted a share of the capacity for the action"""
+    return get_scheduler(action).call(tenant or DEFAULT_TENANT, fn)
+
+
+def get_scheduler_statuses():
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {scheduler.name: scheduler.get_status() for scheduler in schedulers}
@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+
+# The app starts serving straight away (so that it can respond to health checks) while the startup tasks
+# (e.g. starting the workflow runtime and waiting for the Dapr sidecar) run in parallel in the background.
+# /readyz reports the app as ready once all of the startup tasks have completed and the live checks pass.
+
+
+class StartupChecks:
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._started_at = clock()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._failed = {}
+        self._live_checks = {}
+        self.startup_seconds = None
+
+    def run_in_background(self, name, fn):
+        """Runs fn on a background thread, recording the check as complete when fn returns"""
+        with self._lock:
+            self._pending.add(name)
+
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                logging.getLogger("startup").error(f"startup: {name} failed: {e}")
+                with self._lock:
+                    self._pending.discard(name)
+                    self._failed[name] = str(e)
+                return
+            self._complete(name)
+
+        threading.Thread(target=run, name=f"startup-{name}", daemon=True).start()
+
+    def add_live_check(self, name, fn):
+        """Adds a check that is evaluated each time the readiness is queried (fn returns whether it passes)"""
+        self._live_checks[name] = fn
+
+    def get_status(self):
+        with self._lock:
+            pending = sorted(self._pending)
+            failed = dict(self._failed)
+        # live checks are only evaluated once the startup tasks have completed
+        failed_live_checks = [] if len(pending) > 0 else [name for name, fn in self._live_checks.items() if not fn()]
+        return {
+            "ready": len(pending) == 0 and len(failed) == 0 and len(failed_live_checks) == 0,
+            "pending": pending,
+            "failed": failed,
+            "failed_live_checks": failed_live_checks,
+            "startup_seconds": self.startup_seconds,
+        }
+
+    def _complete(self, name):
+        with self._lock:
+            self._pending.discard(name)
+            if len(self._pending) > 0 or self.startup_seconds is not None:
+                return
+            self.startup_seconds = self._clock() - self._started_at
+        print(f"Startup complete in {self.startup_seconds:.2f}s", flush=True)
+
+
+def is_workflow_worker_ready(workflow_runtime):
+    # wait_for_worker_ready is only available in newer versions of the Dapr SDK
+    # (older versions don't report whether the worker is connected so assume that it is once started)
+    if not hasattr(workflow_runtime, "wait_for_worker_ready"):
+        return True
+    return workflow_runtime.wait_for_worker_ready(timeout=0.1)
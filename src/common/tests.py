@@ -0,0 +1,1006 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+import unittest
+
+import dapr.ext.workflow as wf
+
+import codec
+import routing
+from admission import QUEUED, REJECTED, STARTED, AdmissionController
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from debug import format_collapsed, format_top, get_stats, profile, sample_stacks
+from local_dapr import LocalGetWorkflowResponse, LocalWorkflowRuntime
+from processing import ActionCorrelation, ProcessingAction, ProcessingPayload, get_checkpoint_keys, split_content
+from retention import RetentionManager, get_ttl_metadata
+from routing import Replica, ReplicaPool, load_routes, route_call
+from scheduler import FairScheduler
+from startup import StartupChecks
+
+
+class TestCodec(unittest.TestCase):
+    value = {"id": "wf1", "steps": [{"name": "step1", "actions": [{"content": "Hello World" * 200}]}]}
+
+    def test_json_is_untagged(self):
+        data = codec.dumps(self.value, codec="json", compression="none")
+
+        self.assertEqual(codec.get_content_type(data), "application/json")
+        self.assertEqual(codec.loads(data), self.value)
+        self.assertEqual(codec.loads(data.decode("utf-8")), self.value)
+
+    def test_compressed_is_tagged(self):
+        data = codec.dumps(self.value, codec="json", compression="zlib", compression_min_bytes=0)
+
+        self.assertTrue(data.startswith(b"\x00application/json+zlib\n"))
+        self.assertEqual(codec.get_content_type(data), "application/octet-stream")
+        self.assertEqual(codec.loads(data), self.value)
+
+    def test_small_values_are_not_compressed(self):
+        data = codec.dumps({"id": "wf1"}, codec="json", compression="zlib", compression_min_bytes=1024)
+
+        self.assertEqual(data, b'{"id":"wf1"}')
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            codec.dumps(self.value, codec="xml")
+
+
+class TestStartupChecks(unittest.TestCase):
+    def test_ready_when_tasks_complete(self):
+        startup_checks = StartupChecks()
+        task_done = threading.Event()
+        startup_checks.run_in_background("task", task_done.wait)
+
+        self.assertFalse(startup_checks.get_status()["ready"])
+        task_done.set()
+        self._wait_for(lambda: startup_checks.get_status()["ready"])
+        self.assertIsNotNone(startup_checks.get_status()["startup_seconds"])
+
+    def test_not_ready_when_task_fails(self):
+        startup_checks = StartupChecks()
+        startup_checks.run_in_background("task", self._raise_error)
+
+        self._wait_for(lambda: len(startup_checks.get_status()["pending"]) == 0)
+        status = startup_checks.get_status()
+        self.assertFalse(status["ready"])
+        self.assertEqual(status["failed"], {"task": "failed"})
+
+    def test_not_ready_when_live_check_fails(self):
+        startup_checks = StartupChecks()
+        startup_checks.add_live_check("worker", lambda: False)
+
+        status = startup_checks.get_status()
+        self.assertFalse(status["ready"])
+        self.assertEqual(status["failed_live_checks"], ["worker"])
+
+    def _raise_error(self):
+        raise ValueError("failed")
+
+    def _wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("condition not met")
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.circuit_breaker = CircuitBreaker(
+            "app1",
+            window_size=4,
+            minimum_calls=4,
+            failure_rate_threshold=50,
+            slow_call_rate_threshold=100,
+            slow_call_seconds=10,
+            open_seconds=30,
+            half_open_calls=1,
+            clock=lambda: self.now,
+        )
+
+    def _record_calls(self, failures):
+        for failed in failures:
+            self.circuit_breaker.before_call()
+            self.circuit_breaker.record_call(failed=failed, duration=1)
+
+    def test_opens_at_failure_rate(self):
+        self._record_calls([False, True, False])
+        self.assertEqual(self.circuit_breaker.get_status()["state"], "closed")
+
+        self._record_calls([True])
+
+        self.assertEqual(self.circuit_breaker.get_status()["state"], "open")
+        self.assertFalse(self.circuit_breaker.is_call_allowed())
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.before_call()
+
+    def test_opens_for_slow_calls(self):
+        for _ in range(4):
+            self.circuit_breaker.before_call()
+            self.circuit_breaker.record_call(failed=False, duration=10)
+
+        self.assertEqual(self.circuit_breaker.get_status()["state"], "open")
+
+    def test_half_open_closes_after_success(self):
+        self._record_calls([True, True, True, True])
+        self.now = 30
+
+        self.assertTrue(self.circuit_breaker.is_call_allowed())
+        self.circuit_breaker.before_call()
+        self.assertEqual(self.circuit_breaker.get_status()["state"], "half-open")
+        self.assertFalse(self.circuit_breaker.is_call_allowed())
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.before_call()  # only a single trial call is allowed
+
+        self.circuit_breaker.record_call(failed=False, duration=1)
+        self.assertEqual(self.circuit_breaker.get_status()["state"], "closed")
+
+    def test_half_open_reopens_after_failure(self):
+        self._record_calls([True, True, True, True])
+        self.now = 30
+
+        self.assertRaises(ValueError, self.circuit_breaker.call, self._raise_error)
+
+        self.assertEqual(self.circuit_breaker.get_status()["state"], "open")
+
+    def _raise_error(self):
+        raise ValueError("failed")
+
+
+class TestReplicaPool(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.sleeps = []
+
+    def _clock(self):
+        return self.now
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def test_load_routes(self):
+        routes = load_routes(
+            '{"processor": {"replicas": [{"app_id": "processor1", "rate_limit": 1}, {"app_id": "processor2"}], "hedge_after_seconds": 5}}'
+        )
+
+        pool = routes["processor"]
+        self.assertEqual([replica.app_id for replica in pool.replicas], ["processor1", "processor2"])
+        self.assertEqual(pool.replicas[0].bucket.rate, 1)
+        self.assertIsNone(pool.replicas[1].bucket)
+        self.assertEqual(pool.hedge_after_seconds, 5)
+
+    def test_load_routes_with_limit_shares(self):
+        # each of the processes making the calls gets a share of the rate limit
+        routes = load_routes('{"processor": {"replicas": [{"app_id": "processor1", "rate_limit": 10}]}}', limit_shares=4)
+
+        self.assertEqual(routes["processor"].replicas[0].bucket.rate, 2.5)
+
+    def test_acquire_least_outstanding(self):
+        pool = ReplicaPool("processor", [Replica("processor1"), Replica("processor2")])
+
+        first = pool.acquire()
+        second = pool.acquire()
+        pool.release(first)
+        third = pool.acquire()
+
+        self.assertEqual(first.app_id, "processor1")
+        self.assertEqual(second.app_id, "processor2")
+        self.assertEqual(third.app_id, "processor1")
+
+    def test_acquire_waits_for_rate_limit(self):
+        replicas = [Replica("processor1", 1, self._clock), Replica("processor2", 1, self._clock)]
+        pool = ReplicaPool("processor", replicas, clock=self._clock, sleep=self._sleep)
+
+        app_ids = []
+        for _ in range(3):
+            replica = pool.acquire()
+            app_ids.append(replica.app_id)
+            pool.release(replica)
+
+        self.assertEqual(app_ids, ["processor1", "processor2", "processor1"])
+        self.assertEqual(self.sleeps, [1])
+
+    def test_acquire_excludes_replicas(self):
+        pool = ReplicaPool("processor", [Replica("processor1"), Replica("processor2")])
+
+        self.assertEqual(pool.acquire(exclude={"processor1"}).app_id, "processor2")
+        self.assertIsNone(pool.acquire(exclude={"processor1", "processor2"}))
+
+    def test_acquire_skips_open_circuit_breakers(self):
+        replicas = [Replica("processor1", 1, self._clock), Replica("processor2", 1, self._clock)]
+        available = {"processor1": False, "processor2": True}
+        pool = ReplicaPool("processor", replicas, clock=self._clock, sleep=self._sleep, is_available=available.get)
+
+        self.assertEqual(pool.acquire().app_id, "processor2")
+        # no token is taken for the replica whose circuit breaker is open
+        self.assertEqual(replicas[0].get_tokens(), 1)
+        available["processor2"] = False
+        self.assertIsNone(pool.acquire())
+
+    def test_hedged_request_uses_another_replica(self):
+        routing._routes["hedged"] = ReplicaPool(
+            "hedged", [Replica("processor1"), Replica("processor2")], hedge_after_seconds=0.05
+        )
+        calls = []
+
+        def call(app_id):
+            calls.append((app_id, threading.current_thread()))
+            if len(calls) == 1:
+                # the first request is slow and then fails, so the hedged response is used
+                time.sleep(0.3)
+                raise Exception("timed out")
+            return app_id
+
+        try:
+            result = route_call("hedged", call)
+        finally:
+            del routing._routes["hedged"]
+
+        self.assertEqual(result, "processor2")
+        self.assertEqual([app_id for app_id, _ in calls], ["processor1", "processor2"])
+        # both requests run off the calling thread
+        self.assertNotIn(threading.current_thread(), [thread for _, thread in calls])
+
+    def test_hedged_call_returns_first_success(self):
+        routing._routes["hedged"] = ReplicaPool(
+            "hedged", [Replica("processor1"), Replica("processor2")], hedge_after_seconds=0.05
+        )
+        first_done = threading.Event()
+
+        def call(app_id):
+            if app_id == "processor1":
+                # the first request is slow, so the hedged response is used without waiting for it
+                time.sleep(0.5)
+                first_done.set()
+            return app_id
+
+        try:
+            result = route_call("hedged", call)
+        finally:
+            del routing._routes["hedged"]
+
+        self.assertEqual(result, "processor2")
+        self.assertFalse(first_done.is_set())
+
+    def test_failed_responses_are_hedged(self):
+        routing._routes["hedged"] = ReplicaPool(
+            "hedged", [Replica("processor1"), Replica("processor2")], hedge_after_seconds=0.05
+        )
+
+        def call(app_id):
+            if app_id == "processor1":
+                time.sleep(0.2)
+                return {"app_id": app_id, "status_code": 503}
+            time.sleep(0.3)
+            return {"app_id": app_id, "status_code": 200}
+
+        try:
+            result = route_call("hedged", call, is_failure=lambda result: result["status_code"] >= 500)
+        finally:
+            del routing._routes["hedged"]
+
+        # the first response is a failure, so the (later) hedged response is used
+        self.assertEqual(result, {"app_id": "processor2", "status_code": 200})
+
+    def test_no_hedged_request_when_first_request_is_fast(self):
+        routing._routes["hedged"] = ReplicaPool(
+            "hedged", [Replica("processor1"), Replica("processor2")], hedge_after_seconds=0.05
+        )
+        calls = []
+        try:
+            result = route_call("hedged", lambda app_id: calls.append(app_id) or app_id)
+            time.sleep(0.1)
+        finally:
+            del routing._routes["hedged"]
+
+        self.assertEqual(result, "processor1")
+        self.assertEqual(calls, ["processor1"])
+
+    def test_no_hedged_request_after_first_request_fails(self):
+        routing._routes["hedged"] = ReplicaPool(
+            "hedged", [Replica("processor1"), Replica("processor2")], hedge_after_seconds=0.05
+        )
+        calls = []
+        try:
+            result = route_call("hedged", lambda app_id: calls.append(app_id) or 429, is_failure=lambda result: True)
+            time.sleep(0.1)
+        finally:
+            del routing._routes["hedged"]
+
+        self.assertEqual(result, 429)
+        self.assertEqual(calls, ["processor1"])
+
+
+class TestFairScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+
+    def _grant_order(self, scheduler, requests):
+        # returns the order that the requests are granted in as the scheduler is released one call at a time
+        order = []
+        while len(order) < len(requests):
+            granted = [request for request in requests if request.granted and request not in order]
+            self.assertEqual(len(granted), 1)
+            order.append(granted[0])
+            scheduler.release(granted[0].tenant)
+        return [request.tenant for request in order]
+
+    def test_unlimited_concurrency_grants_immediately(self):
+        scheduler = FairScheduler("processor", concurrency=0, weights={}, clock=lambda: self.now)
+
+        requests = [scheduler.request("tenant1") for _ in range(3)]
+
+        self.assertTrue(all(request.granted for request in requests))
+
+    def test_shares_between_tenants(self):
+        scheduler = FairScheduler("processor", concurrency=1, weights={}, clock=lambda: self.now)
+        blocker = scheduler.request("tenant1")
+
+        requests = [scheduler.request("tenant1") for _ in range(4)]
+        requests += [scheduler.request("tenant2") for _ in range(2)]
+        scheduler.release(blocker.tenant)
+
+        self.assertEqual(
+            self._grant_order(scheduler, requests),
+            ["tenant1", "tenant2", "tenant1", "tenant2", "tenant1", "tenant1"],
+        )
+
+    def test_shares_by_weight(self):
+        scheduler = FairScheduler("processor", concurrency=1, weights={"tenant2": 2}, clock=lambda: self.now)
+        blocker = scheduler.request("tenant1")
+
+        requests = [scheduler.request("tenant1") for _ in range(3)]
+        requests += [scheduler.request("tenant2") for _ in range(4)]
+        scheduler.release(blocker.tenant)
+
+        self.assertEqual(
+            self._grant_order(scheduler, requests),
+            ["tenant2", "tenant1", "tenant2", "tenant2", "tenant1", "tenant2", "tenant1"],
+        )
+
+    def test_stats(self):
+        scheduler = FairScheduler(
+            "processor", concurrency=1, weights={}, stats_window_seconds=10, clock=lambda: self.now
+        )
+        first = scheduler.request("tenant1")
+        second = scheduler.request("tenant2")
+        self.now = 4
+        scheduler.release(first.tenant)
+
+        status = scheduler.get_status()
+
+        self.assertTrue(second.granted)
+        self.assertEqual(status["in_use"], 1)
+        self.assertEqual(status["tenants"]["tenant1"]["completed"], 1)
+        self.assertEqual(status["tenants"]["tenant1"]["throughput_per_second"], 0.1)
+        self.assertEqual(status["tenants"]["tenant2"]["in_flight"], 1)
+        self.assertEqual(status["tenants"]["tenant2"]["max_wait_seconds"], 4)
+
+
+class _MemoryStore:
+    def __init__(self):
+        self.state = {}
+
+    def load(self, key):
+        return self.state.get(key)
+
+    def save(self, key, value):
+        self.state[key] = value
+
+    def delete(self, key):
+        self.state.pop(key, None)
+
+
+class TestAdmissionController(unittest.TestCase):
+    def setUp(self):
+        self.running = set()
+        self.started = []
+        self.status_checks = []
+        self.failing = set()
+        self.store = _MemoryStore()
+
+    def _create_controller(self, **kwargs):
+        return AdmissionController(
+            self.store,
+            is_running=self._is_running,
+            start_workflow=self._start_workflow,
+            **kwargs,
+        )
+
+    def _is_running(self, instance_id):
+        self.status_checks.append(instance_id)
+        return instance_id in self.running
+
+    def _start_workflow(self, instance_id, data):
+        if instance_id in self.failing:
+            raise Exception("failed to start")
+        self.started.append(instance_id)
+        self.running.add(instance_id)
+
+    def test_disabled_starts_immediately(self):
+        controller = self._create_controller(max_running_workflows=0, max_outstanding_actions=0)
+
+        results = [controller.submit(f"wf{i}", {}, 1) for i in range(3)]
+
+        self.assertEqual(results, [STARTED] * 3)
+        self.assertEqual(self.started, ["wf0", "wf1", "wf2"])
+
+    def test_queues_when_at_limit(self):
+        controller = self._create_controller(max_running_workflows=2, max_outstanding_actions=0, mode="queue")
+
+        results = [controller.submit(f"wf{i}", {}, 1) for i in range(4)]
+
+        self.assertEqual(results, [STARTED, STARTED, QUEUED, QUEUED])
+        self.assertEqual(controller.get_queue_position("wf3"), 2)
+        self.assertEqual(controller.get_status()["queue_depth"], 2)
+
+        self.running.remove("wf0")
+        self.assertEqual(controller.drain(), 1)
+        self.assertEqual(self.started, ["wf0", "wf1", "wf2"])
+        self.assertEqual(controller.get_queue_position("wf3"), 1)
+
+    def test_rejects_when_at_limit(self):
+        controller = self._create_controller(max_running_workflows=1, max_outstanding_actions=0, mode="reject")
+
+        results = [controller.submit(f"wf{i}", {}, 1) for i in range(2)]
+
+        self.assertEqual(results, [STARTED, REJECTED])
+
+    def test_rejects_when_queue_full(self):
+        controller = self._create_controller(
+            max_running_workflows=1, max_outstanding_actions=0, max_pending_workflows=1, mode="queue"
+        )
+
+        results = [controller.submit(f"wf{i}", {}, 1) for i in range(3)]
+
+        self.assertEqual(results, [STARTED, QUEUED, REJECTED])
+
+    def test_limits_outstanding_actions(self):
+        controller = self._create_controller(max_running_workflows=0, max_outstanding_actions=5, mode="queue")
+
+        results = [controller.submit("wf0", {}, 10), controller.submit("wf1", {}, 2)]
+
+        # a job is allowed when nothing is running even if it has more actions than the limit
+        self.assertEqual(results, [STARTED, QUEUED])
+        self.assertEqual(controller.get_status()["outstanding_actions"], 10)
+
+    def test_queued_jobs_saved_separately(self):
+        controller = self._create_controller(max_running_workflows=1, max_outstanding_actions=0, mode="queue")
+
+        for i in range(3):
+            controller.submit(f"wf{i}", {"job": i}, 1)
+
+        # completed workflows are only checked when draining, not for each job submitted
+        self.assertEqual(self.status_checks, [])
+        self.assertEqual(self.store.state["admission||wf2"], {"job": 2})
+        self.assertEqual(
+            self.store.state["admission"]["pending"],
+            [{"instance_id": "wf1", "action_count": 1}, {"instance_id": "wf2", "action_count": 1}],
+        )
+
+        self.running.remove("wf0")
+        self.assertEqual(controller.drain(), 1)
+        self.assertNotIn("admission||wf1", self.store.state)
+
+        # the queue is loaded from the store after a restart
+        restarted = self._create_controller(max_running_workflows=1, max_outstanding_actions=0, mode="queue")
+        self.assertEqual(restarted.get_queue_position("wf2"), 1)
+
+    def test_drain_saves_started_jobs_when_a_start_fails(self):
+        controller = self._create_controller(max_running_workflows=3, max_outstanding_actions=0, mode="queue")
+        for i in range(6):
+            controller.submit(f"wf{i}", {}, 1)
+        self.running.clear()
+        self.failing.add("wf4")
+
+        self.assertEqual(controller.drain(), 1)
+
+        self.assertEqual(self.started, ["wf0", "wf1", "wf2", "wf3"])
+        # the job that failed to start is put back at the head of the queue
+        self.assertEqual(controller.get_queue_position("wf4"), 1)
+        self.assertEqual(controller.get_status()["running_workflows"], 1)
+        # wf3 isn't started again once wf4 can be started
+        self.failing.clear()
+        restarted = self._create_controller(max_running_workflows=3, max_outstanding_actions=0, mode="queue")
+        self.assertEqual(restarted.drain(), 2)
+        self.assertEqual(self.started, ["wf0", "wf1", "wf2", "wf3", "wf4", "wf5"])
+
+    def test_submit_releases_slot_when_start_fails(self):
+        controller = self._create_controller(max_running_workflows=1, max_outstanding_actions=0, mode="queue")
+        self.failing.add("wf0")
+
+        with self.assertRaises(Exception):
+            controller.submit("wf0", {}, 1)
+
+        self.assertEqual(controller.get_status()["running_workflows"], 0)
+        self.assertEqual(controller.submit("wf1", {}, 1), STARTED)
+
+    def test_workflows_started_without_holding_lock(self):
+        controller = self._create_controller(max_running_workflows=1, max_outstanding_actions=0, mode="queue")
+        statuses = []
+
+        def start_workflow(instance_id, data):
+            # another request is able to use the controller while the workflow is being started
+            thread = threading.Thread(target=lambda: statuses.append(controller.get_status()))
+            thread.start()
+            thread.join(timeout=5)
+            self._start_workflow(instance_id, data)
+
+        controller._start_workflow = start_workflow
+
+        self.assertEqual(controller.submit("wf0", {}, 1), STARTED)
+        # the slot is reserved before the workflow is started
+        self.assertEqual(statuses[0]["running_workflows"], 1)
+
+    def test_status_check_failure_keeps_slot(self):
+        controller = self._create_controller(max_running_workflows=1, max_outstanding_actions=0, mode="queue")
+        controller.submit("wf0", {}, 1)
+        controller.submit("wf1", {}, 1)
+        self.running.clear()
+
+        def is_running(instance_id):
+            raise Exception("status unavailable")
+
+        controller._is_running = is_running
+
+        self.assertEqual(controller.drain(), 0)
+        self.assertEqual(controller.get_queue_position("wf1"), 1)
+
+
+def _double(context, value):
+    return value * 2
+
+
+_flaky_attempts = []
+
+
+def _flaky(context, value):
+    _flaky_attempts.append(value)
+    if len(_flaky_attempts) < 2:
+        raise ValueError("flaky")
+    return value
+
+
+def _fail(context, value):
+    raise ValueError("failed")
+
+
+def _child_workflow(context, input):
+    results = yield wf.when_all([context.call_activity(_double, input=value) for value in input])
+    return sum(results)
+
+
+def _parent_workflow(context, input):
+    total = yield context.call_child_workflow(_child_workflow, input=input["values"])
+    event = yield context.wait_for_external_event("approval")
+    retried = yield context.call_activity(
+        _flaky,
+        input=total,
+        retry_policy=wf.RetryPolicy(first_retry_interval=timedelta(milliseconds=10), max_number_of_attempts=3),
+    )
+    return {"total": retried, "approved": event["approved"]}
+
+
+def _failing_workflow(context, input):
+    yield context.call_activity(_fail, input=input)
+
+
+def _counting_workflow(context, count):
+    count = yield context.call_activity(_double, input=count)
+    if count < 8:
+        context.continue_as_new(count)
+        return None
+    return count
+
+
+class TestLocalWorkflowRuntime(unittest.TestCase):
+    def setUp(self):
+        _flaky_attempts.clear()
+        self.runtime = LocalWorkflowRuntime()
+        for workflow in [_parent_workflow, _child_workflow, _failing_workflow, _counting_workflow]:
+            self.runtime.register_workflow(workflow)
+        for activity in [_double, _flaky, _fail]:
+            self.runtime.register_activity(activity)
+        self.runtime.start()
+
+    def tearDown(self):
+        self.runtime.shutdown()
+
+    def test_workflow_completes(self):
+        instance_id = self.runtime.schedule_new_workflow("_parent_workflow", {"values": [1, 2, 3]})
+        # the event is buffered if the workflow isn't waiting for it yet
+        self.runtime.raise_event(instance_id, "Approval", {"approved": True})
+
+        response = self._wait_for_completion(instance_id)
+        self.assertEqual(response.runtime_status, "Completed")
+        self.assertEqual(response.properties["dapr.workflow.output"], '{"total": 12, "approved": true}')
+        self.assertEqual(len(_flaky_attempts), 2)
+
+    def test_workflow_fails_when_activity_fails(self):
+        instance_id = self.runtime.schedule_new_workflow("_failing_workflow", 1)
+
+        response = self._wait_for_completion(instance_id)
+        self.assertEqual(response.runtime_status, "Failed")
+        self.assertIn("failed", response.properties["dapr.workflow.failure.error_message"])
+
+    def test_continue_as_new(self):
+        instance_id = self.runtime.schedule_new_workflow("_counting_workflow", 1)
+
+        response = self._wait_for_completion(instance_id)
+        self.assertEqual(response.runtime_status, "Completed")
+        self.assertEqual(response.properties["dapr.workflow.output"], "8")
+
+    def _wait_for_completion(self, instance_id):
+        for _ in range(200):
+            response = LocalGetWorkflowResponse(self.runtime.get_instance(instance_id))
+            if response.runtime_status in ["Completed", "Failed"]:
+                return response
+            time.sleep(0.01)
+        self.fail("workflow not completed")
+
+
+class _MemoryItemStore:
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        return self.items.get(key, b"")
+
+    def get_many(self, keys):
+        return {key: self.items[key] for key in keys if key in self.items}
+
+    def save(self, key, data):
+        self.items[key] = data
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+
+class TestRetentionManager(unittest.TestCase):
+    def setUp(self):
+        self.now = 10000
+        self.completed_at = {}
+        self.purged = []
+        self.store = _MemoryItemStore()
+
+    def _create_manager(self, **kwargs):
+        return RetentionManager(
+            self.store,
+            get_completed_at=lambda instance_id: self.completed_at.get(instance_id),
+            purge_workflow=self.purged.append,
+            bucket_seconds=100,
+            clock=lambda: self.now,
+            **kwargs,
+        )
+
+    def test_ttl_metadata(self):
+        self.assertEqual(get_ttl_metadata(0), {})
+        self.assertEqual(get_ttl_metadata(3600), {"ttlInSeconds": "3600"})
+
+    def test_purges_checkpoints(self):
+        manager = self._create_manager(
+            purge_after_seconds=500,
+            get_checkpoint_keys=lambda instance_id: [
+                f"{instance_id}||checkpoint||0-0",
+                f"{instance_id}||checkpoint||0-1",
+                f"{instance_id}||checkpoint||1-0",
+            ],
+        )
+        manager.track("wf0")
+        self.store.save("wf0", codec.dumps({"status": "Failed"}))
+        # the second action in the first step didn't complete so has no checkpoint
+        self.store.save("wf0||checkpoint||0-0", codec.dumps({"success": True}))
+        self.store.save("wf0||checkpoint||1-0", codec.dumps({"success": True}))
+        self.store.save("wf1||checkpoint||0-0", codec.dumps({"success": True}))
+        self.completed_at["wf0"] = self.now
+
+        self.now += 600
+        self.assertEqual(manager.purge(), 1)
+
+        self.assertEqual([key for key in self.store.items if "||checkpoint||" in key], ["wf1||checkpoint||0-0"])
+        self.assertEqual(manager.get_status()["deleted_keys"], 3)
+
+    def test_purges_completed_instances(self):
+        manager = self._create_manager(purge_after_seconds=500)
+        manager.track("wf0")
+        manager.track("wf1")
+        self.store.save("wf0", codec.dumps({"status": "Completed"}))
+        self.completed_at["wf0"] = self.now + 10
+
+        # not purged until purge_after_seconds after completing
+        self.now += 400
+        self.assertEqual(manager.purge(), 0)
+        self.now += 200
+        self.assertEqual(manager.purge(), 1)
+
+        self.assertEqual(self.purged, ["wf0"])
+        self.assertNotIn("wf0", self.store.items)
+        status = manager.get_status()
+        self.assertEqual(status["purged_instances"], 1)
+        self.assertEqual(status["deleted_keys"], 1)
+        self.assertGreater(status["reclaimed_bytes"], 0)
+
+        # the running instance is still tracked
+        self.completed_at["wf1"] = self.now
+        self.now += 500
+        self.assertEqual(manager.purge(), 1)
+        self.assertEqual(self.purged, ["wf0", "wf1"])
+        self.assertEqual(manager.get_status()["tracked_buckets"], 0)
+
+    def test_archives_results(self):
+        with tempfile.TemporaryDirectory() as archive_dir:
+            manager = self._create_manager(purge_after_seconds=100, archive_dir=archive_dir)
+            manager.track("wf0")
+            self.store.save("wf0", codec.dumps({"status": "Completed", "steps": []}))
+            self.completed_at["wf0"] = self.now
+            self.now += 200
+
+            self.assertEqual(manager.purge(), 1)
+
+            self.assertEqual(manager.load_archived_result("wf0"), {"status": "Completed", "steps": []})
+            self.assertIsNone(manager.load_archived_result("wf1"))
+            self.assertEqual(manager.get_status()["archived_results"], 1)
+
+    def test_disabled_does_not_track(self):
+        manager = self._create_manager(purge_after_seconds=0)
+        manager.track("wf0")
+
+        self.assertEqual(self.store.items, {})
+        self.assertEqual(manager.purge(), 0)
+
+
+def _busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestDebug(unittest.TestCase):
+    def setUp(self):
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, args=(self.stop,), name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def test_sample_stacks(self):
+        self._start_thread(_busy_loop, "debug-busy-1")
+        self._start_thread(lambda stop: stop.wait(), "debug-idle-1")
+
+        stacks, sample_count = sample_stacks(0.2, interval_seconds=0.01)
+
+        self.assertGreater(sample_count, 1)
+        busy_stacks = [stack for stack in stacks if stack[0] == "debug-busy"]
+        self.assertGreater(len(busy_stacks), 0)
+        self.assertTrue(busy_stacks[0][-1].startswith("_busy_loop (tests.py:"))
+        # threads that are waiting are left out unless include_idle is set
+        self.assertFalse(any(stack[0] == "debug-idle" for stack in stacks))
+        stacks, _ = sample_stacks(0.05, interval_seconds=0.01, include_idle=True)
+        self.assertTrue(any(stack[0] == "debug-idle" for stack in stacks))
+
+    def test_format_profile(self):
+        stacks = Counter({("worker", "run (a.py:1)", "work (a.py:5)"): 3, ("worker", "run (a.py:1)"): 1})
+
+        self.assertEqual(format_collapsed(stacks), "worker;run (a.py:1);work (a.py:5) 3\nworker;run (a.py:1) 1\n")
+        lines = format_top(stacks, 4).splitlines()
+        self.assertEqual(lines[3].split(), ["1", "25.0%", "4", "100.0%", "run", "(a.py:1)"])
+        self.assertEqual(lines[4].split(), ["3", "75.0%", "3", "75.0%", "work", "(a.py:5)"])
+
+    def test_profile_rejects_non_finite_seconds(self):
+        for seconds in ["nan", "inf", "-inf"]:
+            with self.assertRaises(ValueError):
+                profile(seconds)
+        # the profile lock isn't held after a rejected profile
+        self.assertIsInstance(profile("0"), str)
+
+    def test_get_stats(self):
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="debug-pool")
+        try:
+            executor.submit(self.stop.wait)
+
+            stats = get_stats()
+
+            pool = next(pool for pool in stats["thread_pools"] if pool["name"] == "debug-pool")
+            self.assertEqual(pool["max_workers"], 2)
+            self.assertEqual(pool["busy"], 1)
+            self.assertEqual(stats["threads"]["by_name"]["debug-pool"], 1)
+            self.assertEqual(len(stats["gc"]["generations"]), 3)
+        finally:
+            self.stop.set()
+            executor.shutdown()
+
+
+class TestModels(unittest.TestCase):
+    def test_from_input(self):
+        input = {
+            "steps": [
+                {
+                    "name": "step1",
+                    "actions": [
+                        {"action": "app1", "content": "content1"},
+                        {"action": "app2", "content": "content2"},
+                    ],
+                },
+                {
+                    "name": "step2",
+                    "actions": [
+                        {"action": "app3", "content": "content3"},
+                        {"action": "app4", "content": "content4"},
+                    ],
+                },
+            ]
+        }
+
+        payload = ProcessingPayload.from_input(input)
+
+        self.assertEqual(len(payload.steps), 2)
+
+        self.assertEqual(payload.steps[0].name, "step1")
+        self.assertEqual(len(payload.steps[0].actions), 2)
+        self.assertEqual(payload.steps[0].actions[0].action, "app1")
+        self.assertEqual(payload.steps[0].actions[0].content, "content1")
+        self.assertEqual(payload.steps[0].actions[1].action, "app2")
+        self.assertEqual(payload.steps[0].actions[1].content, "content2")
+
+        self.assertEqual(payload.steps[1].name, "step2")
+        self.assertEqual(len(payload.steps[1].actions), 2)
+        self.assertEqual(payload.steps[1].actions[0].action, "app3")
+        self.assertEqual(payload.steps[1].actions[0].content, "content3")
+        self.assertEqual(payload.steps[1].actions[1].action, "app4")
+        self.assertEqual(payload.steps[1].actions[1].content, "content4")
+
+    def test_dependencies_default_to_sequential(self):
+        input = {
+            "steps": [
+                {"name": "step1", "actions": []},
+                {"name": "step2", "actions": []},
+                {"name": "step3", "actions": []},
+            ]
+        }
+
+        payload = ProcessingPayload.from_input(input)
+
+        self.assertTrue(payload.is_sequential())
+        self.assertEqual(payload.get_dependencies(), [[], [0], [1]])
+
+    def test_dependencies_from_depends_on(self):
+        input = {
+            "steps": [
+                {"name": "step1", "actions": []},
+                {"name": "step2", "depends_on": [], "actions": []},
+                {"name": "step3", "depends_on": ["step2", "step1"], "actions": []},
+            ]
+        }
+
+        payload = ProcessingPayload.from_input(input)
+
+        self.assertEqual(payload.steps[2].depends_on, ["step2", "step1"])
+        self.assertFalse(payload.is_sequential())
+        self.assertEqual(payload.get_dependencies(), [[], [], [1, 0]])
+
+    def test_dependencies_unknown_step(self):
+        input = {
+            "steps": [
+                {"name": "step1", "depends_on": ["missing"], "actions": []},
+            ]
+        }
+
+        with self.assertRaises(ValueError):
+            ProcessingPayload.from_input(input)
+
+    def test_dependencies_cycle(self):
+        input = {
+            "steps": [
+                {"name": "step1", "depends_on": ["step2"], "actions": []},
+                {"name": "step2", "depends_on": ["step1"], "actions": []},
+            ]
+        }
+
+        with self.assertRaises(ValueError):
+            ProcessingPayload.from_input(input)
+
+    def test_content_from_must_be_in_dependency(self):
+        input = {
+            "steps": [
+                {"name": "step1", "actions": [{"action": "app1", "content": "content1", "id": "a1"}]},
+                {"name": "step2", "depends_on": [], "actions": [{"action": "app2", "content_from": "a1"}]},
+            ]
+        }
+
+        with self.assertRaises(ValueError):
+            ProcessingPayload.from_input(input)
+
+    def test_action_dependencies(self):
+        input = {
+            "pipelined": True,
+            "steps": [
+                {
+                    "name": "step1",
+                    "actions": [
+                        {"action": "app1", "content": "content1", "id": "a1"},
+                        {"action": "app2", "content": "content2"},
+                    ],
+                },
+                {"name": "step2", "actions": []},
+                {
+                    "name": "step3",
+                    "actions": [
+                        {"action": "app3", "content_from": "a1"},
+                        {"action": "app4", "content": "content4"},
+                    ],
+                },
+            ]
+        }
+
+        payload = ProcessingPayload.from_input(input)
+
+        self.assertTrue(payload.pipelined)
+        self.assertEqual(
+            payload.get_action_dependencies(),
+            {
+                (0, 0): [],
+                (0, 1): [],
+                (2, 0): [(0, 0)],
+                (2, 1): [(0, 0), (0, 1)],
+            },
+        )
+
+    def test_chunking_options(self):
+        input = {
+            "chunking": {"size": 100, "action_sizes": {"app2": 10}, "delimiter": "\n"},
+            "steps": [{"name": "step1", "actions": [{"action": "app1", "content": "content1"}]}],
+        }
+
+        payload = ProcessingPayload.from_input(input)
+
+        self.assertEqual(payload.chunking.get_chunk_size("app1"), 100)
+        self.assertEqual(payload.chunking.get_chunk_size("app2"), 10)
+        self.assertFalse(payload.chunking.should_split(ProcessingAction("app2", "0123456789")))
+        self.assertTrue(payload.chunking.should_split(ProcessingAction("app2", "0123456789a")))
+
+    def test_chunking_options_invalid_size(self):
+        input = {
+            "chunking": {"size": 0},
+            "steps": [{"name": "step1", "actions": [{"action": "app1", "content": "content1"}]}],
+        }
+
+        with self.assertRaises(ValueError):
+            ProcessingPayload.from_input(input)
+
+    def test_split_content_by_size(self):
+        self.assertEqual(split_content("abcdefgh", 3), ["abc", "def", "gh"])
+        self.assertEqual(split_content("abc", 3), ["abc"])
+
+    def test_split_content_at_delimiter(self):
+        chunks = split_content("one\ntwo\nthree\nfourteen", 9, delimiter="\n")
+
+        self.assertEqual(chunks, ["one\ntwo\n", "three\n", "fourteen"])
+        self.assertEqual("".join(chunks), "one\ntwo\nthree\nfourteen")
+
+    def test_get_checkpoint_keys(self):
+        keys = get_checkpoint_keys("wf0", {"steps": [{"actions": [{}, {}]}, {"actions": [{}]}]})
+
+        self.assertEqual(keys, ["wf0||checkpoint||0-0", "wf0||checkpoint||0-1", "wf0||checkpoint||1-0"])
+
+    def test_correlation_ids_are_unique_across_runs(self):
+        # the sequence restarts when the instance continues as new, so the ids include the step cursor
+        context = SimpleNamespace(instance_id="wf0")
+        first_run = ActionCorrelation(context)
+        next_run = ActionCorrelation(context, completed_steps=2)
+
+        ids = [first_run.new_correlation_id(), first_run.new_correlation_id(), next_run.new_correlation_id()]
+
+        self.assertEqual(ids, ["wf0-0-1", "wf0-0-2", "wf0-2-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
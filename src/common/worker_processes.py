@@ -0,0 +1,174 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+from dapr.conf import settings
+from dapr.ext.workflow import WorkflowRuntime
+
+from circuit_breaker import get_circuit_breaker_statuses
+from local_dapr import LOCAL_DAPR_ENABLED, LocalWorkflowRuntime
+from routing import get_route_statuses
+from scheduler import get_scheduler_statuses
+from startup import is_workflow_worker_ready
+
+# By default the workflow runtime (orchestrations and activities) runs in the same process as the API.
+# Setting WORKFLOW_WORKERS runs the workflow runtime in that many separate worker processes instead,
+# so that activity I/O and serialisation don't compete with the API for the GIL and processing can use
+# more than one CPU core. Each worker connects to the Dapr sidecar, which distributes work items across them.
+# Workers can also be run independently of the API (e.g. in a separate container) with `python worker.py`.
+# The functions take the service's register_workflow_components function (the workflows and activities to run).
+#
+# MAX_CONCURRENT_ACTIVITIES / MAX_CONCURRENT_ORCHESTRATIONS limit the number of activity / orchestration
+# work items that each worker processes at once, and WORKER_THREADS sets the size of the thread pool that
+# activities are run on (the Dapr SDK defaults are used if these aren't set, and setting them requires
+# a version of the Dapr SDK that supports them).
+#
+# Circuit breakers, routing and the tenant scheduler run in each worker process, so the workers are started with
+# LIMIT_SHARES set to the number of workers (unless it is already set, e.g. for workers in several containers)
+# and each worker applies that share of the routing rate limits and SCHEDULER_CONCURRENCY.
+# Each worker sets a shared flag while its workflow runtime is connected (for /readyz), and answers requests
+# for its circuit breaker, routing and scheduler statuses over a pipe (for /circuit-breakers, /routes and /scheduler).
+
+WORKFLOW_WORKERS = int(os.getenv("WORKFLOW_WORKERS", "0"))
+MAX_CONCURRENT_ACTIVITIES = os.getenv("MAX_CONCURRENT_ACTIVITIES")
+MAX_CONCURRENT_ORCHESTRATIONS = os.getenv("MAX_CONCURRENT_ORCHESTRATIONS")
+WORKER_THREADS = os.getenv("WORKER_THREADS")
+READY_CHECK_INTERVAL_SECONDS = 1
+STATUS_TIMEOUT_SECONDS = 5
+
+
+def create_workflow_runtime(register_workflow_components):
+    """Creates a WorkflowRuntime with the workflows and activities registered by register_workflow_components"""
+    if LOCAL_DAPR_ENABLED:
+        # run the workflows in-process against the local stand-in (see local_dapr.py)
+        max_concurrent_activities = int(MAX_CONCURRENT_ACTIVITIES) if MAX_CONCURRENT_ACTIVITIES else None
+        workflow_runtime = LocalWorkflowRuntime(max_concurrent_activities)
+        register_workflow_components(workflow_runtime)
+        return workflow_runtime
+
+    options = {}
+    if MAX_CONCURRENT_ACTIVITIES:
+        options["maximum_concurrent_activity_work_items"] = int(MAX_CONCURRENT_ACTIVITIES)
+    if MAX_CONCURRENT_ORCHESTRATIONS:
+        options["maximum_concurrent_orchestration_work_items"] = int(MAX_CONCURRENT_ORCHESTRATIONS)
+    if WORKER_THREADS:
+        options["maximum_thread_pool_workers"] = int(WORKER_THREADS)
+
+    workflow_runtime = WorkflowRuntime(settings.DAPR_RUNTIME_HOST, settings.DAPR_GRPC_PORT, **options)
+    register_workflow_components(workflow_runtime)
+    return workflow_runtime
+
+
+class WorkerProcess:
+    # A worker process that runs the workflow runtime (see run_worker)
+    def __init__(self, context, register_workflow_components, worker_index):
+        self.ready = context.Event()
+        self._connection, worker_connection = context.Pipe()
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self.process = context.Process(
+            target=run_worker,
+            args=(register_workflow_components, worker_index, self.ready, worker_connection),
+            name=f"workflow-worker-{worker_index}",
+        )
+
+    def is_ready(self):
+        """Returns whether the worker is running and its workflow runtime is connected"""
+        return self.process.is_alive() and self.ready.is_set()
+
+    def get_statuses(self, timeout_seconds=STATUS_TIMEOUT_SECONDS):
+        """Returns the worker's circuit breaker, routing and scheduler statuses (or None if it doesn't respond)"""
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._connection.send(request_id)
+            # skip any responses to earlier requests that timed out
+            while self._connection.poll(timeout_seconds):
+                response_id, statuses = self._connection.recv()
+                if response_id == request_id:
+                    return statuses
+            return None
+
+
+def get_process_statuses():
+    return {
+        "circuit_breakers": get_circuit_breaker_statuses(),
+        "routes": get_route_statuses(),
+        "scheduler": get_scheduler_statuses(),
+    }
+
+
+def run_worker(register_workflow_components, worker_index, ready=None, connection=None):
+    # Runs the workflow runtime in the current process until it receives SIGTERM or SIGINT
+    logging.basicConfig(level=logging.INFO)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    workflow_runtime = create_workflow_runtime(register_workflow_components)
+    print(f"worker {worker_index} (pid {os.getpid()}): starting workflow runtime", flush=True)
+    # start on a background thread so that the worker can be stopped while it is still starting
+    threading.Thread(target=_run_workflow_runtime, args=(workflow_runtime, ready, stop), daemon=True).start()
+    if connection is not None:
+        threading.Thread(target=_serve_statuses, args=(connection,), daemon=True).start()
+    stop.wait()
+    print(f"worker {worker_index} (pid {os.getpid()}): shutting down workflow runtime", flush=True)
+    if ready is not None:
+        ready.clear()
+    workflow_runtime.shutdown()
+
+
+def _run_workflow_runtime(workflow_runtime, ready, stop):
+    # starts the workflow runtime and then keeps the ready flag up to date with whether it is connected
+    workflow_runtime.start()
+    while ready is not None and not stop.is_set():
+        if is_workflow_worker_ready(workflow_runtime):
+            ready.set()
+        else:
+            ready.clear()
+        stop.wait(READY_CHECK_INTERVAL_SECONDS)
+
+
+def _serve_statuses(connection):
+    while True:
+        try:
+            request_id = connection.recv()
+        except EOFError:
+            return
+        connection.send((request_id, get_process_statuses()))
+
+
+def start_workers(register_workflow_components, worker_count):
+    """Starts worker processes that each run the workflow runtime and returns them (as WorkerProcesses)"""
+    # the workers inherit the environment, so this gives each of them a share of the rate limits (see above)
+    os.environ.setdefault("LIMIT_SHARES", str(worker_count))
+    # spawn (rather than fork) so that the workers don't inherit the state of the parent's threads
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        WorkerProcess(context, register_workflow_components, worker_index) for worker_index in range(worker_count)
+    ]
+    for worker in workers:
+        worker.process.start()
+    return workers
+
+
+def stop_workers(workers, timeout_seconds=10):
+    for worker in workers:
+        worker.process.terminate()
+    for worker in workers:
+        worker.process.join(timeout_seconds)
+        if worker.process.is_alive():
+            worker.process.kill()
+
+
+def main(register_workflow_components):
+    workers = start_workers(register_workflow_components, max(WORKFLOW_WORKERS, 1))
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_workers(workers))
+    try:
+        for worker in workers:
+            worker.process.join()
+    except KeyboardInterrupt:
+        stop_workers(workers)
+
@@ -0,0 +1,271 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+from config import load_run_file
+from invocation import RateLimiter, create_app_channel
+from pubsub import PubSub
+from state_store import EtagMismatchError, StateStore
+
+# Lightweight local stand-in for the Dapr sidecars (and Redis) so that the services can be run and
+# benchmarked together on a single machine without the Dapr CLI or any external services, e.g.
+#
+#   python app.py ../../dapr-workflow2-consumer-concurrency.yaml
+#
+# The apps in the Dapr multi-app run file are started with LOCAL_DAPR=true and each gets its own sidecar
+# HTTP endpoint (on DAPR_HTTP_PORT), implementing the subset of the Dapr HTTP API that the services use:
+#  - service invocation (/v1.0/invoke), applying the rate limit middleware from the app's configuration
+#  - state (/v1.0/state), backed by an in-memory store with etags and TTLs (see state_store.py)
+#  - pub/sub (/v1.0/publish), with the concurrency and redelivery of the Redis component (see pubsub.py)
+# The workflow apps run their workflows in-process when LOCAL_DAPR=true (see local_dapr.py in src/common),
+# and resiliency policies (components-with-retry/resiliency.yaml) aren't applied.
+
+EXPIRY_INTERVAL_SECONDS = 10
+
+
+class Sidecar:
+    """The state shared by the sidecar endpoints for all of the apps"""
+
+    def __init__(self, run_config):
+        self.apps = {app.app_id: app for app in run_config.apps}
+        self.app_channels = {
+            app.app_id: create_app_channel(app.app_protocol, app.app_port)
+            for app in run_config.apps
+            if app.app_port
+        }
+        self.rate_limiters = {
+            app.app_id: RateLimiter(app.max_requests_per_second)
+            for app in run_config.apps
+            if app.max_requests_per_second is not None
+        }
+        self.state_stores = {}
+        self.pubsub = PubSub(run_config.pubsubs)
+        self._lock = threading.Lock()
+
+    def get_state_store(self, store_name):
+        with self._lock:
+            return self.state_stores.setdefault(store_name, StateStore())
+
+    def start(self):
+        for app_id, channel in self.app_channels.items():
+            threading.Thread(
+                target=self._subscribe_app, args=(app_id, channel), name=f"subscribe-{app_id}", daemon=True
+            ).start()
+        threading.Thread(target=self._remove_expired_state, name="state-expiry", daemon=True).start()
+
+    def get_status(self):
+        return {
+            "rate_limits": {
+                app_id: {
+                    "max_requests_per_second": self.apps[app_id].max_requests_per_second,
+                    "rejected": limiter.rejected_count,
+                }
+                for app_id, limiter in self.rate_limiters.items()
+            },
+            "state_stores": {store_name: store.get_status() for store_name, store in self.state_stores.items()},
+            "pubsub": self.pubsub.get_status(),
+        }
+
+    def _subscribe_app(self, app_id, channel):
+        # the app's subscriptions are read once it has started (as the Dapr sidecar does)
+        while True:
+            try:
+                subscriptions = channel.get_subscriptions()
+                break
+            except Exception:
+                time.sleep(0.5)
+        for pubsub_name, topic, route in subscriptions:
+            self.pubsub.subscribe(app_id, channel, pubsub_name, topic, route)
+
+    def _remove_expired_state(self):
+        while True:
+            time.sleep(EXPIRY_INTERVAL_SECONDS)
+            for store in list(self.state_stores.values()):
+                store.remove_expired()
+
+
+def create_app(app_id, sidecar: Sidecar):
+    """Creates the sidecar HTTP endpoint for an app"""
+    app = Flask(f"sidecar-{app_id}")
+
+    @app.route("/v1.0/healthz", methods=["GET"])
+    @app.route("/v1.0/healthz/outbound", methods=["GET"])
+    def healthz():
+        return "", 204
+
+    @app.route("/v1.0/metadata", methods=["GET"])
+    def metadata():
+        return {"id": app_id, "local_sidecar": sidecar.get_status()}
+
+    @app.route(
+        "/v1.0/invoke/<target_app_id>/method/<path:method>", methods=["GET", "POST", "PUT", "DELETE", "PATCH"]
+    )
+    def invoke(target_app_id, method):
+        channel = sidecar.app_channels.get(target_app_id)
+        if channel is None:
+            return _error("ERR_DIRECT_INVOKE", f"app {target_app_id} not found", 500)
+        rate_limiter = sidecar.rate_limiters.get(target_app_id)
+        if rate_limiter is not None and not rate_limiter.try_acquire():
+            return "Too Many Requests", 429
+        try:
+            status_code, data, content_type = channel.invoke(
+                method, request.method, request.get_data(), request.content_type, request.query_string.decode()
+            )
+        except Exception as e:
+            return _error("ERR_DIRECT_INVOKE", f"failed to invoke {target_app_id}: {e}", 500)
+        return Response(data, status=status_code, content_type=content_type)
+
+    @app.route("/v1.0/state/<store_name>", methods=["POST"])
+    def save_state(store_name):
+        store = sidecar.get_state_store(store_name)
+        try:
+            for item in request.json:
+                ttl_seconds = (item.get("metadata") or {}).get("ttlInSeconds")
+                store.save(
+                    _get_state_key(app_id, item["key"]),
+                    item["value"],
+                    etag=item.get("etag"),
+                    ttl_seconds=int(ttl_seconds) if ttl_seconds is not None else None,
+                )
+        except EtagMismatchError as e:
+            return _error("ERR_STATE_SAVE", str(e), 409)
+        return "", 204
+
+    @app.route("/v1.0/state/<store_name>/<key>", methods=["GET"])
+    def get_state(store_name, key):
+        item = sidecar.get_state_store(store_name).get(_get_state_key(app_id, key))
+        if item is None:
+            return "", 204
+        value, etag = item
+        return Response(json.dumps(value), status=200, content_type="application/json", headers={"ETag": etag})
+
+    @app.route("/v1.0/state/<store_name>/<key>", methods=["DELETE"])
+    def delete_state(store_name, key):
+        store = sidecar.get_state_store(store_name)
+        try:
+            store.delete(_get_state_key(app_id, key), etag=request.headers.get("If-Match"))
+        except EtagMismatchError as e:
+            return _error("ERR_STATE_DELETE", str(e), 409)
+        return "", 204
+
+    @app.route("/v1.0/state/<store_name>/bulk", methods=["POST"])
+    def get_bulk_state(store_name):
+        keys = request.json["keys"]
+        items = sidecar.get_state_store(store_name).get_bulk([_get_state_key(app_id, key) for key in keys])
+        results = []
+        for key in keys:
+            item = items.get(_get_state_key(app_id, key))
+            results.append({"key": key} if item is None else {"key": key, "data": item[0], "etag": item[1]})
+        return results
+
+    @app.route("/v1.0/publish/<pubsub_name>/<path:topic>", methods=["POST"])
+    def publish(pubsub_name, topic):
+        try:
+            sidecar.pubsub.publish(
+                pubsub_name, topic, request.get_data(), request.content_type or "application/json", app_id
+            )
+        except KeyError as e:
+            return _error("ERR_PUBSUB_NOT_FOUND", str(e), 404)
+        return "", 204
+
+    return app
+
+
+def _get_state_key(app_id, key):
+    # keys are prefixed with the app id as with the Dapr state stores' default keyPrefix
+    return f"{app_id}||{key}"
+
+
+def _error(error_code, message, status_code):
+    return {"errorCode": error_code, "message": message}, status_code
+
+
+def _get_dapr_http_ports(apps, base_port):
+    # use the daprHttpPort from the run file if set, otherwise the next free port from base_port
+    used_ports = {app.dapr_http_port for app in apps if app.dapr_http_port}
+    ports = {}
+    next_port = base_port
+    for app in apps:
+        if app.dapr_http_port:
+            ports[app.app_id] = app.dapr_http_port
+            continue
+        while next_port in used_ports:
+            next_port += 1
+        ports[app.app_id] = next_port
+        used_ports.add(next_port)
+    return ports
+
+
+def _start_app(app, dapr_http_port):
+    command = list(app.command)
+    if len(command) > 0 and command[0] in ["python", "python3"]:
+        # run the apps with the same python as the sidecar (e.g. from a virtual environment)
+        command[0] = sys.executable
+    env = dict(os.environ)
+    env.update(app.env)
+    env.update(
+        {"APP_ID": app.app_id, "DAPR_HTTP_PORT": str(dapr_http_port), "LOCAL_DAPR": "true", "PYTHONUNBUFFERED": "1"}
+    )
+    if app.app_port:
+        env.setdefault("APP_PORT", str(app.app_port))
+    process = subprocess.Popen(
+        command, cwd=app.app_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+
+    def forward_output():
+        for line in process.stdout:
+            print(f"== APP - {app.app_id} == {line}", end="", flush=True)
+
+    threading.Thread(target=forward_output, name=f"output-{app.app_id}", daemon=True).start()
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the apps in a Dapr multi-app run file against a local sidecar")
+    parser.add_argument("run_file", help="Dapr multi-app run file, e.g. ../../dapr-workflow2-simple.yaml")
+    parser.add_argument("--base-port", type=int, default=3500, help="first port for apps without a daprHttpPort")
+    parser.add_argument(
+        "--no-apps", action="store_true", help="only run the sidecars (e.g. to run an app in a debugger)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    run_config = load_run_file(args.run_file)
+    sidecar = Sidecar(run_config)
+    dapr_http_ports = _get_dapr_http_ports(run_config.apps, args.base_port)
+    for app in run_config.apps:
+        port = dapr_http_ports[app.app_id]
+        server = make_server("localhost", port, create_app(app.app_id, sidecar), threaded=True)
+        threading.Thread(target=server.serve_forever, name=f"sidecar-{app.app_id}", daemon=True).start()
+        print(f"sidecar for {app.app_id} listening on port {port}", flush=True)
+    sidecar.start()
+
+    processes = [] if args.no_apps else [_start_app(app, dapr_http_ports[app.app_id]) for app in run_config.apps]
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    while not stop.wait(1):
+        pass
+    print("Stopping apps", flush=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from dataclasses import dataclass, field
+import os
+import re
+
+import yaml
+
+# Reads the configuration for the local sidecar from a Dapr multi-app run file (e.g. dapr-workflow2-simple.yaml)
+# and the components/configuration files that it references, so that the same run files can be used with
+# the Dapr CLI and the local sidecar. Only the settings that the local sidecar implements are read.
+
+DEFAULT_PUBSUB_CONCURRENCY = 10
+DEFAULT_REDELIVER_INTERVAL_SECONDS = 60
+
+
+@dataclass
+class AppConfig:
+    app_id: str
+    app_dir: str
+    command: list
+    app_port: int = None
+    app_protocol: str = "http"
+    dapr_http_port: int = None
+    env: dict = field(default_factory=dict)
+    # from the middleware.http.ratelimit handler in the app's configuration (if any)
+    max_requests_per_second: float = None
+
+
+@dataclass
+class PubSubConfig:
+    name: str
+    concurrency: int = DEFAULT_PUBSUB_CONCURRENCY
+    redeliver_interval_seconds: float = DEFAULT_REDELIVER_INTERVAL_SECONDS
+
+
+@dataclass
+class RunConfig:
+    apps: list
+    pubsubs: dict
+
+
+def load_run_file(path):
+    run_file_dir = os.path.dirname(os.path.abspath(path))
+    run_file = _load_yaml(path)[0]
+    common = run_file.get("common") or {}
+
+    apps = []
+    pubsubs = {}
+    for app in run_file.get("apps") or []:
+        app_dir = os.path.join(run_file_dir, app.get("appDirPath", "."))
+        resources_path = app.get("resourcesPath") or common.get("resourcesPath") or "./components"
+        components = _load_components(os.path.join(run_file_dir, resources_path))
+        for component in components.values():
+            if component["spec"]["type"].startswith("pubsub."):
+                pubsub = _get_pubsub_config(component)
+                pubsubs[pubsub.name] = pubsub
+
+        config_file_path = app.get("configFilePath") or common.get("configFilePath")
+        max_requests_per_second = None
+        if config_file_path:
+            # the config file path is relative to the app directory
+            configuration = _load_yaml(os.path.join(app_dir, config_file_path))[0]
+            max_requests_per_second = _get_max_requests_per_second(configuration, components)
+
+        env = dict(common.get("env") or {})
+        env.update(app.get("env") or {})
+        apps.append(
+            AppConfig(
+                app_id=app["appID"],
+                app_dir=app_dir,
+                command=app.get("command") or [],
+                app_port=app.get("appPort"),
+                app_protocol=app.get("appProtocol", "http"),
+                dapr_http_port=app.get("daprHttpPort"),
+                env={key: str(value) for key, value in env.items()},
+                max_requests_per_second=max_requests_per_second,
+            )
+        )
+    return RunConfig(apps=apps, pubsubs=pubsubs)
+
+
+def parse_duration(value):
+    """Parses a Go-style duration (e.g. 10s, 500ms, 1m) to seconds"""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    total_seconds = 0
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", str(value))
+    if len(parts) == 0:
+        raise ValueError(f"Invalid duration: {value}")
+    for amount, unit in parts:
+        total_seconds += float(amount) * units[unit]
+    return total_seconds
+
+
+def _load_yaml(path):
+    with open(path) as f:
+        return [document for document in yaml.safe_load_all(f) if document]
+
+
+def _load_components(resources_path):
+    components = {}
+    for file_name in sorted(os.listdir(resources_path)):
+        if not file_name.endswith((".yaml", ".yml")):
+            continue
+        for document in _load_yaml(os.path.join(resources_path, file_name)):
+            if document.get("kind") == "Component":
+                components[document["metadata"]["name"]] = document
+    return components
+
+
+def _get_metadata(component):
+    return {item["name"]: item.get("value") for item in component["spec"].get("metadata") or []}
+
+
+def _get_pubsub_config(component):
+    metadata = _get_metadata(component)
+    return PubSubConfig(
+        name=component["metadata"]["name"],
+        concurrency=int(metadata.get("concurrency", DEFAULT_PUBSUB_CONCURRENCY)),
+        redeliver_interval_seconds=parse_duration(
+            metadata.get("redeliverInterval", f"{DEFAULT_REDELIVER_INTERVAL_SECONDS}s")
+        ),
+    )
+
+
+def _get_max_requests_per_second(configuration, components):
+    spec = configuration.get("spec") or {}
+    # the appHttpPipeline handlers apply to the requests that the sidecar sends to the app
+    handlers = (spec.get("appHttpPipeline") or {}).get("handlers") or []
+    for handler in handlers:
+        if handler.get("type") == "middleware.http.ratelimit" and handler["name"] in components:
+            return float(_get_metadata(components[handler["name"]]).get("maxRequestsPerSecond", 100))
+    return None
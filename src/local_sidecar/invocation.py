@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+
+import grpc
+import requests
+from dapr.proto import appcallback_service_v1, appcallback_v1, common_v1
+from google.protobuf import empty_pb2
+from google.protobuf.any_pb2 import Any as GrpcAny
+
+# Channels for calling the apps, used for service invocation and for delivering pub/sub events.
+# Apps are called over HTTP or gRPC (the app callback API used by dapr.ext.grpc.App) depending on their appProtocol.
+
+SUCCESS = "SUCCESS"
+RETRY = "RETRY"
+DROP = "DROP"
+
+
+class RateLimiter:
+    # Token bucket with the behaviour of the middleware.http.ratelimit component: up to max_requests_per_second
+    # requests are allowed each second (with a burst of the same size) and requests over the limit are rejected
+    def __init__(self, max_requests_per_second, clock=time.monotonic):
+        self._clock = clock
+        self._rate = max_requests_per_second
+        self._capacity = max(1.0, float(int(max_requests_per_second)))
+        self._tokens = self._capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+        self.rejected_count = 0
+
+    def try_acquire(self):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.rejected_count += 1
+            return False
+
+
+class HttpAppChannel:
+    def __init__(self, app_port):
+        self._base_url = f"http://localhost:{app_port}"
+        self._session = requests.Session()
+
+    def invoke(self, method, verb, data, content_type, query_string):
+        """Invokes a method on the app and returns (status_code, data, content_type)"""
+        url = f"{self._base_url}/{method}" + (f"?{query_string}" if query_string else "")
+        headers = {"Content-Type": content_type} if content_type else {}
+        resp = self._session.request(verb, url, data=data, headers=headers)
+        return resp.status_code, resp.content, resp.headers.get("Content-Type", "application/json")
+
+    def get_subscriptions(self):
+        """Returns the app's subscriptions as a list of (pubsub_name, topic, route)"""
+        resp = self._session.get(f"{self._base_url}/dapr/subscribe")
+        if resp.status_code == 404:
+            return []
+        resp.raise_for_status()
+        subscriptions = []
+        for subscription in resp.json():
+            route = subscription.get("route") or (subscription.get("routes") or {}).get("default", "")
+            subscriptions.append((subscription["pubsubname"], subscription["topic"], route))
+        return subscriptions
+
+    def deliver_event(self, event, route):
+        """Delivers a pub/sub event to the app and returns SUCCESS, RETRY or DROP"""
+        cloud_event = {
+            "id": event.id,
+            "source": event.source,
+            "type": "com.dapr.event.sent",
+            "specversion": "1.0",
+            "datacontenttype": event.data_content_type,
+            "topic": event.topic,
+            "pubsubname": event.pubsub_name,
+        }
+        if "json" in event.data_content_type:
+            cloud_event["data"] = json.loads(event.data)
+        else:
+            cloud_event["data_base64"] = event.data_base64()
+        resp = self._session.post(
+            f"{self._base_url}/{route.lstrip('/')}",
+            data=json.dumps(cloud_event),
+            headers={"Content-Type": "application/cloudevents+json"},
+        )
+        if resp.status_code == 404:
+            return DROP
+        if not resp.ok:
+            return RETRY
+        try:
+            return (resp.json() or {}).get("status", SUCCESS).upper()
+        except ValueError:
+            return SUCCESS
+
+
+class GrpcAppChannel:
+    def __init__(self, app_port):
+        self._channel = grpc.insecure_channel(f"localhost:{app_port}")
+        self._stub = appcallback_service_v1.AppCallbackStub(self._channel)
+
+    def invoke(self, method, verb, data, content_type, query_string):
+        request = common_v1.InvokeRequest(
+            method=method,
+            data=GrpcAny(value=data),
+            content_type=content_type or "",
+            http_extension=common_v1.HTTPExtension(
+                verb=common_v1.HTTPExtension.Verb.Value(verb), querystring=query_string
+            ),
+        )
+        try:
+            response = self._stub.OnInvoke(request)
+        except grpc.RpcError as e:
+            status_code = 404 if e.code() == grpc.StatusCode.UNIMPLEMENTED else 500
+            error = {"errorCode": "ERR_DIRECT_INVOKE", "message": e.details()}
+            return status_code, json.dumps(error).encode("utf-8"), "application/json"
+        return 200, response.data.value, response.content_type or "application/json"
+
+    def get_subscriptions(self):
+        response = self._stub.ListTopicSubscriptions(empty_pb2.Empty())
+        return [
+            (subscription.pubsub_name, subscription.topic, subscription.routes.default)
+            for subscription in response.subscriptions
+        ]
+
+    def deliver_event(self, event, route):
+        request = appcallback_v1.TopicEventRequest(
+            id=event.id,
+            source=event.source,
+            type="com.dapr.event.sent",
+            spec_version="1.0",
+            data_content_type=event.data_content_type,
+            data=event.data,
+            topic=event.topic,
+            pubsub_name=event.pubsub_name,
+            path=route,
+        )
+        try:
+            response = self._stub.OnTopicEvent(request)
+        except grpc.RpcError as e:
+            return DROP if e.code() == grpc.StatusCode.UNIMPLEMENTED else RETRY
+        return appcallback_v1.TopicEventResponse.TopicEventResponseStatus.Name(response.status)
+
+
+def create_app_channel(app_protocol, app_port):
+    return GrpcAppChannel(app_port) if app_protocol == "grpc" else HttpAppChannel(app_port)
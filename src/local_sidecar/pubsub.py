@@ -0,0 +1,137 @@
+import base64
+from dataclasses import dataclass
+import logging
+import queue
+import threading
+import uuid
+
+from config import PubSubConfig
+from invocation import DROP, SUCCESS
+
+# In-memory pub/sub with the delivery semantics of the Redis pub/sub component that the services use:
+# each subscribing app receives every event published to the topic, with up to `concurrency` events
+# being processed by the app at once, and events that the app fails to process (or asks to retry)
+# are redelivered after `redeliverInterval`. Events published before an app has subscribed
+# are held and delivered once it subscribes.
+
+
+@dataclass
+class TopicEvent:
+    id: str
+    pubsub_name: str
+    topic: str
+    data: bytes
+    data_content_type: str
+    source: str
+
+    def data_base64(self):
+        return base64.b64encode(self.data).decode("ascii")
+
+
+class Subscription:
+    def __init__(self, app_id, channel, pubsub_config: PubSubConfig, topic, route):
+        self.app_id = app_id
+        self.topic = topic
+        self.route = route
+        self._channel = channel
+        self._config = pubsub_config
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._delivered_count = 0
+        self._redelivered_count = 0
+        self._dropped_count = 0
+        for index in range(pubsub_config.concurrency):
+            threading.Thread(
+                target=self._run, name=f"pubsub-{app_id}-{topic}-{index}", daemon=True
+            ).start()
+
+    def publish(self, event: TopicEvent):
+        self._queue.put(event)
+
+    def get_status(self):
+        with self._lock:
+            return {
+                "app_id": self.app_id,
+                "pubsub_name": self._config.name,
+                "topic": self.topic,
+                "concurrency": self._config.concurrency,
+                "queued": self._queue.qsize(),
+                "in_flight": self._in_flight,
+                "delivered": self._delivered_count,
+                "redelivered": self._redelivered_count,
+                "dropped": self._dropped_count,
+            }
+
+    def _run(self):
+        logger = logging.getLogger("pubsub")
+        while True:
+            event = self._queue.get()
+            with self._lock:
+                self._in_flight += 1
+            try:
+                status = self._channel.deliver_event(event, self.route)
+            except Exception as e:
+                logger.warning(f"pubsub: error delivering event {event.id} to {self.app_id}: {e}")
+                status = "ERROR"
+            with self._lock:
+                self._in_flight -= 1
+                if status == SUCCESS:
+                    self._delivered_count += 1
+                elif status == DROP:
+                    self._dropped_count += 1
+                else:
+                    self._redelivered_count += 1
+            if status == DROP:
+                logger.warning(f"pubsub: event {event.id} dropped by {self.app_id}")
+            elif status != SUCCESS:
+                timer = threading.Timer(self._config.redeliver_interval_seconds, self._queue.put, args=(event,))
+                timer.daemon = True
+                timer.start()
+
+
+class PubSub:
+    def __init__(self, pubsub_configs):
+        self._configs = pubsub_configs
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # (pubsub_name, topic) -> [Subscription]
+        self._held_events = {}  # (pubsub_name, topic) -> [TopicEvent] for topics without subscribers
+
+    def subscribe(self, app_id, channel, pubsub_name, topic, route):
+        config = self._configs.get(pubsub_name) or PubSubConfig(name=pubsub_name)
+        subscription = Subscription(app_id, channel, config, topic, route)
+        with self._lock:
+            self._subscriptions.setdefault((pubsub_name, topic), []).append(subscription)
+            held_events = self._held_events.pop((pubsub_name, topic), [])
+        for event in held_events:
+            subscription.publish(event)
+        print(f"pubsub: {app_id} subscribed to {pubsub_name}/{topic}", flush=True)
+
+    def publish(self, pubsub_name, topic, data, data_content_type, source):
+        if pubsub_name not in self._configs:
+            raise KeyError(f"pubsub {pubsub_name} not found")
+        event = TopicEvent(
+            id=str(uuid.uuid4()),
+            pubsub_name=pubsub_name,
+            topic=topic,
+            data=data,
+            data_content_type=data_content_type,
+            source=source,
+        )
+        with self._lock:
+            subscriptions = list(self._subscriptions.get((pubsub_name, topic), []))
+            if len(subscriptions) == 0:
+                self._held_events.setdefault((pubsub_name, topic), []).append(event)
+        for subscription in subscriptions:
+            subscription.publish(event)
+
+    def get_status(self):
+        with self._lock:
+            subscriptions = [subscription for values in self._subscriptions.values() for subscription in values]
+            held_events = {
+                f"{pubsub_name}/{topic}": len(events) for (pubsub_name, topic), events in self._held_events.items()
+            }
+        return {
+            "subscriptions": [subscription.get_status() for subscription in subscriptions],
+            "held_events": held_events,
+        }
@@ -0,0 +1,66 @@
+import threading
+import time
+
+# In-memory state store with the semantics of the Redis state store that the services use:
+# per-key etags, and expiry for keys saved with the ttlInSeconds metadata.
+# As with Dapr, keys are prefixed with the app id (app_id||key) by the sidecar so that apps don't share state.
+
+
+class EtagMismatchError(Exception):
+    pass
+
+
+class StateStore:
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._items = {}  # key -> (value, etag, expires_at)
+        self._etag = 0
+        self.expired_count = 0
+
+    def get(self, key):
+        """Returns (value, etag) for the key or None if the key doesn't exist"""
+        with self._lock:
+            item = self._get_item(key)
+            return None if item is None else item[:2]
+
+    def get_bulk(self, keys):
+        with self._lock:
+            return {key: item[:2] for key in keys if (item := self._get_item(key)) is not None}
+
+    def save(self, key, value, etag=None, ttl_seconds=None):
+        with self._lock:
+            item = self._get_item(key)
+            if etag and (item is None or item[1] != etag):
+                raise EtagMismatchError(f"etag mismatch for key {key}")
+            self._etag += 1
+            expires_at = self._clock() + ttl_seconds if ttl_seconds is not None and ttl_seconds >= 0 else None
+            self._items[key] = (value, str(self._etag), expires_at)
+
+    def delete(self, key, etag=None):
+        with self._lock:
+            item = self._get_item(key)
+            if etag and (item is None or item[1] != etag):
+                raise EtagMismatchError(f"etag mismatch for key {key}")
+            self._items.pop(key, None)
+
+    def remove_expired(self):
+        """Removes the expired keys (keys are also removed when they are next accessed after expiring)"""
+        with self._lock:
+            now = self._clock()
+            expired_keys = [key for key, item in self._items.items() if item[2] is not None and item[2] <= now]
+            for key in expired_keys:
+                del self._items[key]
+            self.expired_count += len(expired_keys)
+
+    def get_status(self):
+        with self._lock:
+            return {"keys": len(self._items), "expired": self.expired_count}
+
+    def _get_item(self, key):
+        item = self._items.get(key)
+        if item is not None and item[2] is not None and item[2] <= self._clock():
+            del self._items[key]
+            self.expired_count += 1
+            return None
+        return item
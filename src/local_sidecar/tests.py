@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+import unittest
+
+from config import PubSubConfig, load_run_file, parse_duration
+from invocation import DROP, RETRY, SUCCESS
+from pubsub import PubSub
+from state_store import EtagMismatchError, StateStore
+
+_REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.store = StateStore(clock=self.clock)
+
+    def test_etags(self):
+        self.store.save("k", b"v1")
+        _, etag = self.store.get("k")
+
+        self.store.save("k", b"v2", etag=etag)
+        # the etag changes with each save, so saving with the old etag fails
+        with self.assertRaises(EtagMismatchError):
+            self.store.save("k", b"v3", etag=etag)
+        with self.assertRaises(EtagMismatchError):
+            self.store.delete("k", etag=etag)
+        self.assertEqual(self.store.get("k")[0], b"v2")
+
+        self.store.delete("k", etag=self.store.get("k")[1])
+        self.assertIsNone(self.store.get("k"))
+        with self.assertRaises(EtagMismatchError):
+            self.store.save("k", b"v4", etag=etag)
+
+    def test_ttl(self):
+        self.store.save("expiring", b"v", ttl_seconds=10)
+        self.store.save("kept", b"v")
+
+        self.clock.now = 9.9
+        self.assertEqual(self.store.get_bulk(["expiring", "kept", "missing"]).keys(), {"expiring", "kept"})
+
+        self.clock.now = 10
+        self.assertIsNone(self.store.get("expiring"))
+        self.assertEqual(self.store.get_status(), {"keys": 1, "expired": 1})
+
+    def test_remove_expired(self):
+        for i in range(3):
+            self.store.save(f"k{i}", b"v", ttl_seconds=i)
+
+        self.clock.now = 1
+        self.store.remove_expired()
+
+        self.assertEqual(self.store.get_status(), {"keys": 1, "expired": 2})
+        self.assertEqual(self.store.get("k2")[0], b"v")
+
+
+class _Channel:
+    # stands in for the app channel: returns the statuses in order for each delivery of an event
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.deliveries = []
+        self.done = threading.Event()
+
+    def deliver_event(self, event, route):
+        self.deliveries.append((event.data, route))
+        status = self.statuses.pop(0)
+        if len(self.statuses) == 0:
+            self.done.set()
+        if isinstance(status, Exception):
+            raise status
+        return status
+
+
+class TestPubSub(unittest.TestCase):
+    def setUp(self):
+        self.pubsub = PubSub({"pubsub": PubSubConfig(name="pubsub", concurrency=1, redeliver_interval_seconds=0.01)})
+
+    def test_failed_events_are_redelivered(self):
+        channel = _Channel([RETRY, Exception("app unavailable"), SUCCESS])
+        self.pubsub.subscribe("app1", channel, "pubsub", "topic1", "/route")
+
+        self.pubsub.publish("pubsub", "topic1", b"data", "application/json", "workflow2")
+
+        self.assertTrue(channel.done.wait(5))
+        self.assertEqual(channel.deliveries, [(b"data", "/route")] * 3)
+        status = self._wait_for_status(delivered=1)
+        self.assertEqual(status["redelivered"], 2)
+
+    def test_dropped_events_are_not_redelivered(self):
+        channel = _Channel([DROP])
+        self.pubsub.subscribe("app1", channel, "pubsub", "topic1", "/route")
+
+        self.pubsub.publish("pubsub", "topic1", b"data", "application/json", "workflow2")
+
+        status = self._wait_for_status(dropped=1)
+        self.assertEqual(status["redelivered"], 0)
+        self.assertEqual(len(channel.deliveries), 1)
+
+    def test_events_are_held_until_subscribed(self):
+        self.pubsub.publish("pubsub", "topic1", b"data", "application/json", "workflow2")
+        self.assertEqual(self.pubsub.get_status()["held_events"], {"pubsub/topic1": 1})
+
+        channel = _Channel([SUCCESS])
+        self.pubsub.subscribe("app1", channel, "pubsub", "topic1", "/route")
+
+        self.assertTrue(channel.done.wait(5))
+        self.assertEqual(self.pubsub.get_status()["held_events"], {})
+
+    def test_unknown_pubsub(self):
+        with self.assertRaises(KeyError):
+            self.pubsub.publish("other", "topic1", b"data", "application/json", "workflow2")
+
+    def _wait_for_status(self, **counts):
+        for _ in range(500):
+            status = self.pubsub.get_status()["subscriptions"][0]
+            if all(status[name] == count for name, count in counts.items()):
+                return status
+            time.sleep(0.01)
+        self.fail(f"subscription status not reached: {counts}")
+
+
+class TestConfig(unittest.TestCase):
+    def test_load_run_file(self):
+        run_config = load_run_file(os.path.join(_REPO_DIR, "dapr-workflow2-consumer-concurrency.yaml"))
+
+        apps = {app.app_id: app for app in run_config.apps}
+        self.assertEqual(set(apps.keys()), {"processor1", "processing-consumer", "workflow2"})
+        # the rate limit is read from the middleware in the app's configuration file
+        self.assertEqual(apps["processor1"].max_requests_per_second, 1)
+        self.assertEqual(apps["processor1"].env["DELAY"], "2")
+        self.assertEqual(apps["processing-consumer"].app_protocol, "grpc")
+        self.assertIsNone(apps["workflow2"].max_requests_per_second)
+        self.assertEqual(
+            run_config.pubsubs["pubsub"], PubSubConfig(name="pubsub", concurrency=1, redeliver_interval_seconds=10)
+        )
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration("10s"), 10)
+        self.assertEqual(parse_duration("500ms"), 0.5)
+        self.assertEqual(parse_duration("1m30s"), 90)
+        with self.assertRaises(ValueError):
+            parse_duration("10")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,27 @@
 import logging
 import os
+import sys
 from cloudevents.sdk.event import v1
-from dapr.ext.grpc import App
+from dapr.ext.grpc import App, InvokeMethodRequest
 from dapr.clients.grpc._response import TopicEventResponse
-from dapr.clients import DaprClient
 
 import json
 
 import requests
 
-app = App()
+# the modules shared between the services (e.g. codec.py) are in src/common
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+import codec
+from debug import register_debug_methods
+from circuit_breaker import CircuitOpenError, call_with_circuit_breaker, get_circuit_breaker_statuses
+from routing import get_route_statuses, is_failed_response, route_call
+from scheduler import call_with_scheduler, get_scheduler_statuses
 
+app = App()
+register_debug_methods(app)
 
-dapr_client = DaprClient()
+TERMINAL_STATUSES = ["completed", "failed", "terminated"]
 
 
 @app.subscribe(pubsub_name="pubsub", topic="processor1")
@@ -21,7 +30,7 @@ def processing_consumer_processor1(event: v1.Event) -> TopicEventResponse:
     try:
         logger = logging.getLogger()
 
-        data = json.loads(event.Data())
+        data = codec.loads(event.Data())
         print(f"processing_consumer_processor1: Got data {data}", flush=True)
 
         instance_id = data.get("instance_id")
@@ -36,18 +45,50 @@ def processing_consumer_processor1(event: v1.Event) -> TopicEventResponse:
         if not content:
             raise Exception("content not found in data")
 
+        dapr_http_port = os.getenv("DAPR_HTTP_PORT", "3500")
+        workflow = "workflow2" # this could be specified in the payload for more flexibility
+
+        if data.get("fail_fast") and _is_action_cancelled(dapr_http_port, workflow, instance_id, correlation_id):
+            # the action has been cancelled or the workflow has finished (e.g. another action failed)
+            # so the result isn't needed
+            logger.info(
+                f"processing_consumer_processor1 (correlation_id: {correlation_id}): action cancelled - skipping"
+            )
+            return TopicEventResponse("success")
+
         # invoke the processing service
         body = {
             "correlation_id": correlation_id,
             "content": content,
         }
-        dapr_http_port = os.getenv("DAPR_HTTP_PORT", "3500")
-        resp = requests.post(
-            url=f"http://localhost:{dapr_http_port}/v1.0/invoke/{action}/method/process",
-            data=json.dumps(body),
-            headers={"Content-Type": "application/json"},
-        )
-        if resp.ok:
+        # wait for the tenant's share of the processor capacity (see scheduler.py),
+        # then route to a replica for the action and use a circuit breaker per app
+        # so that messages fail fast while the processor is unavailable
+        try:
+            resp = call_with_scheduler(
+                action,
+                data.get("tenant"),
+                lambda: route_call(
+                    action,
+                    lambda app_id: call_with_circuit_breaker(
+                        app_id,
+                        lambda: requests.post(
+                            url=f"http://localhost:{dapr_http_port}/v1.0/invoke/{app_id}/method/process",
+                            data=json.dumps(body),
+                            headers={"Content-Type": "application/json"},
+                        ),
+                        is_failure=_is_server_error,
+                    ),
+                    is_failure=is_failed_response,
+                ),
+            )
+        except CircuitOpenError as e:
+            logger.error(f"processing_consumer_processor1 (correlation_id: {correlation_id}): 🔌 {e}")
+            resp = None
+
+        if resp is None:
+            resp_data = {"error": f"circuit breaker open for {action}", "circuit_open": True}
+        elif resp.ok:
             logger.info(
                 f"processing_consumer_processor1 (correlation_id: {correlation_id}): ✅ completed {resp.status_code}"
             )
@@ -60,7 +101,6 @@ def processing_consumer_processor1(event: v1.Event) -> TopicEventResponse:
             resp_data = {"error": _json_or_text(resp), "status_code": resp.status_code}
 
         # send a response back to the workflow
-        workflow = "workflow2" # this could be specified in the payload for more flexibility
         body = {
             "instance_id": instance_id,
             "correlation_id": correlation_id,
@@ -79,6 +119,44 @@ def processing_consumer_processor1(event: v1.Event) -> TopicEventResponse:
         return TopicEventResponse("drop")
 
 
+def _is_action_cancelled(dapr_http_port, workflow, instance_id, correlation_id):
+    # the check is only an optimisation, so if the status can't be looked up then the action is processed
+    # rather than dropping a message that may still be needed
+    try:
+        resp = requests.get(
+            url=f"http://localhost:{dapr_http_port}/v1.0/invoke/{workflow}/method/workflows/{instance_id}/status",
+            params={"correlation_id": correlation_id},
+        )
+        resp.raise_for_status()
+        status = resp.json()
+    except Exception as e:
+        logging.getLogger().warning(
+            f"processing_consumer_processor1 (correlation_id: {correlation_id}): failed to check for cancellation: {e}"
+        )
+        return False
+    return status.get("cancelled", False) or status.get("status", "").lower() in TERMINAL_STATUSES
+
+
+@app.method(name="circuit-breakers")
+def query_circuit_breakers(request: InvokeMethodRequest):
+    return json.dumps(get_circuit_breaker_statuses())
+
+
+@app.method(name="routes")
+def query_routes(request: InvokeMethodRequest):
+    return json.dumps(get_route_statuses())
+
+
+@app.method(name="scheduler")
+def query_scheduler(request: InvokeMethodRequest):
+    return json.dumps(get_scheduler_statuses())
+
+
+def _is_server_error(resp: requests.Response):
+    # 4xx responses (e.g. rate-limiting or invalid input) don't indicate that the processor is unhealthy
+    return resp.status_code >= 500
+
+
 def _json_or_text(resp: requests.Response):
     try:
         return resp.json()
@@ -86,6 +164,7 @@ def _json_or_text(resp: requests.Response):
         return resp.text
 
 
-app_port = os.environ.get("APP_PORT")
-print(f"Starting processing-consumer on port {app_port}", flush=True)
-app.run(app_port)
+if __name__ == "__main__":
+    app_port = os.environ.get("APP_PORT")
+    print(f"Starting processing-consumer on port {app_port}", flush=True)
+    app.run(app_port)
@@ -0,0 +1,118 @@
+import json
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+from cloudevents.sdk.event import v1
+from dapr.clients.grpc._response import TopicEventResponseStatus
+import requests
+
+# the modules shared between the services (e.g. codec.py) are in src/common
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+import app
+import codec
+
+
+def _response(status_code, body):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = json.dumps(body).encode("utf-8")
+    return resp
+
+
+def _event(data, **codec_options):
+    event = v1.Event()
+    event.SetData(codec.dumps(data, **codec_options))
+    return event
+
+
+def _process(event):
+    # the subscribe decorator registers the handler with the app's servicer (rather than returning it)
+    return app.app._servicer._topic_map["pubsub:processor1:"](event)
+
+
+class TestProcessingConsumer(unittest.TestCase):
+    # Calls the subscription handler with the requests to the processor, the workflow status
+    # and the workflow's raise-event method replaced by _get and _post
+    def setUp(self):
+        self.status = {"status": "RUNNING", "cancelled": False}
+        self.posts = []
+        self.status_error = None
+        patcher = patch.multiple(app.requests, get=self._get, post=self._post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get(self, url, params=None):
+        if self.status_error is not None:
+            raise self.status_error
+        return _response(200, self.status)
+
+    def _post(self, url, data=None, headers=None):
+        self.posts.append((url, json.loads(data)))
+        if url.endswith("/method/process"):
+            return _response(200, {"success": True, "result": json.loads(data)["content"].upper()})
+        return _response(200, {"success": True})
+
+    def _message(self, **values):
+        return dict({"instance_id": "wf0", "correlation_id": "wf0-0-1", "content": "a"}, **values)
+
+    def test_result_is_raised_as_event(self):
+        response = _process(_event(self._message()))
+
+        self.assertEqual(response.status, TopicEventResponseStatus.success)
+        self.assertEqual([url.split("/")[-1] for url, _ in self.posts], ["process", "raise-event"])
+        self.assertEqual(
+            self.posts[1][1],
+            {"instance_id": "wf0", "correlation_id": "wf0-0-1", "response": {"success": True, "result": "A"}},
+        )
+
+    def test_compressed_message(self):
+        # workflow2 publishes the messages with the shared codec, which may compress them
+        event = _event(self._message(content="a" * 1000), compression="zlib", compression_min_bytes=0)
+
+        _process(event)
+
+        self.assertEqual(self.posts[0][1]["content"], "a" * 1000)
+
+    def test_cancelled_action_is_skipped(self):
+        self.status["cancelled"] = True
+
+        response = _process(_event(self._message(fail_fast=True)))
+
+        self.assertEqual(response.status, TopicEventResponseStatus.success)
+        self.assertEqual(self.posts, [])
+
+    def test_completed_workflow_is_skipped(self):
+        self.status["status"] = "COMPLETED"
+
+        _process(_event(self._message(fail_fast=True)))
+
+        self.assertEqual(self.posts, [])
+
+    def test_cancellation_only_checked_for_fail_fast(self):
+        self.status["cancelled"] = True
+
+        _process(_event(self._message()))
+
+        self.assertEqual(len(self.posts), 2)
+
+    def test_failed_cancellation_check_processes_message(self):
+        self.status_error = requests.ConnectionError("workflow2 unavailable")
+
+        response = _process(_event(self._message(fail_fast=True)))
+
+        # the message isn't dropped when the cancellation can't be checked
+        self.assertEqual(response.status, TopicEventResponseStatus.success)
+        self.assertEqual(len(self.posts), 2)
+
+    def test_invalid_message_is_dropped(self):
+        response = _process(_event(self._message(correlation_id=None)))
+
+        self.assertEqual(response.status, TopicEventResponseStatus.drop)
+        self.assertEqual(self.posts, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,8 +5,15 @@ import logging
 import os
 import random
 import string
+import sys
+
+# the modules shared between the services (e.g. debug.py) are in src/common
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from debug import register_debug_routes
 
 app = Flask(__name__)
+register_debug_routes(app)
 processing_delay = float(os.getenv("DELAY", "2"))
 failure_chance = int(os.getenv("FAILURE_CHANCE", "30"))
 shift_amount = int(os.getenv("SHIFT_AMOUNT", "1"))
@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+import timeit
+
+# the modules shared between the services (e.g. codec.py) are in src/common
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+import codec
+
+# Compares the codecs (and compression options) for typical and large job results
+# Usage: python benchmark_codec.py [--iterations N]
+
+
+def _create_result(action_count):
+    # creates a workflow result in the same shape as the results saved by save_state
+    return {
+        "id": "60eea8fa-514f-473f-a7ff-0d66330d0220",
+        "status": "Completed",
+        "steps": [
+            {
+                "name": f"step_{step_index}",
+                "actions": [
+                    {
+                        "action": "processor1",
+                        "attempt_count": 1,
+                        "content": f"Content for action {action_index} in step {step_index} " * 4,
+                        "result": {
+                            "success": True,
+                            "result": f"Result for action {action_index} in step {step_index} " * 4,
+                        },
+                    }
+                    for action_index in range(action_count // 2)
+                ],
+            }
+            for step_index in range(2)
+        ],
+    }
+
+
+def _benchmark(value, codec_name, compression, iterations):
+    data = codec.dumps(value, codec=codec_name, compression=compression, compression_min_bytes=0)
+    if codec.loads(data) != value:
+        raise Exception(f"Round trip failed for {codec_name}/{compression}")
+    encode_seconds = timeit.timeit(
+        lambda: codec.dumps(value, codec=codec_name, compression=compression, compression_min_bytes=0),
+        number=iterations,
+    )
+    decode_seconds = timeit.timeit(lambda: codec.loads(data), number=iterations)
+    return len(data), encode_seconds / iterations, decode_seconds / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    jobs = {"typical (4 actions)": _create_result(4), "large (5000 actions)": _create_result(5000)}
+    print(f"{'job':<22}{'codec':<10}{'compression':<13}{'bytes':>10}{'encode (ms)':>14}{'decode (ms)':>14}")
+    for job_name, value in jobs.items():
+        for codec_name in ["json", "msgpack", "cbor"]:
+            for compression in ["none", "zlib", "lzma"]:
+                try:
+                    size, encode_seconds, decode_seconds = _benchmark(value, codec_name, compression, args.iterations)
+                except ValueError as e:
+                    print(f"{job_name:<22}{codec_name:<10}{compression:<13} skipped: {e}")
+                    break
+                print(
+                    f"{job_name:<22}{codec_name:<10}{compression:<13}{size:>10}"
+                    f"{encode_seconds * 1000:>14.3f}{decode_seconds * 1000:>14.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
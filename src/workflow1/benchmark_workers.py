@@ -0,0 +1,71 @@
+import argparse
+import time
+
+import requests
+
+# Measures the throughput (actions/second) of a running workflow app by submitting jobs and waiting for them
+# to complete. To see how throughput scales with the number of workers, run the app with different values
+# of WORKFLOW_WORKERS (see worker.py) and run this script against each, e.g.
+#
+#   python benchmark_workers.py --jobs 10 --actions 50 --processor processor1
+#
+# The processor should be run without an artificial delay, failures or a rate limit so that
+# the workflow app is the bottleneck.
+
+
+def _submit_job(base_url, processor, action_count, job_index):
+    job = {
+        "steps": [
+            {
+                "name": "benchmark_step",
+                "actions": [
+                    {"action": processor, "content": f"Benchmark job {job_index} action {action_index}"}
+                    for action_index in range(action_count)
+                ],
+            }
+        ]
+    }
+    resp = requests.post(f"{base_url}/workflows", json=job)
+    resp.raise_for_status()
+    return resp.json()["instance_id"]
+
+
+def _wait_for_jobs(base_url, instance_ids, poll_seconds):
+    statuses = {}
+    remaining = set(instance_ids)
+    while len(remaining) > 0:
+        time.sleep(poll_seconds)
+        for instance_id in list(remaining):
+            resp = requests.get(f"{base_url}/workflows/{instance_id}")
+            resp.raise_for_status()
+            status = resp.json().get("status")
+            if status not in ["Running", "Pending", "Queued"]:
+                statuses[instance_id] = status
+                remaining.remove(instance_id)
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8100")
+    parser.add_argument("--processor", default="processor1")
+    parser.add_argument("--jobs", type=int, default=10)
+    parser.add_argument("--actions", type=int, default=50, help="number of actions per job")
+    parser.add_argument("--poll-seconds", type=float, default=0.5)
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    instance_ids = [
+        _submit_job(args.url, args.processor, args.actions, job_index) for job_index in range(args.jobs)
+    ]
+    statuses = _wait_for_jobs(args.url, instance_ids, args.poll_seconds)
+    elapsed_seconds = time.monotonic() - start
+
+    action_count = args.jobs * args.actions
+    completed_count = sum(1 for status in statuses.values() if status == "Completed")
+    print(f"jobs: {args.jobs} ({completed_count} completed), actions: {action_count}")
+    print(f"elapsed: {elapsed_seconds:.1f}s, throughput: {action_count / elapsed_seconds:.1f} actions/second")
+
+
+if __name__ == "__main__":
+    main()
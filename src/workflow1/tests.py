@@ -1,46 +1,425 @@
+import json
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
 import unittest
+from unittest.mock import patch
 
-from app import ProcessingPayload
+from dapr.clients.grpc._response import BulkStateItem, BulkStatesResponse, StateResponse
+from dapr.ext.workflow import DaprWorkflowContext
 
+try:
+    from dapr.ext.workflow._durabletask.internal import helpers, protos as pb
+    from dapr.ext.workflow._durabletask.worker import _OrchestrationExecutor, _Registry
+except ImportError:
+    # older versions of the Dapr SDK use the durabletask package (which has different names for the actions)
+    _OrchestrationExecutor = None
 
-class TestModels(unittest.TestCase):
-    def test_from_input(self):
-        input = {
+# the modules shared between the services (e.g. codec.py) are in src/common
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+import app
+import clients
+import codec
+import processing
+from local_dapr import LocalDaprClient, LocalGetWorkflowResponse, LocalWorkflowRuntime
+from worker import start_workers, stop_workers
+from workflow1 import register_workflow_components
+
+
+class _MemoryDaprClient(LocalDaprClient):
+    # LocalDaprClient (for the workflow methods) with the state held in memory rather than in the local sidecar
+    def __init__(self):
+        super().__init__()
+        self.state = {}
+
+    def get_state(self, store_name, key, state_metadata=None):
+        return StateResponse(self.state.get(key, b""))
+
+    def save_state(self, store_name, key, value, etag=None, options=None, state_metadata=None):
+        self.state[key] = value
+
+    def save_bulk_state(self, store_name, states, metadata=None):
+        for state in states:
+            self.state[state.key] = state.value
+
+    def get_bulk_state(self, store_name, keys, parallelism=1, states_metadata=None):
+        return BulkStatesResponse([BulkStateItem(key, self.state.get(key, b""), "") for key in keys])
+
+    def delete_state(self, store_name, key, etag=None, options=None, state_metadata=None):
+        self.state.pop(key, None)
+
+
+_processed_contents = []
+# ("start" or "end", content) in the order that the processor calls started and ended
+_process_events = []
+_failing_contents = set()
+
+
+def _process_content(context, input):
+    # stands in for invoke_processor: the result is the content in upper case
+    # (or an error for "fail" and the contents in _failing_contents), and contents starting with "slow" take 0.5s
+    _processed_contents.append(input["content"])
+    _process_events.append(("start", input["content"]))
+    if input["content"] == "fail" or input["content"] in _failing_contents:
+        return {"error": "processing failed"}
+    if input["content"].startswith("slow"):
+        time.sleep(0.5)
+    _process_events.append(("end", input["content"]))
+    return {"success": True, "result": input["content"].upper()}
+
+
+class _ReplayRuntime:
+    # Runs workflows with the durabletask orchestration executor (as used by the Dapr workflow worker),
+    # replaying the full history each time the workflow is resumed as the Dapr sidecar does.
+    # The activities and child workflows are run synchronously when they are scheduled
+    def __init__(self):
+        self._registry = _Registry()
+        self._activities = {}
+        self.execution_count = 0
+
+    def register_workflow(self, fn, *, name=None):
+        self._registry.add_named_orchestrator(
+            name or fn.__name__, lambda ctx, input=None: fn(DaprWorkflowContext(ctx), input)
+        )
+
+    def register_activity(self, fn, *, name=None):
+        self._activities[name or fn.__name__] = fn
+
+    def run_workflow(self, name, instance_id, input):
+        """Runs the workflow to completion and returns (output, the history for the last run of the instance)"""
+        history = []
+        new_events = [
+            helpers.new_workflow_started_event(),
+            helpers.new_execution_started_event(name, instance_id, encoded_input=json.dumps(input)),
+        ]
+        while True:
+            results = self._execute(instance_id, history, new_events)
+            history.extend(new_events)
+            new_events = [helpers.new_workflow_started_event()]
+            for action in results.actions:
+                if action.HasField("completeWorkflow"):
+                    complete = action.completeWorkflow
+                    if complete.workflowStatus == pb.ORCHESTRATION_STATUS_CONTINUED_AS_NEW:
+                        history = []
+                        new_events.append(
+                            helpers.new_execution_started_event(name, instance_id, encoded_input=complete.result.value)
+                        )
+                        break
+                    if complete.workflowStatus != pb.ORCHESTRATION_STATUS_COMPLETED:
+                        raise Exception(f"workflow {instance_id} failed: {complete.failureDetails.errorMessage}")
+                    return json.loads(complete.result.value), history
+                history.append(self._get_scheduled_event(action))
+                new_events.append(self._run_action(instance_id, action))
+
+    def _execute(self, instance_id, old_events, new_events):
+        self.execution_count += 1
+        return _OrchestrationExecutor(self._registry, logging.getLogger("replay")).execute(
+            instance_id, old_events, new_events
+        )
+
+    def _get_scheduled_event(self, action):
+        if action.HasField("scheduleTask"):
+            task = action.scheduleTask
+            return helpers.new_task_scheduled_event(action.id, task.name, task.input.value)
+        if action.HasField("createChildWorkflow"):
+            child = action.createChildWorkflow
+            return helpers.new_child_workflow_created_event(action.id, child.name, child.instanceId, child.input.value)
+        return helpers.new_timer_created_event(action.id, action.createTimer.fireAt)
+
+    def _run_action(self, instance_id, action):
+        if action.HasField("scheduleTask"):
+            activity = self._activities[action.scheduleTask.name]
+            input = json.loads(action.scheduleTask.input.value) if action.scheduleTask.input.value else None
+            try:
+                result = activity(SimpleNamespace(workflow_id=instance_id, task_id=action.id), input)
+            except Exception as e:
+                return helpers.new_task_failed_event(action.id, e)
+            return helpers.new_task_completed_event(action.id, json.dumps(result))
+        if action.HasField("createChildWorkflow"):
+            child = action.createChildWorkflow
+            try:
+                result, _ = self.run_workflow(child.name, child.instanceId, json.loads(child.input.value))
+            except Exception as e:
+                return helpers.new_child_workflow_failed_event(action.id, e)
+            return helpers.new_child_workflow_completed_event(action.id, json.dumps(result))
+        return helpers.new_timer_fired_event(action.id, action.createTimer.fireAt)
+
+
+class TestWorkerProcess(unittest.TestCase):
+    def test_ready_and_statuses(self):
+        # runs a worker process with the local workflow runtime (so that it doesn't need a Dapr sidecar)
+        with patch.dict(os.environ, {"LOCAL_DAPR": "true"}):
+            workers = start_workers(1)
+        try:
+            for _ in range(500):
+                if workers[0].is_ready():
+                    break
+                time.sleep(0.02)
+            self.assertTrue(workers[0].is_ready())
+            statuses = workers[0].get_statuses()
+            self.assertEqual(set(statuses.keys()), {"circuit_breakers", "routes", "scheduler"})
+        finally:
+            stop_workers(workers)
+        self.assertFalse(workers[0].is_ready())
+
+
+class TestProcessingWorkflow(unittest.TestCase):
+    # Runs processing_workflow on the local workflow runtime with the processor replaced by _process_content
+    def setUp(self):
+        _processed_contents.clear()
+        _process_events.clear()
+        _failing_contents.clear()
+        self.runtime = LocalWorkflowRuntime()
+        register_workflow_components(self.runtime)
+        self.runtime.register_activity(_process_content, name="invoke_processor")
+        self.runtime.start()
+        self.client = _MemoryDaprClient()
+        self._previous_client = clients._dapr_client
+        clients._dapr_client = self.client
+
+    def tearDown(self):
+        clients._dapr_client = self._previous_client
+        self.runtime.shutdown()
+
+    def test_steps_run_when_their_dependencies_complete(self):
+        job = {
+            "steps": [
+                {"name": "s1", "actions": [{"action": "p", "content": "slow1"}]},
+                {"name": "s2", "depends_on": [], "actions": [{"action": "p", "content": "b"}]},
+                {"name": "s3", "depends_on": ["s1"], "actions": [{"action": "p", "content": "c"}]},
+            ]
+        }
+
+        _, result = self._run(job)
+
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual([step["actions"][0]["result"]["result"] for step in result["steps"]], ["SLOW1", "B", "C"])
+        # s2 doesn't depend on s1 so runs at the same time, while s3 waits for s1
+        self.assertLess(_process_events.index(("end", "b")), _process_events.index(("end", "slow1")))
+        self.assertLess(_process_events.index(("end", "slow1")), _process_events.index(("start", "c")))
+
+    def test_pipelined_actions_start_when_their_content_is_available(self):
+        job = {
+            "pipelined": True,
             "steps": [
                 {
-                    "name": "step1",
-                    "actions": [
-                        {"action": "app1", "content": "content1"},
-                        {"action": "app2", "content": "content2"},
-                    ],
-                },
-                {
-                    "name": "step2",
-                    "actions": [
-                        {"action": "app3", "content": "content3"},
-                        {"action": "app4", "content": "content4"},
-                    ],
+                    "name": "s1",
+                    "actions": [{"action": "p", "content": "slow1"}, {"action": "p", "content": "f", "id": "f"}],
                 },
+                {"name": "s2", "actions": [{"action": "p", "content_from": "f"}]},
+            ],
+        }
+
+        _, result = self._run(job)
+
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual(result["steps"][1]["actions"][0]["result"]["result"], "F")
+        # the action in s2 only needs the result from f, so it doesn't wait for the rest of s1
+        self.assertLess(_process_events.index(("start", "F")), _process_events.index(("end", "slow1")))
+
+    def test_fail_fast_cancels_remaining_actions(self):
+        job = {
+            "fail_fast": True,
+            "steps": [
+                {"name": "s1", "actions": [{"action": "p", "content": "fail"}, {"action": "p", "content": "slow1"}]},
+                {"name": "s2", "actions": [{"action": "p", "content": "c"}]},
+            ],
+        }
+
+        instance_id, result = self._run(job)
+
+        self.assertEqual(result["status"], "Failed")
+        self.assertEqual(result["steps"][0]["actions"][0]["result"], {"error": "processing failed"})
+        self.assertTrue(result["steps"][0]["actions"][1]["result"]["cancelled"])
+        self.assertNotIn("c", _processed_contents)
+        # the cancelled action is recorded so that invoke_processor can skip it if it hasn't started
+        cancelled_keys = [key for key in self.client.state if key.endswith("||cancelled")]
+        self.assertEqual(cancelled_keys, [f"{instance_id}-0-2||cancelled"])
+
+    def test_resume_reprocesses_failed_and_changed_actions(self):
+        job = {
+            "steps": [
+                {"name": "s1", "actions": [{"action": "p", "content": c} for c in ["a", "b", "d"]]},
+                {"name": "s2", "actions": [{"action": "p", "content": "c"}]},
             ]
         }
+        _failing_contents.add("b")
+        instance_id, result = self._run(job)
+        self.assertEqual(result["status"], "Failed")
+
+        _failing_contents.clear()
+        _processed_contents.clear()
+        job["steps"][0]["actions"][2]["content"] = "d2"
+        _, result = self._run(dict(job, resume_from=instance_id))
+
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual([action["result"]["result"] for action in result["steps"][0]["actions"]], ["A", "B", "D2"])
+        # the checkpointed result is only reused for the action that succeeded and hasn't changed
+        self.assertEqual(sorted(_processed_contents), ["b", "c", "d2"])
+
+    def test_chunked_action(self):
+        job = {
+            "chunking": {"size": 3},
+            "steps": [{"name": "s1", "actions": [{"action": "p", "content": "abcdefgh"}]}],
+        }
+
+        _, result = self._run(job)
+
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual(sorted(_processed_contents), ["abc", "def", "gh"])
+        self.assertEqual(
+            result["steps"][0]["actions"][0]["result"], {"success": True, "result": "ABCDEFGH", "chunk_count": 3}
+        )
+
+    def test_sharded_step(self):
+        job = {"steps": [{"name": "s1", "actions": [{"action": "p", "content": f"c{i}"} for i in range(5)]}]}
+
+        with patch.object(processing, "SHARD_SIZE", 2):
+            instance_id, result = self._run(job)
+
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual([action["result"]["result"] for action in result["steps"][0]["actions"]], [f"C{i}" for i in range(5)])
+        # each shard is processed by a child workflow
+        for shard_index in range(3):
+            shard = self.runtime.get_instance(f"{instance_id}:0-0:{shard_index}")
+            self.assertEqual(shard.runtime_status, "Completed")
+
+    def test_cancelled_shards_are_terminated(self):
+        contents = ["fail", "b", "slow1", "slow2"]
+        job = {
+            "steps": [{"name": "s1", "fail_fast": True, "actions": [{"action": "p", "content": c} for c in contents]}]
+        }
+
+        with patch.object(processing, "SHARD_SIZE", 2):
+            instance_id, result = self._run(job)
+
+        self.assertEqual(result["status"], "Failed")
+        results = [action["result"] for action in result["steps"][0]["actions"]]
+        self.assertEqual(results[0], {"error": "processing failed"})
+        self.assertTrue(results[2]["cancelled"])
+        self.assertTrue(results[3]["cancelled"])
+        self.assertEqual(self.runtime.get_instance(f"{instance_id}:0-0:1").runtime_status, "Terminated")
 
-        payload = ProcessingPayload.from_input(input)
+    def test_continue_as_new(self):
+        steps = [{"name": "s0", "actions": [{"action": "p", "content": "a", "id": "a"}]}]
+        steps.extend({"name": f"s{i}", "actions": [{"action": "p", "content": f"c{i}"}]} for i in range(1, 4))
+        # refers to the result from the first run of the instance
+        steps.append({"name": "s4", "actions": [{"action": "p", "content_from": "a"}]})
 
-        self.assertEqual(len(payload.steps), 2)
+        with patch.object(processing, "MAX_STEPS_PER_INSTANCE", 2):
+            instance_id, result = self._run({"steps": steps})
+
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual(
+            [step["actions"][0]["result"]["result"] for step in result["steps"]], ["A", "C1", "C2", "C3", "A"]
+        )
+        self.assertEqual(_processed_contents, ["a", "c1", "c2", "c3", "A"])
+        # only the step cursor is carried over, the earlier results are loaded from the checkpoints
+        input = json.loads(self.runtime.get_instance(instance_id).input)
+        self.assertEqual(input["completed_steps"], 4)
+        self.assertNotIn("completed_results", input)
+
+    def test_purged_workflow_is_not_running(self):
+        instance_id, _ = self._run({"steps": [{"name": "s1", "actions": [{"action": "p", "content": "a"}]}]})
+        self.client.purge_workflow(instance_id=instance_id, workflow_component="dapr")
+
+        # the admission controller treats the purged instance as completed rather than failing to drain the queue
+        self.assertFalse(app._is_workflow_running(instance_id))
+
+    def test_save_state_fails_when_checkpoints_are_missing(self):
+        steps = [{"name": "s0", "actions": [{"action": "p", "content": "a", "result": None}]}]
+
+        # the results for the earlier runs of the instance are saved in checkpoints, which may have expired
+        with self.assertRaisesRegex(Exception, "Checkpointed results not found"):
+            processing.save_state(SimpleNamespace(workflow_id="wf0"), {"steps": steps, "checkpointed_steps": 1})
+        self.assertNotIn("wf0", self.client.state)
+
+    def test_query_unknown_workflow(self):
+        client = app.app.test_client()
+
+        with patch.object(app.retention_manager, "load_archived_result", return_value=None) as load_archived_result:
+            self.assertEqual(client.get("/workflows/unknown").status_code, 404)
+            load_archived_result.assert_called_once_with("unknown")
+
+            # the archive is only used when the instance isn't found, not for other errors
+            load_archived_result.reset_mock()
+            with patch.object(self.client, "get_workflow", side_effect=Exception("connection refused")):
+                self.assertEqual(client.get("/workflows/unknown").status_code, 500)
+            load_archived_result.assert_not_called()
+
+    def _run(self, job):
+        instance_id = self.runtime.schedule_new_workflow("processing_workflow", job)
+        for _ in range(500):
+            response = LocalGetWorkflowResponse(self.runtime.get_instance(instance_id))
+            if response.runtime_status in ["Completed", "Failed"]:
+                self.assertEqual(response.runtime_status, "Completed")
+                return instance_id, codec.loads(self.client.state[instance_id])
+            time.sleep(0.01)
+        self.fail("workflow not completed")
+
+
+@unittest.skipIf(_OrchestrationExecutor is None, "needs the durabletask executor from dapr-ext-workflow")
+class TestReplay(unittest.TestCase):
+    # Runs processing_workflow with the durabletask executor, which replays the history each time the workflow
+    # resumes and fails the workflow (with a NonDeterminismError) if the replay schedules different tasks
+    def setUp(self):
+        _processed_contents.clear()
+        _process_events.clear()
+        _failing_contents.clear()
+        self.runtime = _ReplayRuntime()
+        register_workflow_components(self.runtime)
+        self.runtime.register_activity(_process_content, name="invoke_processor")
+        self.client = _MemoryDaprClient()
+        self._previous_client = clients._dapr_client
+        clients._dapr_client = self.client
+
+    def tearDown(self):
+        clients._dapr_client = self._previous_client
+
+    def test_replay_is_deterministic(self):
+        steps = [
+            {"name": "s0", "actions": [{"action": "p", "content": "a", "id": "a"}, {"action": "p", "content": "b"}]},
+            {"name": "s1", "actions": [{"action": "p", "content": f"c{i}"} for i in range(5)]},
+            {"name": "s2", "actions": [{"action": "p", "content_from": "a"}]},
+        ]
+        steps.extend({"name": f"s{i}", "actions": [{"action": "p", "content": f"d{i}"}]} for i in range(3, 6))
+
+        # covers sharded steps (child workflows), continue as new and loading the checkpointed results
+        with patch.object(processing, "SHARD_SIZE", 2), patch.object(processing, "MAX_STEPS_PER_INSTANCE", 2):
+            output, history = self.runtime.run_workflow("processing_workflow", "wf0", {"steps": steps})
+
+        self.assertEqual(output, "workflow done")
+        result = codec.loads(self.client.state["wf0"])
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual(
+            [[action["result"]["result"] for action in step["actions"]] for step in result["steps"]],
+            [["A", "B"], [f"C{i}" for i in range(5)], ["A"], ["D3"], ["D4"], ["D5"]],
+        )
+        # each action is processed once, and s2 processes the result for a (loaded from its checkpoint)
+        expected_contents = ["a", "b", "c0", "c1", "c2", "c3", "c4", "A", "d3", "d4", "d5"]
+        self.assertEqual(sorted(_processed_contents), sorted(expected_contents))
+        # replaying the complete history of the last run gives the same result without scheduling anything new
+        results = self.runtime._execute("wf0", history[:-1], history[-1:])
+        self.assertEqual(len(results.actions), 1)
+        self.assertEqual(json.loads(results.actions[0].completeWorkflow.result.value), "workflow done")
+
+    def test_replay_fail_fast(self):
+        job = {
+            "fail_fast": True,
+            "steps": [
+                {"name": "s1", "actions": [{"action": "p", "content": "fail"}, {"action": "p", "content": "b"}]},
+                {"name": "s2", "actions": [{"action": "p", "content": "c"}]},
+            ],
+        }
 
-        self.assertEqual(payload.steps[0].name, "step1")
-        self.assertEqual(len(payload.steps[0].actions), 2)
-        self.assertEqual(payload.steps[0].actions[0].action, "app1")
-        self.assertEqual(payload.steps[0].actions[0].content, "content1")
-        self.assertEqual(payload.steps[0].actions[1].action, "app2")
-        self.assertEqual(payload.steps[0].actions[1].content, "content2")
+        self.runtime.run_workflow("processing_workflow", "wf0", job)
 
-        self.assertEqual(payload.steps[1].name, "step2")
-        self.assertEqual(len(payload.steps[1].actions), 2)
-        self.assertEqual(payload.steps[1].actions[0].action, "app3")
-        self.assertEqual(payload.steps[1].actions[0].content, "content3")
-        self.assertEqual(payload.steps[1].actions[1].action, "app4")
-        self.assertEqual(payload.steps[1].actions[1].content, "content4")
+        result = codec.loads(self.client.state["wf0"])
+        self.assertEqual(result["status"], "Failed")
+        self.assertNotIn("c", _processed_contents)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
-from dataclasses import dataclass, asdict
+from dataclasses import asdict
 from datetime import timedelta
+from functools import partial
 import json
 import logging
 import os
@@ -10,91 +11,49 @@ from dapr.ext.workflow import (
     WorkflowActivityContext,
 )
 import dapr.ext.workflow as wf
-from dapr.clients import DaprClient
 
-dapr_client = DaprClient()
+from circuit_breaker import CircuitOpenError, call_with_circuit_breaker
+from processing import (
+    ActionCorrelation,
+    ProcessingAction,
+    ProcessingActionResult,
+    ProcessingPayload,
+    ProcessingResult,
+    ProcessingStep,
+    cancel_actions,
+    cancelled_result,
+    gather_step_results,
+    get_continue_as_new_input,
+    get_save_state_input,
+    has_errors,
+    is_action_cancelled,
+    is_error,
+    is_error_result,
+    load_checkpoint,
+    run_steps,
+    save_checkpoint,
+    save_state,
+    terminate_workflows,
+)
+from routing import is_failed_response, route_call
+from scheduler import call_with_scheduler
+
+# The job model and the orchestration that is shared with workflow2 are in processing.py (in src/common)
 
 USE_RETRIES = os.getenv("USE_RETRIES", "false").lower() == "true"
 MAX_RETRIES = 3
 RETRY_SLEEP = 3
 
 
-@dataclass
-class ProcessingAction:
-    action: str
-    content: str
-
-
-@dataclass
-class ProcessingStep:
-    name: str
-    actions: list[ProcessingAction]
-
-    @staticmethod
-    def from_input(data):
-        name = data["name"]
-        actions = []
-        for action in data["actions"]:
-            actions.append(ProcessingAction(**action))
-
-        return ProcessingStep(name, actions)
-
-
-@dataclass
-class ProcessingPayload:
-    steps: list[ProcessingStep]
-
-    @staticmethod
-    def from_input(data):
-        steps = []
-        for step in data["steps"]:
-            steps.append(ProcessingStep.from_input(step))
-        return ProcessingPayload(steps)
-
-
-@dataclass
-class ProcessingActionResult:
-    action: str
-    content: str
-    result: str
-    attempt_count: int
-
-
-@dataclass
-class ProcessingStepResult:
-    name: str
-    actions: list[ProcessingActionResult]
-
-
-@dataclass
-class ProcessingResult:
-    id: str
-    status: str
-    steps: list[ProcessingStepResult]
-
-
-def _has_errors(tasks):
-    for task in tasks:
-        if _is_error(task):
-            return True
-    return False
-
-
-def _is_error(task):
-    if task.is_failed:
-        return True
-    result = task.get_result()
-    if result is None:
-        return True
-    if "error" in result:
-        return True
-    return False
-
-
 def register_workflow_components(workflowRuntime):
     workflowRuntime.register_workflow(processing_workflow)
+    workflowRuntime.register_workflow(processing_shard_workflow)
     workflowRuntime.register_activity(invoke_processor)
     workflowRuntime.register_activity(save_state)
+    workflowRuntime.register_activity(save_checkpoint)
+    workflowRuntime.register_activity(load_checkpoint)
+    workflowRuntime.register_activity(terminate_workflows)
+    workflowRuntime.register_activity(cancel_actions)
 
 
 def processing_workflow(context: DaprWorkflowContext, input):
@@ -108,191 +67,305 @@ def processing_workflow(context: DaprWorkflowContext, input):
     #     yield r
 
 
+def processing_shard_workflow(context: DaprWorkflowContext, input):
+    # Child workflow that processes a shard of the actions for a large step (see _ShardedStep)
+    # Returns the results for the actions in the shard and a flag indicating whether they all succeeded
+    step = ProcessingStep.from_input(input)
+    correlation = ActionCorrelation(context)
+    shard = (_StepWithRetries if USE_RETRIES else _StepNoRetries)(context, step, correlation)
+    while not shard.is_done:
+        yield shard.task
+        shard.on_task_completed()
+    if len(correlation.cancel_tasks) > 0:
+        yield wf.when_all(correlation.cancel_tasks)
+    return {
+        "success": shard.success,
+        "results": [asdict(shard.get_action_result(action_index)) for action_index in range(len(step.actions))],
+    }
+
+
+def _get_activity_input(step: ProcessingStep, action: ProcessingAction, correlation_id):
+    # Convert dataclass to dict before passing to call_activity
+    # otherwise the durabletask serialisation will deserialise it as a SimpleNamespace type
+    input = asdict(action)
+    input["correlation_id"] = correlation_id
+    if step.fail_fast:
+        # actions for fail_fast steps can be abandoned, so check that the action hasn't been cancelled before processing
+        input["fail_fast"] = True
+    if step.tenant is not None:
+        input["tenant"] = step.tenant
+    return input
+
+
+class _StepNoRetries:
+    # Processes the actions for a step with a single attempt
+    def __init__(self, context: DaprWorkflowContext, step: ProcessingStep, correlation: ActionCorrelation):
+        self.step = step
+        self.correlation_ids = [correlation.new_correlation_id() for _ in step.actions]
+        self.action_tasks = [
+            context.call_activity(invoke_processor, input=_get_activity_input(step, action, correlation_id))
+            for action, correlation_id in zip(step.actions, self.correlation_ids)
+        ]
+        self.cancelled_actions = set()
+        self.is_done = False
+        self.success = False
+        self._correlation = correlation
+        self._wait_for_actions()
+
+    def _wait_for_actions(self):
+        pending_tasks = [task for task in self.action_tasks if not task.is_complete]
+        if self.step.fail_fast and len(pending_tasks) > 0:
+            # wait for the next action to complete so that a failure can be handled straight away
+            self.task = wf.when_any(pending_tasks)
+        else:
+            self.task = wf.when_all(self.action_tasks)
+
+    def on_task_completed(self):
+        completed_tasks = [task for task in self.action_tasks if task.is_complete]
+        if self.step.fail_fast and has_errors(completed_tasks):
+            self.cancel()
+        elif len(completed_tasks) == len(self.action_tasks):
+            self.is_done = True
+            self.success = not has_errors(self.action_tasks)
+        else:
+            self._wait_for_actions()
+
+    def cancel(self):
+        self.cancelled_actions = {
+            action_index
+            for action_index, task in enumerate(self.action_tasks)
+            if not task.is_complete
+        }
+        if self.step.fail_fast:
+            # invoke_processor checks for cancelled actions before processing the actions for fail_fast steps
+            self._correlation.cancel(
+                [self.correlation_ids[action_index] for action_index in sorted(self.cancelled_actions)]
+            )
+        self.is_done = True
+        self.success = False
+
+    def get_completed_actions(self):
+        # returns the indices of the actions that have completed successfully
+        return [
+            action_index
+            for action_index, task in enumerate(self.action_tasks)
+            if action_index not in self.cancelled_actions and task.is_complete and not is_error(task)
+        ]
+
+    def get_action_result(self, action_index):
+        action = self.step.actions[action_index]
+        return ProcessingActionResult(
+            action=action.action,
+            content=action.content,
+            result=cancelled_result()
+            if action_index in self.cancelled_actions
+            else self.action_tasks[action_index].get_result(),
+            attempt_count=1,  # no retries, so always a single attempt ;-)
+        )
+
+
 def processing_workflow_no_retries(context: DaprWorkflowContext, input):
     # This is the workflow orchestrator
     # Calls here must be deterministic
     # TODO: consider whether logging makes sense here
     logger = logging.getLogger("processing_workflow")
-    have_errors = False
 
     try:
         payload = ProcessingPayload.from_input(input)
         if not context.is_replaying:
             logger.info(f"Processing_workflow - received new payload: {payload}")
 
-        step_results = []
-        for step in payload.steps:
-            # Convert dataclass to dict before passing to call_activity
-            # otherwise the durabletask serialisation will deserialise it as a SimpleNamespace type
-            action_tasks = [
-                context.call_activity(invoke_processor, input=asdict(action))
-                for action in step.actions
-            ]
-            yield wf.when_all(action_tasks)
-            step_results.append(action_tasks)
-            if _has_errors(action_tasks):
-                logger.info(
-                    f"processing step completed with errors - skipping any remaining work: {step.name}"
-                )
-                have_errors = True
-                break
+        completed_steps = input.get("completed_steps", 0)
+        correlation = ActionCorrelation(context, completed_steps)
+        action_runs, success, next_step = yield from run_steps(
+            context,
+            payload,
+            partial(_StepNoRetries, correlation=correlation),
+            processing_shard_workflow,
+            completed_steps,
+        )
+        if len(correlation.cancel_tasks) > 0:
+            yield wf.when_all(correlation.cancel_tasks)
+        if next_step is not None:
+            # continue as new to process the remaining steps (keeping the history for the instance bounded)
+            context.continue_as_new(get_continue_as_new_input(input, next_step))
+            return "workflow continued as new"
 
         # Gather results
         results = ProcessingResult(
             id=context.instance_id,
-            status="Failed" if have_errors else "Completed",
-            steps=[
-                ProcessingStepResult(
-                    step.name,
-                    [
-                        # step_results is an list of steps
-                        # each item is a list of action tasks
-                        # map each of these to a ProcessingActionResult
-                        ProcessingActionResult(
-                            action=action.action,
-                            content=action.content,
-                            result=step_results[step_index][action_index].get_result()
-                            if len(step_results) > step_index
-                            else None,
-                            attempt_count=1,  # no retries, so always a single attempt ;-)
-                        )
-                        for action_index, action in enumerate(step.actions)
-                    ],
-                )
-                for step_index, step in enumerate(payload.steps)
-            ],
+            status="Completed" if success else "Failed",
+            steps=gather_step_results(payload, action_runs, not_started_attempt_count=1),
         )
         logger.info(f"processing_workflow completed: {results}")
 
-        yield context.call_activity(save_state, input=asdict(results))
+        yield context.call_activity(save_state, input=get_save_state_input(results, completed_steps))
 
         return "workflow done"
     except Exception as e:
         logger.error(f"!!!workflow error: {e}")
-        # TODO - save state here showing progress and include the error(s)?
+        # progress is checkpointed as actions complete (see save_checkpoint) so the job can be resumed
+        # TODO - save state here including the error(s)?
         raise e
 
 
+class _StepWithRetries:
+    # Processes the actions for a step, retrying failed actions up to MAX_RETRIES attempts
+    def __init__(self, context: DaprWorkflowContext, step: ProcessingStep, correlation: ActionCorrelation):
+        self.step = step
+        self.step_results_dic = {}  # track final results
+        self.attempt_count = 1
+        self.is_done = False
+        self.success = False
+        self._context = context
+        self._correlation = correlation
+        self._start_attempt()
+
+    def _start_attempt(self):
+        # each attempt has new correlation ids so that cancelling an attempt doesn't affect later ones
+        self.correlation_ids = {
+            action_index: self._correlation.new_correlation_id()
+            for action_index in range(len(self.step.actions))
+            if action_index not in self.step_results_dic
+        }
+        self.action_task_dict = {
+            action_index: self._context.call_activity(
+                invoke_processor, input=_get_activity_input(self.step, self.step.actions[action_index], correlation_id)
+            )
+            for action_index, correlation_id in self.correlation_ids.items()
+        }
+        action_tasks = list(self.action_task_dict.values())
+
+        if len(action_tasks) == 0:
+            raise Exception("No actions to process")
+
+        self.task = wf.when_all(action_tasks)
+        self._waiting_to_retry = False
+
+    def on_task_completed(self):
+        if self._waiting_to_retry:
+            # retry timer has fired - start the next attempt
+            self._start_attempt()
+            return
+
+        # Determine whether to retry any actions
+        if has_errors(self.action_task_dict.values()):
+            self.attempt_count += 1
+            if self.attempt_count > MAX_RETRIES:
+                # copy all tasks to result dict (i.e. include errors)
+                self._copy_results(include_errors=True, attempt_count=self.attempt_count - 1)  # already incremented
+                self._complete(success=False)
+            else:
+                # copy successful tasks to result dict
+                self._copy_results(include_errors=False, attempt_count=self.attempt_count)  # already incremented
+
+                # Insert logic to handle failures here
+                # In this example, we're going to suspend the step for RETRY_SLEEP seconds
+                # before resuming to continue to the next attempt
+                self.task = self._context.create_timer(
+                    self._context.current_utc_datetime + timedelta(seconds=RETRY_SLEEP)
+                )
+                self._waiting_to_retry = True
+        else:
+            # copy all tasks to result dict
+            self._copy_results(include_errors=True, attempt_count=self.attempt_count)
+            self._complete(success=True)
+
+    def _copy_results(self, include_errors, attempt_count):
+        for action_index, task in self.action_task_dict.items():
+            if include_errors or not is_error(task):
+                action = self.step.actions[action_index]
+                self.step_results_dic[action_index] = ProcessingActionResult(
+                    action=action.action,
+                    content=action.content,
+                    result=task.get_result(),
+                    attempt_count=attempt_count,
+                )
+
+    def cancel(self):
+        if self.step.fail_fast and not self._waiting_to_retry:
+            # invoke_processor checks for cancelled actions before processing the actions for fail_fast steps
+            self._correlation.cancel(
+                [
+                    self.correlation_ids[action_index]
+                    for action_index, task in self.action_task_dict.items()
+                    if not task.is_complete
+                ]
+            )
+        # record any actions without a final result as cancelled
+        for action_index, action in enumerate(self.step.actions):
+            if action_index not in self.step_results_dic:
+                self.step_results_dic[action_index] = ProcessingActionResult(
+                    action=action.action,
+                    content=action.content,
+                    result=cancelled_result(),
+                    attempt_count=self.attempt_count,
+                )
+        self.is_done = True
+        self.success = False
+
+    def get_action_result(self, action_index):
+        return self.step_results_dic[action_index]
+
+    def get_completed_actions(self):
+        # returns the indices of the actions that have completed successfully
+        return [
+            action_index
+            for action_index, action_result in self.step_results_dic.items()
+            if not is_error_result(action_result.result)
+        ]
+
+    def _complete(self, success):
+        if len(self.step_results_dic) != len(self.step.actions):
+            raise Exception(
+                f"Expected {len(self.step.actions)} results but got {len(self.step_results_dic)} (step={self.step.name}))"
+            )
+        self.is_done = True
+        self.success = success
+
+
 def processing_workflow_with_retries(context: DaprWorkflowContext, input):
     # This is the workflow orchestrator
     # Calls here must be deterministic
     # TODO: consider whether logging makes sense here
     logger = logging.getLogger("processing_workflow")
-    have_errors = False
 
     try:
         payload = ProcessingPayload.from_input(input)
         if not context.is_replaying:
             logger.info(f"Processing_workflow - received new payload: {payload}")
 
-        step_results = []
-        for step in payload.steps:
-            step_results_dic = {}  # track final results
-            attempt_count = 1
-            success = False
-            while True:
-                # Convert dataclass to dict before passing to call_activity
-                # otherwise the durabletask serialisation will deserialise it as a SimpleNamespace type
-                action_task_dict = {
-                    action_index: context.call_activity(
-                        invoke_processor, input=asdict(action)
-                    )
-                    for action_index, action in enumerate(step.actions)
-                    if action_index not in step_results_dic
-                }
-                action_tasks = action_task_dict.values()
-
-                if len(action_tasks) == 0:
-                    raise Exception("No actions to process")
-
-                yield wf.when_all(action_tasks)
-
-                # Determine whether to retry any actions
-                if _has_errors(action_tasks):
-                    attempt_count += 1
-                    if attempt_count > MAX_RETRIES:
-                        # copy all tasks to result dict (i.e. include errors)
-                        for action_index, task in action_task_dict.items():
-                            action = step.actions[action_index]
-                            step_results_dic[action_index] = ProcessingActionResult(
-                                action=action.action,
-                                content=action.content,
-                                result=task.get_result(),
-                                attempt_count=attempt_count - 1,  # already incremented
-                            )
-                        break
-                    else:
-                        # copy successful tasks to result dict
-                        for action_index, task in action_task_dict.items():
-                            if not _is_error(task):
-                                action = step.actions[action_index]
-                                step_results_dic[action_index] = ProcessingActionResult(
-                                    action=action.action,
-                                    content=action.content,
-                                    result=task.get_result(),
-                                    attempt_count=attempt_count,  # already incremented
-                                )
-                        
-                        # Insert logic to handle failures here
-                        # In this example, we're going to suspend the workflow for RETRY_SLEEP seconds 
-                        # before resuming to continue to the next attempt
-                        yield context.create_timer(context.current_utc_datetime + timedelta(seconds=RETRY_SLEEP))
-                        continue
-                else:
-                    # copy all tasks to result dict
-                    for action_index, task in action_task_dict.items():
-                        action = step.actions[action_index]
-                        step_results_dic[action_index] = ProcessingActionResult(
-                            action=action.action,
-                            content=action.content,
-                            result=task.get_result(),
-                            attempt_count=attempt_count,
-                        )
-                    success = True
-                    break
-
-            if len(step_results_dic) != len(step.actions):
-                raise Exception(
-                    f"Expected {len(step.actions)} results but got {len(step_results_dic)} (step={step.name}))"
-                )
-
-            step_results.append(step_results_dic)
-            if not success:
-                logger.info(
-                    f"processing step completed with errors - skipping any remaining work: {step.name}"
-                )
-                break
+        completed_steps = input.get("completed_steps", 0)
+        correlation = ActionCorrelation(context, completed_steps)
+        action_runs, success, next_step = yield from run_steps(
+            context,
+            payload,
+            partial(_StepWithRetries, correlation=correlation),
+            processing_shard_workflow,
+            completed_steps,
+        )
+        if len(correlation.cancel_tasks) > 0:
+            yield wf.when_all(correlation.cancel_tasks)
+        if next_step is not None:
+            # continue as new to process the remaining steps (keeping the history for the instance bounded)
+            context.continue_as_new(get_continue_as_new_input(input, next_step))
+            return "workflow continued as new"
 
         # Gather results
         results = ProcessingResult(
             id=context.instance_id,
             status="Completed" if success else "Failed",
-            steps=[
-                ProcessingStepResult(
-                    step.name,
-                    [
-                        step_results[step_index][action_index]
-                        for action_index, action in enumerate(step.actions)
-                    ] if step_index < len(step_results) else [
-                        ProcessingActionResult(
-                            action=action.action,
-                            content=action.content,
-                            result=None,
-                            attempt_count=0)
-                        for action in step.actions
-                    ],
-                )
-                for step_index, step in enumerate(payload.steps)
-            ],
+            steps=gather_step_results(payload, action_runs, not_started_attempt_count=0),
         )
         logger.info(f"processing_workflow completed: {results}")
 
-        yield context.call_activity(save_state, input=asdict(results))
+        yield context.call_activity(save_state, input=get_save_state_input(results, completed_steps))
 
         return "workflow done"
     except Exception as e:
         logger.error(f"!!!workflow error: {traceback.format_exception(e)}")
-        # TODO - save state here showing progress and include the error(s)?
+        # progress is checkpointed as actions complete (see save_checkpoint) so the job can be resumed
+        # TODO - save state here including the error(s)?
         raise e
 
 
@@ -304,12 +377,22 @@ def invoke_processor(context: WorkflowActivityContext, input_dict):
             f"invoke_processor (wf_id: {context.workflow_id}; task_id: {context.task_id}): ⚡ triggered"
             + json.dumps(input_dict)
         )
+        input_dict = dict(input_dict)
+        correlation_id = input_dict.pop("correlation_id")
+        fail_fast = input_dict.pop("fail_fast", False)
+        tenant = input_dict.pop("tenant", None)
         action = ProcessingAction(**input_dict)
 
-        # Currently using action.name as the app_id
-        # This is a simplification - imagine having a mapping and applying validation etc ;-)
+        if fail_fast and _is_action_cancelled(correlation_id):
+            # the action has been cancelled (e.g. another action in the step failed) so the result isn't needed
+            logger.info(
+                f"invoke_processor (wf_id: {context.workflow_id}; task_id: {context.task_id}): cancelled - skipping"
+            )
+            return {"error": "action cancelled", "cancelled": True}
+
+        # action.action is mapped to the app_id of a processor replica using the routing table (see routing.py)
         body = {
-            "correlation_id": f"{context.workflow_id}-{context.task_id}",
+            "correlation_id": correlation_id,
             "content": action.content,
         }
         # wanted to use dapr_client.invoke_method but it obscures the response status code
@@ -322,10 +405,25 @@ def invoke_processor(context: WorkflowActivityContext, input_dict):
         # )
 
         dapr_http_port = os.getenv("DAPR_HTTP_PORT", "3500")
-        resp = requests.post(
-            url=f"http://localhost:{dapr_http_port}/v1.0/invoke/{action.action}/method/process",
-            data=json.dumps(body),
-            headers={"Content-Type": "application/json"},
+        # wait for the tenant's share of the processor capacity (see scheduler.py),
+        # then route to a replica for the action and use a circuit breaker per app
+        # so that calls fail fast while the processor is unavailable
+        resp = call_with_scheduler(
+            action.action,
+            tenant,
+            lambda: route_call(
+                action.action,
+                lambda app_id: call_with_circuit_breaker(
+                    app_id,
+                    lambda: requests.post(
+                        url=f"http://localhost:{dapr_http_port}/v1.0/invoke/{app_id}/method/process",
+                        data=json.dumps(body),
+                        headers={"Content-Type": "application/json"},
+                    ),
+                    is_failure=_is_server_error,
+                ),
+                is_failure=is_failed_response,
+            ),
         )
         if resp.ok:
             logger.info(
@@ -339,6 +437,9 @@ def invoke_processor(context: WorkflowActivityContext, input_dict):
             resp_data = {"error": _json_or_text(resp), "status_code": resp.status_code}
             return resp_data
 
+    except CircuitOpenError as e:
+        logger.error(f"invoke_processor (wf_id: {context.workflow_id}; task_id: {context.task_id}): 🔌 {e}")
+        return {"error": str(e), "circuit_open": True}
     except Exception as e:
         logger.error(f"invoke_processor (wf_id: {context.workflow_id}; task_id: {context.task_id}) - failed with: {e}")
         # return an error type as a result rather than throwing as
@@ -346,20 +447,22 @@ def invoke_processor(context: WorkflowActivityContext, input_dict):
         return {"error": str(e)}  # TODO likely don't want to expose raw errors
 
 
-def _json_or_text(resp: requests.Response):
+def _is_action_cancelled(correlation_id):
+    # the check is only an optimisation, so if the cancellation can't be looked up then the action is processed
     try:
-        return resp.json()
-    except:
-        return resp.text
+        return is_action_cancelled(correlation_id)
+    except Exception as e:
+        logging.getLogger("invoke_processor").warning(f"Failed to check for cancellation ({correlation_id}): {e}")
+        return False
 
 
-def save_state(context: WorkflowActivityContext, input_dict):
-    logger = logging.getLogger("save_state")
+def _is_server_error(resp: requests.Response):
+    # 4xx responses (e.g. rate-limiting or invalid input) don't indicate that the processor is unhealthy
+    return resp.status_code >= 500
 
+
+def _json_or_text(resp: requests.Response):
     try:
-        dapr_client.save_state(
-            "statestore", context.workflow_id, json.dumps(input_dict)
-        )
-    except Exception as e:
-        logger.error(f"!!!save_state error: {e}")
-        raise e
+        return resp.json()
+    except:
+        return resp.text
@@ -1,20 +1,41 @@
 import logging
-from dapr.clients import DaprClient
 from dapr.conf import settings
-from dapr.ext.workflow import (
-    WorkflowRuntime,
-)
 
 from flask import Flask, request
+from datetime import timezone
 import json
 import os
+import sys
+import uuid
+
+# the modules shared between the services (e.g. codec.py) are in src/common
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
 
-from workflow2 import register_workflow_components
+import codec
+from clients import get_dapr_client
+from debug import register_debug_routes
+from admission import (
+    QUEUED,
+    REJECTED,
+    RETRY_AFTER_SECONDS,
+    AdmissionController,
+    DaprStateStore,
+    start_draining,
+)
+from local_dapr import LOCAL_DAPR_ENABLED
+from retention import DaprStateItemStore, RetentionManager, start_purging
+from startup import StartupChecks, is_workflow_worker_ready
+from worker import WORKFLOW_WORKERS, create_workflow_runtime, start_workers, stop_workers
+from processing import ProcessingPayload, get_checkpoint_keys, is_action_cancelled
 
 
 app = Flask(__name__)
-dapr_client = DaprClient()
 logging.basicConfig(level=logging.INFO)
+register_debug_routes(app)
+
+TERMINAL_STATUSES = ["completed", "failed", "terminated"]
+
+startup_checks = StartupChecks()
 
 
 @app.route("/workflows", methods=["POST"])
@@ -23,37 +44,181 @@ def start_workflow():
     data = request.json
     logger.info("POST /workflows triggered: " + json.dumps(data))
 
+    return _start_workflow(data)
+
+
+@app.route("/workflows/<instance_id>/resume", methods=["POST"])
+def resume_workflow(instance_id):
+    # Starts a new workflow instance for a job that reuses the checkpointed results from a previous instance
+    # so that only actions that didn't complete successfully are processed again.
+    # The job can be passed in the body, otherwise the input from the previous instance is used
+    # Checkpointed results are only reused for actions that match the action in the job
+    # (see _run_steps), so a job that has been changed only reuses the results that still apply
+    logger = logging.getLogger("resume_workflow")
+    if admission_controller.get_queue_position(instance_id) is not None:
+        return {"success": False, "error": f"Workflow instance {instance_id} is queued"}, 409
+    try:
+        workflow_response = get_dapr_client().get_workflow(
+            instance_id=instance_id, workflow_component="dapr"
+        )
+    except Exception as e:
+        if _is_not_found_error(e):
+            return {"success": False, "error": f"Workflow instance {instance_id} not found"}, 404
+        raise
+    if workflow_response.runtime_status.lower() not in TERMINAL_STATUSES:
+        return {"success": False, "error": f"Workflow instance {instance_id} is still running"}, 409
+
+    data = request.get_json(silent=True)
+    if not data:
+        data = json.loads(workflow_response.properties["dapr.workflow.input"])
+    data = dict(data, resume_from=instance_id)
+    # the steps processed before the previous instance continued as new are also in its checkpoint
+    data.pop("completed_steps", None)
+    logger.info(f"POST /workflows/{instance_id}/resume triggered: " + json.dumps(data))
+
+    return _start_workflow(data)
+
+
+def _start_workflow(data):
     # Here we are passing data from input to workflow
     # This 'works' because we have matched the data format of the body with the workload input
-    # but you might want some validation here ;-)
-    response = dapr_client.start_workflow(
-        workflow_component="dapr", workflow_name="processing_workflow", input=data
-    )
+    # Parse the input to check that it is valid (e.g. step dependencies can be satisfied)
+    try:
+        payload = ProcessingPayload.from_input(data)
+    except (KeyError, TypeError, ValueError) as e:
+        return {"success": False, "error": f"Invalid job: {e}"}, 400
+
+    # the instance id is generated here so that it can be returned for jobs that are queued
+    instance_id = str(uuid.uuid4())
+    action_count = sum(len(step.actions) for step in payload.steps)
+    result = admission_controller.submit(instance_id, data, action_count)
+    if result == REJECTED:
+        return (
+            {"success": False, "error": "Too many jobs running - retry later"},
+            429,
+            {"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
 
     return (
-        {"success": True, "instance_id": response.instance_id},
-        200,
+        {"success": True, "instance_id": instance_id, "queued": result == QUEUED},
+        202 if result == QUEUED else 200,
         {
             "ContentType": "application/json",
-            "Location": f"/workflows/{response.instance_id}",
+            "Location": f"/workflows/{instance_id}",
         },
     )
 
 
-@app.route("/workflows/<instance_id>", methods=["GET"])
-def query_workflow(instance_id):
-    workflow_response = dapr_client.get_workflow(
+def _start_workflow_instance(instance_id, data):
+    get_dapr_client().start_workflow(
+        workflow_component="dapr",
+        workflow_name="processing_workflow",
+        input=data,
+        instance_id=instance_id,
+    )
+    retention_manager.track(instance_id)
+
+
+def _is_workflow_running(instance_id):
+    try:
+        workflow_response = get_dapr_client().get_workflow(
+            instance_id=instance_id, workflow_component="dapr"
+        )
+    except Exception as e:
+        # the instance has completed and been purged (see retention.py)
+        if _is_not_found_error(e):
+            return False
+        raise
+    return workflow_response.runtime_status.lower() not in TERMINAL_STATUSES
+
+
+def _is_not_found_error(e):
+    # the Dapr runtime reports unknown instances as "no such instance exists"
+    # (and the local stand-in as "workflow instance ... not found")
+    message = str(e).lower()
+    return "no such instance" in message or "not found" in message
+
+
+def _get_workflow_completed_at(instance_id):
+    workflow_response = get_dapr_client().get_workflow(
+        instance_id=instance_id, workflow_component="dapr"
+    )
+    if workflow_response.runtime_status.lower() not in TERMINAL_STATUSES:
+        return None
+    # last_updated_at is a naive UTC datetime
+    return workflow_response.last_updated_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _get_workflow_checkpoint_keys(instance_id):
+    workflow_response = get_dapr_client().get_workflow(
         instance_id=instance_id, workflow_component="dapr"
     )
+    return get_checkpoint_keys(instance_id, json.loads(workflow_response.properties["dapr.workflow.input"]))
+
+
+def _purge_workflow_instance(instance_id):
+    get_dapr_client().purge_workflow(instance_id=instance_id, workflow_component="dapr")
+
+
+retention_manager = RetentionManager(
+    DaprStateItemStore(get_dapr_client),
+    get_completed_at=_get_workflow_completed_at,
+    get_checkpoint_keys=_get_workflow_checkpoint_keys,
+    purge_workflow=_purge_workflow_instance,
+)
+
+
+admission_controller = AdmissionController(
+    DaprStateStore(get_dapr_client),
+    is_running=_is_workflow_running,
+    start_workflow=_start_workflow_instance,
+)
+
+
+@app.route("/workflows/<instance_id>", methods=["GET"])
+def query_workflow(instance_id):
+    queue_position = admission_controller.get_queue_position(instance_id)
+    if queue_position is not None:
+        return {"status": "Queued", "queue_position": queue_position}
+
+    try:
+        workflow_response = get_dapr_client().get_workflow(
+            instance_id=instance_id, workflow_component="dapr"
+        )
+    except Exception as e:
+        if not _is_not_found_error(e):
+            raise
+        # the workflow instance may have been purged after its result was archived (see retention.py)
+        archived_result = retention_manager.load_archived_result(instance_id)
+        if archived_result is None:
+            return {"success": False, "error": f"Workflow instance {instance_id} not found"}, 404
+        return archived_result
     if workflow_response.runtime_status == "Completed":
-        state = dapr_client.get_state("statestore", workflow_response.instance_id)
-        response = state.json()
+        state = get_dapr_client().get_state("statestore", workflow_response.instance_id)
+        if state.data:
+            response = codec.loads(state.data)
+        else:
+            # the result has expired (see RESULT_TTL_SECONDS in retention.py)
+            response = {"status": "Completed", "result_expired": True}
     else:
         response = {"status": workflow_response.runtime_status}
 
     return response
 
 
+@app.route("/workflows/<instance_id>/status", methods=["GET"])
+def query_workflow_status(instance_id):
+    # lightweight status check (used by processing_consumer to skip work for cancelled actions and completed workflows)
+    workflow_response = get_dapr_client().get_workflow(
+        instance_id=instance_id, workflow_component="dapr"
+    )
+    response = {"status": workflow_response.runtime_status}
+    correlation_id = request.args.get("correlation_id")
+    if correlation_id:
+        response["cancelled"] = is_action_cancelled(correlation_id)
+    return response
+
+
 @app.route("/raise-event", methods=["POST"])
 def raise_workflow_event():
     logger = logging.getLogger("raise_workflow_event")
@@ -72,7 +237,7 @@ def raise_workflow_event():
     if not result:
         raise Exception("response not found in data")
 
-    dapr_client.raise_workflow_event(
+    get_dapr_client().raise_workflow_event(
         instance_id=instance_id,
         workflow_component="dapr",
         event_name=correlation_id,
@@ -81,30 +246,66 @@ def raise_workflow_event():
     return {"success": True}
 
 
+@app.route("/admission", methods=["GET"])
+def query_admission():
+    return admission_controller.get_status()
+
+
+@app.route("/retention", methods=["GET"])
+def query_retention():
+    return retention_manager.get_status()
+
+
 @app.route("/healthz", methods=["GET"])
 def healthz():
     return "OK"
 
 
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    status = startup_checks.get_status()
+    return status, 200 if status["ready"] else 503
+
+
+def _wait_for_sidecar():
+    get_dapr_client().wait(10)
+    print("dapr sidecar ready", flush=True)
+    start_draining(admission_controller)
+    start_purging(retention_manager)
+
+
 def main():
     host = settings.DAPR_RUNTIME_HOST
     grpc_port = settings.DAPR_GRPC_PORT
-    workflowRuntime = WorkflowRuntime(host, grpc_port)
-    register_workflow_components(workflowRuntime)
-    print(f"Starting workflow runtime on {host}:{grpc_port}", flush=True)
-    workflowRuntime.start()
+    workflowRuntime = None
+    workers = []
+    # the local stand-in runs the workflows in the API process (see local_dapr.py)
+    if WORKFLOW_WORKERS > 0 and not LOCAL_DAPR_ENABLED:
+        # run the workflow runtime in separate worker processes (see worker.py)
+        print(f"Starting {WORKFLOW_WORKERS} workflow worker processes on {host}:{grpc_port}", flush=True)
+        workers = start_workers(WORKFLOW_WORKERS)
+        startup_checks.add_live_check("workflow_workers", lambda: all(worker.is_ready() for worker in workers))
+    else:
+        workflowRuntime = create_workflow_runtime()
 
+        # start the workflow runtime and wait for the dapr sidecar in the background
+        # so that the flask app can start serving straight away (/readyz reports when startup has completed)
+        print(f"Starting workflow runtime on {host}:{grpc_port}", flush=True)
+        startup_checks.run_in_background("workflow_runtime", workflowRuntime.start)
+        startup_checks.add_live_check("workflow_worker", lambda: is_workflow_worker_ready(workflowRuntime))
     print("Waiting for dapr sidecar...", flush=True)
-    dapr_client.wait(10)
+    startup_checks.run_in_background("dapr_sidecar", _wait_for_sidecar)
 
     app_port = int(os.getenv("APP_PORT", "8100"))
-    print(f"dapr sidecar ready, starting flask app on port {app_port}", flush=True)
+    print(f"starting flask app on port {app_port}", flush=True)
     app.run(port=app_port)
     print(
         "*************************** Flask app exited - shutting down workflow runtime"
     )
 
-    workflowRuntime.shutdown()
+    if workflowRuntime is not None:
+        workflowRuntime.shutdown()
+    stop_workers(workers)
 
 
 if __name__ == "__main__":
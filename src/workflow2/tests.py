@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import unittest
+from unittest.mock import patch
+
+from dapr.clients.grpc._response import BulkStateItem, BulkStatesResponse, StateResponse
+
+# the modules shared between the services (e.g. codec.py) are in src/common
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+import app
+import clients
+import codec
+import processing
+from local_dapr import LocalDaprClient, LocalGetWorkflowResponse, LocalWorkflowRuntime
+from workflow2 import register_workflow_components
+
+
+class _MemoryDaprClient(LocalDaprClient):
+    # LocalDaprClient (for the workflow methods) with the state held in memory rather than in the local sidecar,
+    # and the published events passed to on_published (which stands in for the processing_consumer)
+    def __init__(self, on_published):
+        super().__init__()
+        self.state = {}
+        self.published = []
+        self._on_published = on_published
+
+    def get_state(self, store_name, key, state_metadata=None):
+        return StateResponse(self.state.get(key, b""))
+
+    def save_state(self, store_name, key, value, etag=None, options=None, state_metadata=None):
+        self.state[key] = value
+
+    def save_bulk_state(self, store_name, states, metadata=None):
+        for state in states:
+            self.state[state.key] = state.value
+
+    def get_bulk_state(self, store_name, keys, parallelism=1, states_metadata=None):
+        return BulkStatesResponse([BulkStateItem(key, self.state.get(key, b""), "") for key in keys])
+
+    def delete_state(self, store_name, key, etag=None, options=None, state_metadata=None):
+        self.state.pop(key, None)
+
+    def publish_event(self, pubsub_name, topic_name, data, publish_metadata=None, data_content_type=None):
+        self.published.append((topic_name, codec.loads(data)))
+        self._on_published(codec.loads(data))
+
+
+class TestProcessingWorkflow(unittest.TestCase):
+    # Runs processing_workflow on the local workflow runtime, with the results for the published actions raised
+    # as events by _process (the result is the content in upper case, or an error for "fail", and there is
+    # no result for "hold" so that it is still outstanding when the other actions complete)
+    def setUp(self):
+        self.runtime = LocalWorkflowRuntime()
+        register_workflow_components(self.runtime)
+        self.runtime.start()
+        self.client = _MemoryDaprClient(self._process)
+        self._previous_client = clients._dapr_client
+        clients._dapr_client = self.client
+
+    def tearDown(self):
+        clients._dapr_client = self._previous_client
+        self.runtime.shutdown()
+
+    def _process(self, message):
+        if message["content"] == "hold":
+            return
+        if message["content"] == "fail":
+            response = {"error": "processing failed"}
+        else:
+            response = {"success": True, "result": message["content"].upper()}
+        self.runtime.raise_event(message["instance_id"], message["correlation_id"], response)
+
+    def test_results_are_correlated_with_actions(self):
+        job = {
+            "steps": [
+                {"name": "s1", "actions": [{"action": "processor1", "content": c} for c in ["a", "b"]]},
+                {"name": "s2", "actions": [{"action": "processor1", "content": "c"}]},
+            ]
+        }
+
+        instance_id, result = self._run(job)
+
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual(
+            [[action["result"]["result"] for action in step["actions"]] for step in result["steps"]], [["A", "B"], ["C"]]
+        )
+        messages = [message for _, message in self.client.published]
+        self.assertEqual(
+            [message["correlation_id"] for message in messages],
+            [f"{instance_id}-0-1", f"{instance_id}-0-2", f"{instance_id}-0-3"],
+        )
+        self.assertEqual({topic for topic, _ in self.client.published}, {"processor1"})
+        self.assertFalse(any(message["fail_fast"] for message in messages))
+
+    def test_fail_fast_cancels_outstanding_actions(self):
+        job = {
+            "fail_fast": True,
+            "steps": [
+                {"name": "s1", "actions": [{"action": "processor1", "content": c} for c in ["hold", "fail", "b"]]},
+                {"name": "s2", "actions": [{"action": "processor1", "content": "c"}]},
+            ],
+        }
+
+        instance_id, result = self._run(job)
+
+        self.assertEqual(result["status"], "Failed")
+        results = [action["result"] for action in result["steps"][0]["actions"]]
+        self.assertTrue(results[0]["cancelled"])
+        self.assertEqual(results[1], {"error": "processing failed"})
+        self.assertNotIn("c", [message["content"] for _, message in self.client.published])
+        # the outstanding action is recorded as cancelled for the processing_consumer
+        # (via the status endpoint), while the completed actions aren't
+        client = app.app.test_client()
+        for correlation_id, cancelled in [(f"{instance_id}-0-1", True), (f"{instance_id}-0-2", False)]:
+            status = client.get(f"/workflows/{instance_id}/status", query_string={"correlation_id": correlation_id})
+            self.assertEqual(status.json, {"status": "Completed", "cancelled": cancelled})
+
+    def test_correlation_ids_are_unique_across_continue_as_new(self):
+        job = {"steps": [{"name": f"s{i}", "actions": [{"action": "processor1", "content": f"c{i}"}]} for i in range(3)]}
+
+        with patch.object(processing, "MAX_STEPS_PER_INSTANCE", 1):
+            instance_id, result = self._run(job)
+
+        self.assertEqual(result["status"], "Completed")
+        self.assertEqual([step["actions"][0]["result"]["result"] for step in result["steps"]], ["C0", "C1", "C2"])
+        self.assertEqual(
+            [message["correlation_id"] for _, message in self.client.published],
+            [f"{instance_id}-0-1", f"{instance_id}-1-1", f"{instance_id}-2-1"],
+        )
+
+    def _run(self, job):
+        instance_id = self.runtime.schedule_new_workflow("processing_workflow", job)
+        for _ in range(500):
+            response = LocalGetWorkflowResponse(self.runtime.get_instance(instance_id))
+            if response.runtime_status in ["Completed", "Failed"]:
+                self.assertEqual(response.runtime_status, "Completed")
+                return instance_id, codec.loads(self.client.state[instance_id])
+            time.sleep(0.01)
+        self.fail("workflow not completed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import os
+import sys
+
+# the modules shared between the services (e.g. codec.py) are in src/common
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+import worker_processes
+from worker_processes import WORKFLOW_WORKERS, stop_workers
+from workflow2 import register_workflow_components
+
+# Runs the workflow2 workflows and activities in separate worker processes (see worker_processes.py in src/common)
+# Workers can also be run independently of the API (e.g. in a separate container) with `python worker.py`.
+
+
+def create_workflow_runtime():
+    """Creates a WorkflowRuntime with the workflow2 workflows and activities registered"""
+    return worker_processes.create_workflow_runtime(register_workflow_components)
+
+
+def start_workers(worker_count):
+    """Starts worker processes that each run the workflow2 workflow runtime"""
+    return worker_processes.start_workers(register_workflow_components, worker_count)
+
+
+if __name__ == "__main__":
+    worker_processes.main(register_workflow_components)
@@ -1,96 +1,186 @@
-from dataclasses import dataclass, asdict
-from datetime import timedelta
+from dataclasses import asdict
+from functools import partial
 import json
 import logging
-import os
-import requests
-import traceback
 from dapr.ext.workflow import (
     DaprWorkflowContext,
     WorkflowActivityContext,
 )
 import dapr.ext.workflow as wf
-from dapr.clients import DaprClient
-
-dapr_client = DaprClient()
-
-
-@dataclass
-class ProcessingAction:
-    action: str
-    content: str
-
-
-@dataclass
-class ProcessingStep:
-    name: str
-    actions: list[ProcessingAction]
-
-    @staticmethod
-    def from_input(data):
-        name = data["name"]
-        actions = []
-        for action in data["actions"]:
-            actions.append(ProcessingAction(**action))
-
-        return ProcessingStep(name, actions)
-
-
-@dataclass
-class ProcessingPayload:
-    steps: list[ProcessingStep]
-
-    @staticmethod
-    def from_input(data):
-        steps = []
-        for step in data["steps"]:
-            steps.append(ProcessingStep.from_input(step))
-        return ProcessingPayload(steps)
-
-
-@dataclass
-class ProcessingActionResult:
-    action: str
-    content: str
-    result: str
-    attempt_count: int
-
-
-@dataclass
-class ProcessingStepResult:
-    name: str
-    actions: list[ProcessingActionResult]
-
-
-@dataclass
-class ProcessingResult:
-    id: str
-    status: str
-    steps: list[ProcessingStepResult]
-
-
-def _has_errors(tasks):
-    for task in tasks:
-        if _is_error(task):
-            return True
-    return False
 
+import codec
+from clients import get_dapr_client
+from processing import (
+    ActionCorrelation,
+    ProcessingAction,
+    ProcessingActionResult,
+    ProcessingPayload,
+    ProcessingResult,
+    ProcessingStep,
+    cancel_actions,
+    cancelled_result,
+    gather_step_results,
+    get_continue_as_new_input,
+    get_save_state_input,
+    has_errors,
+    is_error,
+    load_checkpoint,
+    run_steps,
+    save_checkpoint,
+    save_state,
+    terminate_workflows,
+)
 
-def _is_error(task):
-    if task.is_failed:
-        return True
-    result = task.get_result()
-    if result is None:
-        return True
-    if "error" in result:
-        return True
-    return False
+# The job model and the orchestration that is shared with workflow1 are in processing.py (in src/common)
 
 
 def register_workflow_components(workflowRuntime):
     workflowRuntime.register_workflow(processing_workflow)
+    workflowRuntime.register_workflow(processing_shard_workflow)
     workflowRuntime.register_activity(invoke_processor)
     workflowRuntime.register_activity(save_state)
+    workflowRuntime.register_activity(save_checkpoint)
+    workflowRuntime.register_activity(load_checkpoint)
+    workflowRuntime.register_activity(terminate_workflows)
+    workflowRuntime.register_activity(cancel_actions)
+
+
+def processing_shard_workflow(context: DaprWorkflowContext, input):
+    # Child workflow that processes a shard of the actions for a large step (see _ShardedStep)
+    # Returns the results for the actions in the shard and a flag indicating whether they all succeeded
+    step = ProcessingStep.from_input(input)
+    correlation = ActionCorrelation(context)
+    shard = _Step(context, step, correlation)
+    while not shard.is_done:
+        yield shard.task
+        shard.on_task_completed()
+    if len(correlation.cancel_tasks) > 0:
+        yield wf.when_all(correlation.cancel_tasks)
+    return {
+        "success": shard.success,
+        "results": [asdict(shard.get_action_result(action_index)) for action_index in range(len(step.actions))],
+    }
+
+
+def _get_activity_input(step: ProcessingStep, action: ProcessingAction, correlation_id):
+    # Convert dataclass to dict before passing to call_activity
+    # otherwise the durabletask serialisation will deserialise it as a SimpleNamespace type
+    input = asdict(action)
+    input["correlation_id"] = correlation_id
+    if step.fail_fast:
+        # actions for fail_fast steps can be abandoned, so the processing_consumer checks that the action
+        # hasn't been cancelled (and that the workflow is still running) before processing them
+        input["fail_fast"] = True
+    if step.tenant is not None:
+        input["tenant"] = step.tenant
+    return input
+
+
+class _Step:
+    # Processes the actions for a step by publishing them for the processing_consumer
+    # and then waiting for the external events that are raised with the results
+    def __init__(self, context: DaprWorkflowContext, step: ProcessingStep, correlation: ActionCorrelation):
+        self.step = step
+        self.correlation_ids = [correlation.new_correlation_id() for _ in step.actions]
+        self.action_tasks = [
+            context.call_activity(invoke_processor, input=_get_activity_input(step, action, correlation_id))
+            for action, correlation_id in zip(step.actions, self.correlation_ids)
+        ]
+        self.result_tasks = self.action_tasks
+        self.task = wf.when_all(self.action_tasks)
+        self.cancelled_actions = set()
+        self.is_done = False
+        self.success = False
+        self._context = context
+        self._correlation = correlation
+
+    def on_task_completed(self):
+        logger = logging.getLogger("processing_workflow")
+        if self.result_tasks is self.action_tasks:
+            if has_errors(self.action_tasks):
+                logger.info(
+                    f"processing step completed with errors while invoking processor - skipping any remaining work: {self.step.name}"
+                )
+                # the actions that were published are abandoned
+                self._cancel_actions(
+                    [action_index for action_index, task in enumerate(self.action_tasks) if not is_error(task)]
+                )
+                self.is_done = True
+                return
+            # The correlation_ids are used to correlate the results from the pubsub events
+            # and are the names of the external events to wait for
+            self.result_tasks = [
+                self._context.wait_for_external_event(correlation_id)
+                for correlation_id in self.correlation_ids
+            ]
+            # the tasks for events that were raised before the workflow started waiting for them are already
+            # complete, so they are checked straight away (otherwise a failure wouldn't be handled until
+            # another result arrives)
+
+        completed_tasks = [task for task in self.result_tasks if task.is_complete]
+        if self.step.fail_fast and has_errors(completed_tasks):
+            logger.info(
+                f"processing step completed with errors from processing - cancelling remaining actions: {self.step.name}"
+            )
+            self.cancel()
+        elif len(completed_tasks) == len(self.result_tasks):
+            self.is_done = True
+            self.success = not has_errors(self.result_tasks)
+            if not self.success:
+                logger.info(
+                    f"processing step completed with errors from processing - skipping any remaining work: {self.step.name}"
+                )
+        else:
+            self._wait_for_results()
+
+    def _wait_for_results(self):
+        pending_tasks = [task for task in self.result_tasks if not task.is_complete]
+        if self.step.fail_fast and len(pending_tasks) > 0:
+            # wait for the next result so that a failure can be handled straight away
+            self.task = wf.when_any(pending_tasks)
+        else:
+            self.task = wf.when_all(self.result_tasks)
+
+    def cancel(self):
+        # every action that hasn't had a result event is cancelled (including all of the actions
+        # if their messages are still being published)
+        self._cancel_actions(
+            [
+                action_index
+                for action_index, task in enumerate(self.result_tasks)
+                if self.result_tasks is self.action_tasks or not task.is_complete
+            ]
+        )
+        self.is_done = True
+        self.success = False
+
+    def _cancel_actions(self, action_indices):
+        self.cancelled_actions = set(action_indices)
+        if self.step.fail_fast and len(action_indices) > 0:
+            # the processing_consumer checks for cancelled actions before processing the messages for fail_fast steps
+            self._correlation.cancel([self.correlation_ids[action_index] for action_index in action_indices])
+
+    def get_completed_actions(self):
+        # returns the indices of the actions that have completed successfully
+        if self.result_tasks is self.action_tasks:
+            # still waiting for the messages to be published
+            return []
+        return [
+            action_index
+            for action_index, task in enumerate(self.result_tasks)
+            if action_index not in self.cancelled_actions and task.is_complete and not is_error(task)
+        ]
+
+    def get_action_result(self, action_index):
+        action = self.step.actions[action_index]
+        return ProcessingActionResult(
+            action=action.action,
+            content=action.content,
+            result=cancelled_result()
+            if action_index in self.cancelled_actions
+            else self.result_tasks[action_index].get_result(),
+            attempt_count=1,  # no retries, so always a single attempt ;-)
+        )
 
 
 def processing_workflow(context: DaprWorkflowContext, input):
@@ -98,81 +188,39 @@ def processing_workflow(context: DaprWorkflowContext, input):
     # Calls here must be deterministic
     # TODO: consider whether logging makes sense here
     logger = logging.getLogger("processing_workflow")
-    have_errors = False
 
     try:
         payload = ProcessingPayload.from_input(input)
         if not context.is_replaying:
             logger.info(f"Processing_workflow - received new payload: {payload}")
 
-        step_results = []
-        for step in payload.steps:
-            # Convert dataclass to dict before passing to call_activity
-            # otherwise the durabletask serialisation will deserialise it as a SimpleNamespace type
-            action_tasks = [
-                context.call_activity(invoke_processor, input=asdict(action))
-                for action in step.actions
-            ]
-            yield wf.when_all(action_tasks)
-            if _has_errors(action_tasks):
-                logger.info(
-                    f"processing step completed with errors while invoking processor - skipping any remaining work: {step.name}"
-                )
-                step_results.append(action_tasks)
-                have_errors = True
-                break
-            # Get the correlation_ids from the action tasks
-            # These are used to correlate the results from the pubsub events
-            # And will be used as the name of external events to wait for
-            event_correlation_ids = [
-                r.get_result().get("correlation_id") for r in action_tasks
-            ]
-            events = [
-                context.wait_for_external_event(event_correlation_id)
-                for event_correlation_id in event_correlation_ids
-            ]
-            yield wf.when_all(events)
-            step_results.append(events)
-            if _has_errors(events):
-                logger.info(
-                    f"processing step completed with errors from processing - skipping any remaining work: {step.name}"
-                )
-                have_errors = True
-                break
+        completed_steps = input.get("completed_steps", 0)
+        correlation = ActionCorrelation(context, completed_steps)
+        action_runs, success, next_step = yield from run_steps(
+            context, payload, partial(_Step, correlation=correlation), processing_shard_workflow, completed_steps
+        )
+        if len(correlation.cancel_tasks) > 0:
+            yield wf.when_all(correlation.cancel_tasks)
+        if next_step is not None:
+            # continue as new to process the remaining steps (keeping the history for the instance bounded)
+            context.continue_as_new(get_continue_as_new_input(input, next_step))
+            return "workflow continued as new"
 
         # Gather results
         results = ProcessingResult(
             id=context.instance_id,
-            status="Failed" if have_errors else "Completed",
-            steps=[
-                ProcessingStepResult(
-                    step.name,
-                    [
-                        # step_results is an list of steps
-                        # each item is a list of action tasks
-                        # map each of these to a ProcessingActionResult
-                        ProcessingActionResult(
-                            action=action.action,
-                            content=action.content,
-                            result=step_results[step_index][action_index].get_result()
-                            if len(step_results) > step_index
-                            else None,
-                            attempt_count=1,  # no retries, so always a single attempt ;-)
-                        )
-                        for action_index, action in enumerate(step.actions)
-                    ],
-                )
-                for step_index, step in enumerate(payload.steps)
-            ],
+            status="Completed" if success else "Failed",
+            steps=gather_step_results(payload, action_runs, not_started_attempt_count=1),
         )
         logger.info(f"processing_workflow completed: {results}")
 
-        yield context.call_activity(save_state, input=asdict(results))
+        yield context.call_activity(save_state, input=get_save_state_input(results, completed_steps))
 
         return "workflow done"
     except Exception as e:
         logger.error(f"!!!workflow error: {e}")
-        # TODO - save state here showing progress and include the error(s)?
+        # progress is checkpointed as actions complete (see save_checkpoint) so the job can be resumed
+        # TODO - save state here including the error(s)?
         raise e
 
 
@@ -184,19 +232,28 @@ def invoke_processor(context: WorkflowActivityContext, input_dict):
             f"invoke_processor (wf_id: {context.workflow_id}; task_id: {context.task_id}): ⚡ triggered"
             + json.dumps(input_dict)
         )
+        input_dict = dict(input_dict)
+        fail_fast = input_dict.pop("fail_fast", False)
+        tenant = input_dict.pop("tenant", None)
+        correlation_id = input_dict.pop("correlation_id")
         action = ProcessingAction(**input_dict)
 
         # Currently using action.name as the app_id
         # This is a simplification - imagine having a mapping and applying validation etc ;-)
-        correlation_id = f"{context.workflow_id}-{context.task_id}"
         body = {
             "instance_id": context.workflow_id,
             "correlation_id": correlation_id,  # used when calling back to indicate completion
             "content": action.content,
+            "fail_fast": fail_fast,  # indicates that the consumer should skip the message if the action is cancelled
+            "tenant": tenant,  # used by the consumer to share the processor capacity between tenants
         }
 
-        resp = dapr_client.publish_event(
-            pubsub_name="pubsub", topic_name=action.action, data=json.dumps(body)
+        data = codec.dumps(body)
+        resp = get_dapr_client().publish_event(
+            pubsub_name="pubsub",
+            topic_name=action.action,
+            data=data,
+            data_content_type=codec.get_content_type(data),
         )
         logger.info(
             f"invoke_processor (wf_id: {context.workflow_id}; task_id: {context.task_id}) - published event: {resp}"
@@ -211,15 +268,3 @@ def invoke_processor(context: WorkflowActivityContext, input_dict):
         # return an error type as a result rather than throwing as
         # the workflow will be marked as failed otherwise
         return {"error": str(e)}  # TODO likely don't want to expose raw errors
-
-
-def save_state(context: WorkflowActivityContext, input_dict):
-    logger = logging.getLogger("save_state")
-
-    try:
-        dapr_client.save_state(
-            "statestore", context.workflow_id, json.dumps(input_dict)
-        )
-    except Exception as e:
-        logger.error(f"!!!save_state error: {e}")
-        raise e